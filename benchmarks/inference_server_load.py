@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import csv
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+
+async def send_requests(encoded_images: list, n_requests: int, host: str, port: int, unix_socket: str,
+                        latencies: list) -> None:
+    # One keep-alive connection sending its requests one after the other
+    if unix_socket:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    for i in range(n_requests):
+        body = encoded_images[i % len(encoded_images)]
+        start = time.time()
+        writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            host, len(body)).encode('latin1') + body)
+        await writer.drain()
+
+        content_length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                content_length = int(line.split(b':')[1])
+        await reader.readexactly(content_length)
+        latencies.append(time.time() - start)
+    writer.close()
+
+
+def run_load(encoded_images: list, concurrency: int, n_requests: int, host: str = 'localhost', port: int = 8080,
+             unix_socket: str = None) -> dict:
+    latencies = list()
+    loop = asyncio.get_event_loop()
+    start = time.time()
+    loop.run_until_complete(asyncio.gather(*[
+        send_requests(encoded_images, n_requests // concurrency, host, port, unix_socket, latencies)
+        for _ in range(concurrency)]))
+    duration = time.time() - start
+
+    return {'concurrency': concurrency,
+            'n_requests': len(latencies),
+            'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+            'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+            'requests_per_sec': len(latencies) / duration}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of serve_model.py (client side latencies)')
+    parser.add_argument('-f', '--csv_file', type=str, required=True, help='CSV file of the images sent')
+    parser.add_argument('--csv_delimiter', type=str, help='Delimiter of the csv file', default=';')
+    parser.add_argument('-c', '--concurrency', type=int, nargs='*', help='Numbers of concurrent clients',
+                        default=[1, 8, 32, 128])
+    parser.add_argument('-n', '--n_requests', type=int, help='Number of requests per concurrency level',
+                        default=2000)
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix_socket', type=str, default=None)
+    args = vars(parser.parse_args())
+
+    encoded_images = list()
+    with open(args.get('csv_file'), 'r', encoding='utf8') as f:
+        for row in csv.reader(f, delimiter=args.get('csv_delimiter')):
+            with open(row[0], 'rb') as image_file:
+                encoded_images.append(image_file.read())
+
+    for concurrency in args.get('concurrency'):
+        print(json.dumps(run_load(encoded_images, concurrency, args.get('n_requests'), host=args.get('host'),
+                                  port=args.get('port'), unix_socket=args.get('unix_socket'))))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.model import deep_bidirectional_lstm
+from src.config import Params, Alphabet
+
+
+def build_lstm_graph(lstm_implementation: str, inputs: np.ndarray):
+    params = Params(alphabet=Alphabet.LETTERS_DIGITS_EXTENDED, lstm_implementation=lstm_implementation)
+    params.keep_prob_dropout = 1.0
+
+    inputs = tf.constant(inputs)
+    sequence_length = tf.fill([inputs.get_shape()[0].value], inputs.get_shape()[1].value)
+    logits, _ = deep_bidirectional_lstm(inputs, params=params, summaries=False, sequence_length=sequence_length)
+    gradients = tf.gradients(tf.reduce_sum(logits), tf.trainable_variables())
+
+    return logits, gradients
+
+
+def time_lstm(lstm_implementation: str, inputs: np.ndarray, n_runs: int, checkpoint: str = None) -> dict:
+    with tf.Graph().as_default():
+        logits, gradients = build_lstm_graph(lstm_implementation, inputs)
+        saver = tf.train.Saver()
+
+        with tf.Session() as sess:
+            if checkpoint and os.path.isfile('{}.index'.format(checkpoint)):
+                saver.restore(sess, checkpoint)
+            else:
+                sess.run(tf.global_variables_initializer())
+                if checkpoint:
+                    saver.save(sess, checkpoint)
+
+            output = sess.run(logits)
+            timings = dict()
+            for name, fetches in [('forward', logits), ('forward_backward', [logits, gradients])]:
+                sess.run(fetches)
+                start = time.time()
+                for _ in range(n_runs):
+                    sess.run(fetches)
+                timings[name] = 1000 * (time.time() - start) / n_runs
+
+    return {'timings_ms': timings, 'output': output}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--time_steps', type=int, help='Numbers of time steps to time', nargs='*',
+                        default=[24, 99, 447])
+    parser.add_argument('-b', '--batch_size', type=int, help='Batch size', default=32)
+    parser.add_argument('-f', '--n_features', type=int, help='Size of the features (cnn output)', default=512)
+    parser.add_argument('-n', '--n_runs', type=int, help='Number of timed runs', default=10)
+    args = vars(parser.parse_args())
+
+    checkpoint_dir = tempfile.mkdtemp()
+    for time_steps in args.get('time_steps'):
+        inputs = np.random.RandomState(0).randn(args.get('batch_size'), time_steps,
+                                                args.get('n_features')).astype(np.float32)
+        # The fused implementation restores the checkpoint of the basic one to check that they are equivalent
+        checkpoint = os.path.join(checkpoint_dir, 'lstm_{}'.format(time_steps))
+        results = {implementation: time_lstm(implementation, inputs, args.get('n_runs'), checkpoint=checkpoint)
+                   for implementation in ['basic', 'block_fused']}
+
+        max_difference = np.abs(results['basic']['output'] - results['block_fused']['output']).max()
+        for implementation, result in results.items():
+            print('{:4d} steps | {:11s} | forward {:9.2f} ms ({:.3f} ms/step) | forward+backward {:9.2f} ms'.format(
+                time_steps, implementation, result['timings_ms']['forward'],
+                result['timings_ms']['forward'] / time_steps, result['timings_ms']['forward_backward']))
+        print('{:4d} steps | max difference of the outputs : {:.2e}'.format(time_steps, max_difference))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from typing import List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.model import deep_cnn, deep_bidirectional_lstm, crnn_fn
+from src.data_handler import data_loader, preprocess_batch_for_prediction
+from src.loader import PredictionModel
+from src.config import Params, Alphabet
+
+# Benchmarked on CPU with a fixed number of threads so that the results of two runs can be compared
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+
+def session_config(n_threads: int) -> tf.ConfigProto:
+    return tf.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=n_threads)
+
+
+def time_fetches(sess: tf.Session, fetches, n_runs: int, n_warmup_runs: int = 2, feed_dict: dict = None) -> float:
+    # Median time of the runs in ms
+    for _ in range(n_warmup_runs):
+        sess.run(fetches, feed_dict=feed_dict)
+    timings = list()
+    for _ in range(n_runs):
+        start = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        timings.append(time.time() - start)
+    return 1000 * float(np.median(timings))
+
+
+def make_params(input_shape: List[int], **kwargs) -> Params:
+    return Params(alphabet=Alphabet.LETTERS_DIGITS_EXTENDED, input_shape=tuple(input_shape), csv_delimiter=';',
+                  **kwargs)
+
+
+def write_synthetic_dataset(output_dir: str, n_images: int, height: int, max_width: int, seed: int = 0) -> str:
+    # Random grayscale png images of random widths with random labels, returns the csv filename
+    random_state = np.random.RandomState(seed)
+    alphabet = Alphabet.LETTERS_DIGITS
+    csv_filename = os.path.join(output_dir, 'synthetic.csv')
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        image_placeholder = tf.placeholder(tf.uint8, shape=[height, None, 1])
+        encoded_image = tf.image.encode_png(image_placeholder)
+        with open(csv_filename, 'w', encoding='utf8') as csv_file:
+            for i in range(n_images):
+                width = random_state.randint(max_width // 4, max_width + 1)
+                image = random_state.randint(0, 256, size=[height, width, 1]).astype(np.uint8)
+                filename = os.path.join(output_dir, '{:06d}.png'.format(i))
+                with open(filename, 'wb') as f:
+                    f.write(sess.run(encoded_image, feed_dict={image_placeholder: image}))
+                label = ''.join(random_state.choice(alphabet, size=random_state.randint(1, width // 16 + 2)))
+                csv_file.write('{};{}\n'.format(filename, label))
+    return csv_filename
+
+
+def benchmark_data_loader(csv_filename: str, input_shape: List[int], batch_size: int, n_batches: int,
+                          n_threads: int) -> dict:
+    results = dict()
+    for pipeline in ['queue', 'dataset']:
+        params = make_params(input_shape, input_pipeline=pipeline)
+        with tf.Graph().as_default():
+            features, _ = data_loader(csv_filename=csv_filename, params=params, batch_size=batch_size)()
+            with tf.train.MonitoredSession(session_creator=tf.train.ChiefSessionCreator(
+                    config=session_config(n_threads))) as sess:
+                ms_per_batch = time_fetches(sess, features, n_batches)
+        results['data_loader/{}/images_per_sec'.format(pipeline)] = (1000 * batch_size / ms_per_batch, True)
+    return results
+
+
+def benchmark_model_step(input_shape: List[int], batch_size: int, n_runs: int, n_threads: int,
+                         lstm_implementation: str = 'basic') -> dict:
+    random_state = np.random.RandomState(0)
+    params = make_params(input_shape, lstm_implementation=lstm_implementation)
+    params.keep_prob_dropout = 1.0
+    images = random_state.uniform(0, 255, size=[batch_size] + list(input_shape) + [1]).astype(np.float32)
+    key = '{}x{}/batch_{}'.format(input_shape[0], input_shape[1], batch_size)
+    results = dict()
+
+    with tf.Graph().as_default(), tf.Session(config=session_config(n_threads)) as sess:
+        conv = deep_cnn(tf.constant(images), is_training=True, summaries=False)
+        gradients = tf.gradients(tf.reduce_sum(conv), tf.trainable_variables())
+        sess.run(tf.global_variables_initializer())
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        results['deep_cnn/{}/forward_ms'.format(key)] = (time_fetches(sess, conv, n_runs), False)
+        results['deep_cnn/{}/forward_backward_ms'.format(key)] = (
+            time_fetches(sess, [gradients, update_ops], n_runs), False)
+        features = sess.run(conv)
+
+    with tf.Graph().as_default(), tf.Session(config=session_config(n_threads)) as sess:
+        inputs = tf.constant(features)
+        sequence_length = tf.fill([features.shape[0]], features.shape[1])
+        logits, _ = deep_bidirectional_lstm(inputs, params=params, summaries=False, sequence_length=sequence_length)
+        gradients = tf.gradients(tf.reduce_sum(logits), tf.trainable_variables())
+        sess.run(tf.global_variables_initializer())
+        results['deep_bidirectional_lstm/{}/forward_ms'.format(key)] = (time_fetches(sess, logits, n_runs), False)
+        results['deep_bidirectional_lstm/{}/forward_backward_ms'.format(key)] = (
+            time_fetches(sess, [logits, gradients], n_runs), False)
+
+    return results
+
+
+def benchmark_cnn_backbones(input_shape: List[int], batch_size: int, n_runs: int, n_threads: int) -> dict:
+    # Forward time of the lighter backbones (the default one is measured by benchmark_model_step)
+    images = np.random.RandomState(0).uniform(0, 255, size=[batch_size] + list(input_shape) + [1]).astype(np.float32)
+    key = '{}x{}/batch_{}'.format(input_shape[0], input_shape[1], batch_size)
+    results = dict()
+
+    for backbone, width_multiplier in [('vgg', 0.5), ('separable', 1.0), ('separable', 0.5)]:
+        params = make_params(input_shape, cnn_backbone=backbone, cnn_width_multiplier=width_multiplier)
+        with tf.Graph().as_default(), tf.Session(config=session_config(n_threads)) as sess:
+            conv = deep_cnn(tf.constant(images), is_training=False, summaries=False, params=params)
+            sess.run(tf.global_variables_initializer())
+            results['deep_cnn_{}_x{}/{}/forward_ms'.format(backbone, width_multiplier, key)] = (
+                time_fetches(sess, conv, n_runs), False)
+
+    return results
+
+
+def benchmark_decoders(input_shape: List[int], batch_size: int, n_runs: int, n_threads: int) -> dict:
+    params = make_params(input_shape)
+    n_time_steps = input_shape[1] // 4 - 1
+    logits = np.random.RandomState(0).randn(n_time_steps, batch_size, params.n_classes).astype(np.float32)
+    key = '{}_steps/batch_{}'.format(n_time_steps, batch_size)
+    results = dict()
+
+    with tf.Graph().as_default(), tf.Session(config=session_config(n_threads)) as sess:
+        sequence_length = tf.fill([batch_size], n_time_steps)
+        greedy, _ = tf.nn.ctc_greedy_decoder(logits, sequence_length, merge_repeated=True)
+        beam_search, _ = tf.nn.ctc_beam_search_decoder(logits, sequence_length, merge_repeated=False,
+                                                       beam_width=params.beam_width, top_paths=params.top_paths)
+        results['decoding/greedy/{}/ms'.format(key)] = (time_fetches(sess, greedy, n_runs), False)
+        results['decoding/beam_search_{}/{}/ms'.format(params.beam_width, key)] = (
+            time_fetches(sess, beam_search, n_runs), False)
+
+    return results
+
+
+def export_random_model(input_shape: List[int], output_dir: str) -> str:
+    # Model with randomly initialized weights exported with the batch serving signature
+    params = make_params(input_shape)
+    model_dir = os.path.join(output_dir, 'model')
+    with tf.Graph().as_default(), tf.Session() as sess:
+        tf.train.get_or_create_global_step()
+        features = {'images': tf.placeholder(tf.float32, [None, input_shape[0], None, 1]),
+                    'images_widths': tf.placeholder(tf.int32, [None])}
+        crnn_fn(features, None, tf.estimator.ModeKeys.PREDICT, {'Params': params})
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver().save(sess, os.path.join(model_dir, 'model.ckpt'))
+
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params={'Params': params}, model_dir=model_dir)
+    export_dir = estimator.export_savedmodel(os.path.join(output_dir, 'export'),
+                                             preprocess_batch_for_prediction(fixed_height=input_shape[0],
+                                                                             min_width=10))
+    return export_dir.decode() if isinstance(export_dir, bytes) else export_dir
+
+
+def benchmark_prediction_model(export_dir: str, input_shape: List[int], batch_sizes: List[int], n_runs: int,
+                               n_threads: int) -> dict:
+    random_state = np.random.RandomState(0)
+    results = dict()
+    with tf.Session(graph=tf.Graph(), config=session_config(n_threads)):
+        model = PredictionModel(export_dir)
+        for batch_size in batch_sizes:
+            images = [random_state.uniform(0, 255, size=[input_shape[0], random_state.randint(input_shape[1] // 4,
+                                                                                            input_shape[1] + 1)])
+                      for _ in range(batch_size)]
+            for _ in range(2):
+                model.predict_batch(images)
+            timings = list()
+            for _ in range(n_runs):
+                start = time.time()
+                model.predict_batch(images)
+                timings.append(time.time() - start)
+            results['prediction_model/batch_{}/latency_ms'.format(batch_size)] = (1000 * float(np.median(timings)),
+                                                                                  False)
+    return results
+
+
+def run_suite(input_shapes: List[List[int]], batch_sizes: List[int], n_runs: int, n_threads: int,
+              n_images: int) -> dict:
+    work_dir = tempfile.mkdtemp()
+    results = dict()
+    try:
+        for input_shape in input_shapes:
+            dataset_dir = os.path.join(work_dir, 'images_{}x{}'.format(*input_shape))
+            os.makedirs(dataset_dir)
+            csv_filename = write_synthetic_dataset(dataset_dir, n_images, input_shape[0], input_shape[1])
+            for batch_size in batch_sizes:
+                results.update(benchmark_data_loader(csv_filename, input_shape, batch_size, n_runs, n_threads))
+                results.update(benchmark_model_step(input_shape, batch_size, n_runs, n_threads))
+                results.update(benchmark_cnn_backbones(input_shape, batch_size, n_runs, n_threads))
+                results.update(benchmark_decoders(input_shape, batch_size, n_runs, n_threads))
+            export_dir = export_random_model(input_shape, os.path.join(work_dir, 'export_{}x{}'.format(*input_shape)))
+            results.update(benchmark_prediction_model(export_dir, input_shape, [1] + batch_sizes, n_runs, n_threads))
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {'metadata': {'tensorflow_version': tf.__version__,
+                         'platform': platform.platform(),
+                         'processor': platform.processor(),
+                         'cpu_count': os.cpu_count(),
+                         'n_threads': n_threads,
+                         'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results': {name: {'value': value, 'higher_is_better': higher_is_better}
+                        for name, (value, higher_is_better) in sorted(results.items())}}
+
+
+def compare_results(baseline: dict, candidate: dict, threshold: float = 0.1) -> List[str]:
+    # Relative change of each benchmark present in both files, returns the names of the regressions
+    regressions = list()
+    for name in sorted(set(baseline['results']) & set(candidate['results'])):
+        base, new = baseline['results'][name], candidate['results'][name]
+        change = (new['value'] - base['value']) / base['value']
+        worse = -change if base['higher_is_better'] else change
+        is_regression = worse > threshold
+        if is_regression:
+            regressions.append(name)
+        print('{:70s} {:12.2f} {:12.2f} {:+8.1%} {}'.format(name, base['value'], new['value'], change,
+                                                              'REGRESSION' if is_regression else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and write the results to json')
+    run_parser.add_argument('-o', '--output', type=str, required=True, help='Output json file')
+    run_parser.add_argument('-s', '--input_shapes', type=str, nargs='*', default=['32x100', '64x448'],
+                            help='Input shapes HEIGHTxWIDTH')
+    run_parser.add_argument('-b', '--batch_sizes', type=int, nargs='*', default=[8, 32], help='Batch sizes')
+    run_parser.add_argument('-n', '--n_runs', type=int, default=10, help='Number of timed runs (median is kept)')
+    run_parser.add_argument('-t', '--n_threads', type=int, default=4, help='Number of CPU threads of the sessions')
+    run_parser.add_argument('--n_images', type=int, default=256, help='Number of synthetic images')
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files and flag the regressions')
+    compare_parser.add_argument('baseline', type=str, help='Results json of the reference')
+    compare_parser.add_argument('candidate', type=str, help='Results json to compare to the reference')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative slow down flagged')
+    args = vars(parser.parse_args())
+
+    if args.get('command') == 'run':
+        benchmark_results = run_suite([[int(s) for s in shape.split('x')] for shape in args.get('input_shapes')],
+                                      args.get('batch_sizes'), args.get('n_runs'), args.get('n_threads'),
+                                      args.get('n_images'))
+        with open(args.get('output'), 'w') as f:
+            json.dump(benchmark_results, f, indent=2)
+        print('Results written to {}'.format(args.get('output')))
+
+    elif args.get('command') == 'compare':
+        with open(args.get('baseline'), 'r') as f:
+            baseline_results = json.load(f)
+        with open(args.get('candidate'), 'r') as f:
+            candidate_results = json.load(f)
+        found_regressions = compare_results(baseline_results, candidate_results, threshold=args.get('threshold'))
+        print('{} regression(s)'.format(len(found_regressions)))
+        sys.exit(1 if found_regressions else 0)
+
+    else:
+        parser.print_help()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.tflite_recognizer import TFLiteRecognizer
+
+_worker_recognizer, _worker_images = None, None
+
+
+def _init_worker(model_filename: str, images: list) -> None:
+    global _worker_recognizer, _worker_images
+    _worker_recognizer, _worker_images = TFLiteRecognizer(model_filename), images
+
+
+def _predict_worker(index: int) -> str:
+    return _worker_recognizer.predict(_worker_images[index])[0]
+
+
+def measure_latency(model_filename: str, images: list, n_warmup: int = 5) -> dict:
+    # Single process, one image at a time : preparation of the image, model and greedy decoding
+    recognizer = TFLiteRecognizer(model_filename)
+    for image in images[:n_warmup]:
+        recognizer.predict(image)
+
+    latencies = list()
+    for image in images:
+        start = time.time()
+        recognizer.predict(image)
+        latencies.append(time.time() - start)
+
+    return {'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+            'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+            'mean_ms': 1000 * float(np.mean(latencies))}
+
+
+def measure_throughput(model_filename: str, images: list, n_processes: int, n_images: int) -> dict:
+    # Worker processes with one interpreter each, the images are sent to the workers once
+    with Pool(processes=n_processes, initializer=_init_worker, initargs=(model_filename, images)) as pool:
+        pool.map(_predict_worker, range(n_processes))  # warm up
+        start = time.time()
+        pool.map(_predict_worker, [i % len(images) for i in range(n_images)], chunksize=8)
+        duration = time.time() - start
+    return {'n_processes': n_processes, 'images_per_sec': n_images / duration}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU latency and throughput of a tflite model (convert_tflite.py)')
+    parser.add_argument('-t', '--tflite_model', type=str, required=True, help='Filename of the tflite model')
+    parser.add_argument('-f', '--csv_file', type=str, required=True, help='CSV file of the images')
+    parser.add_argument('--csv_delimiter', type=str, help='Delimiter of the csv file', default=';')
+    parser.add_argument('-n', '--n_images', type=int, help='Number of images of the throughput runs', default=1000)
+    parser.add_argument('-p', '--n_processes', type=int, nargs='*', help='Numbers of worker processes',
+                        default=[1, 2, 4, os.cpu_count()])
+    parser.add_argument('-o', '--output', type=str, help='Json file of the results', default=None)
+    args = vars(parser.parse_args())
+
+    # Only the image decoding uses tensorflow, the workers use the tflite interpreter
+    from src.loader import ImageDecoder
+    from src.evaluation import read_csv_samples
+    paths, _ = read_csv_samples(args.get('csv_file'), args.get('csv_delimiter'), max_samples=args.get('n_images'))
+    image_decoder = ImageDecoder()
+    decoded_images = [image_decoder.decode_file(path) for path in paths]
+    image_decoder.close()
+
+    results = {'latency': measure_latency(args.get('tflite_model'), decoded_images),
+               'throughput': [measure_throughput(args.get('tflite_model'), decoded_images, n, args.get('n_images'))
+                              for n in sorted(set(args.get('n_processes')))]}
+
+    print('Latency : p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(**results['latency']))
+    for result in results['throughput']:
+        print('{n_processes:>3} processes : {images_per_sec:.1f} images/sec'.format(**result))
+
+    if args.get('output'):
+        with open(args.get('output'), 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from typing import List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.decoding import get_words_from_chars
+from src.config import Alphabet
+
+
+def get_words_from_chars_map_fn(characters_list: List[str], sequence_lengths: List[int], name='chars_conversion'):
+    # Previous implementation (one reduce_join per sequence with tf.map_fn), kept for comparison
+    with tf.name_scope(name=name):
+        def join_characters_fn(coords):
+            return tf.reduce_join(characters_list[coords[0]:coords[1]])
+
+        def coords_several_sequences():
+            end_coords = tf.cumsum(sequence_lengths)
+            start_coords = tf.concat([[0], end_coords[:-1]], axis=0)
+            coords = tf.stack([start_coords, end_coords], axis=1)
+            coords = tf.cast(coords, dtype=tf.int32)
+            return tf.map_fn(join_characters_fn, coords, dtype=tf.string)
+
+        def coords_single_sequence():
+            return tf.reduce_join(characters_list, keep_dims=True)
+
+        words = tf.cond(tf.shape(sequence_lengths)[0] > 1,
+                        true_fn=lambda: coords_several_sequences(),
+                        false_fn=lambda: coords_single_sequence())
+
+        return words
+
+
+def random_sequences(batch_size: int, max_length: int, random_state: np.random.RandomState):
+    # Some sequences are empty (nothing predicted)
+    sequence_lengths = random_state.randint(0, max_length + 1, size=batch_size).astype(np.int32)
+    characters = random_state.choice(list(Alphabet.LETTERS_DIGITS[:-1]), size=sequence_lengths.sum())
+    return characters.astype(object), sequence_lengths
+
+
+def time_implementation(fn, batch_size: int, max_length: int, n_runs: int, seed: int = 0) -> dict:
+    random_state = np.random.RandomState(seed)
+    with tf.Graph().as_default():
+        characters_ph = tf.placeholder(tf.string, shape=[None])
+        lengths_ph = tf.placeholder(tf.int32, shape=[None])
+        words = fn(characters_ph, lengths_ph)
+
+        inputs = [random_sequences(batch_size, max_length, random_state) for _ in range(n_runs)]
+        with tf.Session() as sess:
+            # Warm up
+            sess.run(words, feed_dict={characters_ph: inputs[0][0], lengths_ph: inputs[0][1]})
+
+            times = list()
+            for characters, lengths in inputs:
+                start = time.time()
+                sess.run(words, feed_dict={characters_ph: characters, lengths_ph: lengths})
+                times.append(time.time() - start)
+
+    return {'mean_ms': 1000 * np.mean(times), 'p50_ms': 1000 * np.percentile(times, 50),
+            'p99_ms': 1000 * np.percentile(times, 99)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch_sizes', type=int, help='Batch sizes to time', nargs='*',
+                        default=[1, 128, 1024])
+    parser.add_argument('-l', '--max_length', type=int, help='Maximum number of characters per sequence', default=30)
+    parser.add_argument('-n', '--n_runs', type=int, help='Number of timed runs', default=100)
+    args = vars(parser.parse_args())
+
+    implementations = {'map_fn': get_words_from_chars_map_fn, 'vectorized': get_words_from_chars}
+    for batch_size in args.get('batch_sizes'):
+        for name, fn in implementations.items():
+            timing = time_implementation(fn, batch_size, args.get('max_length'), args.get('n_runs'))
+            print('batch {:5d} | {:10s} | mean {:8.3f} ms | p50 {:8.3f} ms | p99 {:8.3f} ms'.format(
+                batch_size, name, timing['mean_ms'], timing['p50_ms'], timing['p99_ms']))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import argparse
+from src.data_handler import build_tfrecord_cache, build_memmap_store
+from src.tfrecord_cache import load_cache_info
+from src.memmap_store import load_store_info
+from src.manifest_index import build_manifest_index
+from src.distillation import build_teacher_cache
+from src.config import Params, import_params_from_json
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--csv_files', type=str, required=True, help='CSV filenames to compile', nargs='*')
+    parser.add_argument('-p', '--params-file', type=str, required=True,
+                        help='Parameters filename (input_shape, csv_delimiter and cache parameters are used)')
+    parser.add_argument('-t', '--format', type=str,
+                        help="'tfrecord' shards, 'memmap' store, manifest 'index' (image sizes, label lengths) "
+                             "or logits of a 'teacher' model (distillation)",
+                        choices=['tfrecord', 'memmap', 'index', 'teacher'], default='tfrecord')
+    parser.add_argument('-c', '--cache_dir', type=str, default=None,
+                        help='Cache directory (overrides tfrecord_cache_dir, memmap_store_dir, manifest_index_dir '
+                             'or distillation_cache_dir)')
+    parser.add_argument('--teacher', type=str, default=None,
+                        help="Exported teacher model (format 'teacher', default : distillation_teacher of the params)")
+    parser.add_argument('--force', action='store_true', help='Rebuild the cache even if it is up to date')
+    args = vars(parser.parse_args())
+
+    dict_params = import_params_from_json(json_filename=args.get('params_file'))
+    if args.get('cache_dir'):
+        cache_dir_key = {'tfrecord': 'tfrecord_cache_dir', 'memmap': 'memmap_store_dir',
+                         'index': 'manifest_index_dir', 'teacher': 'distillation_cache_dir'}[args.get('format')]
+        dict_params[cache_dir_key] = args.get('cache_dir')
+    parameters = Params(**dict_params)
+
+    if args.get('format') == 'tfrecord':
+        cache_dir = build_tfrecord_cache(args.get('csv_files'), parameters, force=args.get('force'))
+        cache_info = load_cache_info(cache_dir)
+        print('Cache {} : {} samples in {} shards'.format(cache_dir, cache_info['n_samples'],
+                                                          len(cache_info['shards'])))
+    elif args.get('format') == 'teacher':
+        teacher = args.get('teacher') or parameters.distillation_teacher
+        assert teacher, 'No teacher model given (--teacher)'
+        cache_dir = build_teacher_cache(teacher, args.get('csv_files'), parameters, force=args.get('force'))
+        print('Logits of the teacher {} cached in {}'.format(teacher, cache_dir))
+    elif args.get('format') == 'index':
+        index = build_manifest_index(args.get('csv_files'), parameters, force=args.get('force'))
+        print('Index {} : {}'.format(index.index_dir, index.summary()))
+    else:
+        store_dir = build_memmap_store(args.get('csv_files'), parameters, force=args.get('force'))
+        store_info = load_store_info(store_dir)
+        print('Store {} : {} samples of shape {}'.format(store_dir, store_info['n_samples'],
+                                                         store_info['input_shape']))
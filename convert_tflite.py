@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from typing import List, Tuple
+from src.loader import PredictionModel, ImageDecoder
+from src.evaluation import evaluate_predictions, read_csv_samples
+from src.tflite_export import convert_checkpoint_to_tflite, export_reference_saved_model
+from src.tflite_recognizer import TFLiteRecognizer, resized_width
+from src.config import Params, import_params_from_json
+
+
+# Fractions of the fixed width of the tflite model covered by the images, bounds of the parity report bins.
+# The images wider than the model (fraction > 1) are squeezed to its width and have their own bin
+WIDTH_FRACTION_BINS = [0.25, 0.5, 0.75, 1.0]
+
+
+def recognize_images(predict_word, images: list) -> Tuple[List[str], List[float]]:
+    # Predicted word and time of each image, recognized one by one
+    predicted_words, times = list(), list()
+    for image in images:
+        start = time.time()
+        predicted_words.append(predict_word(image))
+        times.append(time.time() - start)
+    return predicted_words, times
+
+
+def recognition_metrics(predicted_words: List[str], times: List[float], labels: List[str], params: Params) -> dict:
+    metrics = evaluate_predictions(predicted_words, labels, params)
+    metrics.update({'n_samples': len(labels),
+                    'ms_per_image': 1000 * float(np.mean(times)),
+                    'images_per_sec': len(labels) / float(np.sum(times))})
+    return metrics
+
+
+def parity_by_width(saved_model_words: List[str], tflite_words: List[str], labels: List[str],
+                    width_fractions: List[float], params: Params) -> dict:
+    # CER of both models for the images grouped by the fraction of the tflite width they cover. The unrolled lstm
+    # of the tflite model is not masked, its backward direction starts on the zero padding that the SavedModel
+    # excludes (sequence lengths) : a gap is expected on the narrow images, none on the images filling the width.
+    # The images wider than the model are squeezed by the tflite preprocessing only, a gap is expected on them too
+    report = dict()
+    bins = np.digitize(width_fractions, WIDTH_FRACTION_BINS, right=True)
+    bin_names = ['{:.0%}-{:.0%}'.format(lower, upper) for lower, upper in zip([0.0] + WIDTH_FRACTION_BINS[:-1],
+                                                                              WIDTH_FRACTION_BINS)] + \
+        ['>{:.0%} (squeezed)'.format(WIDTH_FRACTION_BINS[-1])]
+    for i, bin_name in enumerate(bin_names):
+        indices = np.flatnonzero(bins == i)
+        if len(indices) == 0:
+            continue
+        bin_labels = [labels[j] for j in indices]
+        saved_model_cer = evaluate_predictions([saved_model_words[j] for j in indices], bin_labels, params)['CER']
+        tflite_cer = evaluate_predictions([tflite_words[j] for j in indices], bin_labels, params)['CER']
+        report[bin_name] = {'n_samples': len(indices),
+                            'saved_model_CER': saved_model_cer,
+                            'tflite_CER': tflite_cer,
+                            'CER_difference': tflite_cer - saved_model_cer}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_dir', type=str, required=True, help='Directory of the trained model')
+    parser.add_argument('-o', '--output_filename', type=str, required=True, help='Filename of the tflite model')
+    parser.add_argument('-w', '--width', type=int, default=None,
+                        help='Fixed width of the input images (default : width of the input_shape of the params)')
+    parser.add_argument('--min_width', type=int, help='Minimum width of the resized images', default=10)
+    parser.add_argument('-q', '--quantize', action='store_true', help='Store the weights in int8')
+    parser.add_argument('-c', '--csv_files', type=str, nargs='*', default=None,
+                        help='CSV filenames for the CER parity check against the SavedModel of the checkpoint')
+    parser.add_argument('-n', '--max_samples', type=int, help='Maximum number of samples checked', default=None)
+    args = vars(parser.parse_args())
+
+    parameters = Params(**import_params_from_json(args.get('model_dir')))
+
+    convert_checkpoint_to_tflite(args.get('model_dir'), parameters, args.get('output_filename'),
+                                 width=args.get('width'), min_width=args.get('min_width'),
+                                 quantize=args.get('quantize'))
+    print('Converted model to {} ({} bytes)'.format(args.get('output_filename'),
+                                                    os.path.getsize(args.get('output_filename'))))
+
+    if args.get('csv_files'):
+        paths, labels = read_csv_samples(args.get('csv_files'), parameters.csv_delimiter,
+                                         max_samples=args.get('max_samples'))
+        image_decoder = ImageDecoder()
+        images = [image_decoder.decode_file(path) for path in paths]
+        image_decoder.close()
+
+        export_dir_base = tempfile.mkdtemp()
+        export_dir = export_reference_saved_model(args.get('model_dir'), parameters, export_dir_base,
+                                                  min_width=args.get('min_width'))
+        with tf.Session(graph=tf.Graph()):
+            model = PredictionModel(export_dir)
+            saved_model_words, saved_model_times = recognize_images(
+                lambda image: model.predict(image)['words'][0].decode('utf8'), images)
+        shutil.rmtree(export_dir_base)
+
+        recognizer = TFLiteRecognizer(args.get('output_filename'))
+        tflite_words, tflite_times = recognize_images(lambda image: recognizer.predict(image)[0], images)
+        # Width of the resized images before they are squeezed to the width of the model
+        width_fractions = [resized_width(image.shape[:2], recognizer.height, None, recognizer.min_width)
+                           / recognizer.width for image in images]
+
+        saved_model_metrics = recognition_metrics(saved_model_words, saved_model_times, labels, parameters)
+        tflite_metrics = recognition_metrics(tflite_words, tflite_times, labels, parameters)
+        report = {'saved_model': saved_model_metrics, 'tflite': tflite_metrics,
+                  'CER_difference': tflite_metrics['CER'] - saved_model_metrics['CER'],
+                  'by_width_fraction': parity_by_width(saved_model_words, tflite_words, labels, width_fractions,
+                                                       parameters)}
+        for name in ['saved_model', 'tflite']:
+            print('{:<12} CER {CER:.4f}  accuracy {accuracy:.4f}  {ms_per_image:.2f} ms/image'.format(
+                name, **report[name]))
+        # The padding seen by the unrolled lstm explains the difference on the images narrower than the model
+        for width_bin, parity in report['by_width_fraction'].items():
+            print('width {:<16} {n_samples:>6} images  CER saved_model {saved_model_CER:.4f}  tflite {tflite_CER:.4f}'
+                  .format(width_bin, **parity))
+        with open(os.path.splitext(args.get('output_filename'))[0] + '_parity.json', 'w') as f:
+            json.dump(report, f, indent=2)
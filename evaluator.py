@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import argparse
+import tensorflow as tf
+from src.model import crnn_fn
+from src.data_handler import data_loader
+from src.config import Params, import_params_from_json
+
+TRAINING_DONE_FILENAME = 'training_done'
+
+
+def evaluate_checkpoints(parameters: Params, csv_files_eval: list, n_threads: int, timeout: int = 600,
+                         min_interval_secs: int = 60, stop_when_training_done: bool = True) -> None:
+    # Evaluates each new checkpoint of the model directory, the results are written in the same
+    # summaries ('eval' directory) as the evaluations of train.py
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=n_threads,
+                                    inter_op_parallelism_threads=n_threads)
+    est_config = tf.estimator.RunConfig(session_config=session_config, model_dir=parameters.output_model_dir)
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn,
+                                       params={'Params': parameters},
+                                       model_dir=parameters.output_model_dir,
+                                       config=est_config)
+
+    done_filename = os.path.join(parameters.output_model_dir, TRAINING_DONE_FILENAME)
+
+    def training_done():
+        # Called when no new checkpoint appeared during timeout seconds
+        return not stop_when_training_done or os.path.isfile(done_filename)
+
+    for checkpoint_path in tf.contrib.training.checkpoints_iterator(parameters.output_model_dir,
+                                                                    min_interval_secs=min_interval_secs,
+                                                                    timeout=timeout,
+                                                                    timeout_fn=training_done):
+        try:
+            metrics = estimator.evaluate(input_fn=data_loader(csv_filename=csv_files_eval,
+                                                              params=parameters,
+                                                              batch_size=parameters.eval_batch_size,
+                                                              num_epochs=1),
+                                         steps=None,  # until the end of the single epoch of the eval data
+                                         checkpoint_path=checkpoint_path)
+            print('Evaluated {} : {}'.format(checkpoint_path, metrics))
+        except tf.errors.NotFoundError:
+            # The checkpoint was removed by the trainer (keep_checkpoint_max) before being evaluated
+            print('Checkpoint {} not found, skipped'.format(checkpoint_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_dir', type=str, required=True,
+                        help='Output directory of the training (checkpoints and parameters json)')
+    parser.add_argument('-fe', '--csv_files_eval', type=str, help='CSV filenames for evaluation '
+                                                                  '(default : csv_files_eval of the parameters)',
+                        nargs='*', default=None)
+    parser.add_argument('-t', '--n_threads', type=int, help='Number of CPU threads of the evaluation', default=2)
+    parser.add_argument('--timeout', type=int, default=600,
+                        help='Seconds without new checkpoint before checking if the training is done')
+    parser.add_argument('--min_interval', type=int, help='Minimum seconds between two evaluations', default=60)
+    parser.add_argument('--no_stop', action='store_true', help='Keep waiting for checkpoints after the training')
+    parser.add_argument('-g', '--gpu', type=str, help="GPU 0,1 or '' ", default='')
+    args = vars(parser.parse_args())
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.get('gpu')
+
+    parameters = Params(**import_params_from_json(args.get('model_dir')))
+    parameters.output_model_dir = args.get('model_dir')
+
+    evaluate_checkpoints(parameters, args.get('csv_files_eval') or parameters.csv_files_eval,
+                         n_threads=args.get('n_threads'), timeout=args.get('timeout'),
+                         min_interval_secs=args.get('min_interval'),
+                         stop_when_training_done=not args.get('no_stop'))
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 __author__ = 'solivr'
 
-from src.data_handler import preprocess_image_for_prediction
+from src.data_handler import preprocess_image_for_prediction, preprocess_batch_for_prediction, \
+    preprocess_encoded_images_for_prediction
 from src.model import crnn_fn
 import tensorflow as tf
 import os
@@ -12,7 +13,17 @@ from src.config import Params, import_params_from_json
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-m', '--model_dir', type=str, help='Directory of model to be exported', default='./model')
-    parser.add_argument('-e', '--output_dir', type=str, help='Output directory (for exported model)', default='./exported_model')
+    parser.add_argument('-e', '--output_dir', type=str, help='Output directory (for exported model)',
+                        default='./exported_model')
+    parser.add_argument('-r', '--receiver', type=str,
+                        help="Serving input : one 'image', a 'batch' of images or a batch of 'encoded' images",
+                        choices=['image', 'batch', 'encoded'], default='image')
+    parser.add_argument('--ctc_decoder', type=str, help='Overrides the ctc decoder of the model params',
+                        choices=['beam_search', 'greedy'], default=None)
+    parser.add_argument('--beam_width', type=int, help='Overrides the beam width of the model params', default=None)
+    parser.add_argument('--top_paths', type=int, help='Overrides the number of decoded paths', default=None)
+    parser.add_argument('--score_type', type=str, help='Overrides the score of the model params',
+                        choices=['beam_margin', 'mean_max_prob', 'min_max_prob'], default=None)
     parser.add_argument('-g', '--gpu', type=str, help='GPU 1, 0 or '' for CPU', default='')
     args = vars(parser.parse_args())
 
@@ -22,6 +33,10 @@ if __name__ == '__main__':
 
     # Import parameters from the json file
     params_json = import_params_from_json(args.get('model_dir'))
+    # The decoding strategy is part of the exported graph
+    for key in ['ctc_decoder', 'beam_width', 'top_paths', 'score_type']:
+        if args.get(key) is not None:
+            params_json[key] = args.get(key)
     params = Params(**params_json)
 
     # Config
@@ -32,10 +47,18 @@ if __name__ == '__main__':
                        save_checkpoints_secs=None,
                        save_summary_steps=1000)
 
-    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params=params,
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params={'Params': params},
                                        model_dir=args.get('model_dir'),
                                        config=est_config,
                                        )
 
-    estimator.export_savedmodel(args.get('export_dir'),
-                                serving_input_receiver_fn=preprocess_image_for_prediction(min_width=10))
+    if args.get('receiver') == 'batch':
+        serving_input_fn = preprocess_batch_for_prediction(fixed_height=params.input_shape[0], min_width=10,
+                                                           num_parallel_calls=params.num_parallel_calls)
+    elif args.get('receiver') == 'encoded':
+        serving_input_fn = preprocess_encoded_images_for_prediction(fixed_height=params.input_shape[0], min_width=10,
+                                                                    num_parallel_calls=params.num_parallel_calls)
+    else:
+        serving_input_fn = preprocess_image_for_prediction(fixed_height=params.input_shape[0], min_width=10)
+
+    estimator.export_savedmodel(args.get('output_dir'), serving_input_receiver_fn=serving_input_fn)
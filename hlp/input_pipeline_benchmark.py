@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import time
+import argparse
+import tensorflow as tf
+from tqdm import trange
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.data_handler import data_loader
+from src.config import Params, Alphabet, import_params_from_json
+
+
+def measure_images_per_second(params: Params, csv_files: list, batch_size: int, n_batches: int,
+                              n_warmup_batches: int = 5, data_augmentation: bool = False) -> float:
+    with tf.Graph().as_default():
+        input_fn = data_loader(csv_filename=csv_files, params=params, batch_size=batch_size,
+                               data_augmentation=data_augmentation)
+        features, _ = input_fn()
+
+        # MonitoredSession takes care of the tables and of the queue runners of the legacy pipeline
+        with tf.train.MonitoredSession() as sess:
+            for _ in range(n_warmup_batches):
+                sess.run(features)
+
+            start = time.time()
+            for _ in trange(n_batches):
+                sess.run(features)
+            elapsed = time.time() - start
+
+    return n_batches * batch_size / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--csv_files', type=str, required=True, help='CSV filenames to read', nargs='*')
+    parser.add_argument('-p', '--params-file', type=str, help='Parameters filename', default=None)
+    parser.add_argument('-b', '--batch_size', type=int, help='Batch size', default=128)
+    parser.add_argument('-n', '--n_batches', type=int, help='Number of batches to time', default=50)
+    parser.add_argument('-d', '--csv_delimiter', type=str, help='CSV delimiter character', default=' ')
+    parser.add_argument('-a', '--data_augmentation', action='store_true', help='Time with data augmentation')
+    args = vars(parser.parse_args())
+
+    if args.get('params_file'):
+        dict_params = import_params_from_json(json_filename=args.get('params_file'))
+    else:
+        dict_params = {'input_shape': (128, 1792),
+                       'alphabet': Alphabet.LETTERS_DIGITS_EXTENDED,
+                       'csv_delimiter': args.get('csv_delimiter')}
+
+    for pipeline in ['queue', 'dataset']:
+        dict_params['input_pipeline'] = pipeline
+        images_per_sec = measure_images_per_second(Params(**dict_params), args.get('csv_files'),
+                                                   batch_size=args.get('batch_size'),
+                                                   n_batches=args.get('n_batches'),
+                                                   data_augmentation=args.get('data_augmentation'))
+        print('{} pipeline : {:.1f} images/sec'.format(pipeline, images_per_sec))
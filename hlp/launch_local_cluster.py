@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import argparse
+import subprocess
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'train.py')
+
+
+def launch_local_cluster(n_workers: int, n_ps: int, train_args: list, first_port: int = 2222,
+                         evaluator: bool = True) -> None:
+    # Starts the processes of a distributed training on localhost (CPU only) and waits for the workers
+    worker_hosts = ['localhost:{}'.format(first_port + i) for i in range(n_workers)]
+    ps_hosts = ['localhost:{}'.format(first_port + n_workers + i) for i in range(n_ps)]
+    cluster_args = ['--worker_hosts'] + worker_hosts + (['--ps_hosts'] + ps_hosts if ps_hosts else [])
+
+    tasks = [('ps', i) for i in range(n_ps)] + [('worker', i) for i in range(n_workers)]
+    if evaluator:
+        tasks.append(('evaluator', 0))
+
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    processes = dict()
+    for task_type, task_index in tasks:
+        command = [sys.executable, TRAIN_SCRIPT] + train_args + cluster_args + \
+                  ['--task_type', task_type, '--task_index', str(task_index)]
+        processes[(task_type, task_index)] = subprocess.Popen(command, env=env)
+        print('Started {} {} (pid {})'.format(task_type, task_index, processes[(task_type, task_index)].pid))
+
+    try:
+        for (task_type, task_index), process in processes.items():
+            if task_type == 'worker':
+                process.wait()
+    finally:
+        # Parameter servers and evaluator never stop by themselves
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distributed training on localhost. '
+                                                 'Remaining arguments are passed to train.py')
+    parser.add_argument('-w', '--n_workers', type=int, help='Number of workers', default=2)
+    parser.add_argument('-s', '--n_ps', type=int, help='Number of parameter servers', default=1)
+    parser.add_argument('--port', type=int, help='First port used', default=2222)
+    parser.add_argument('--no_evaluator', action='store_true', help='Do not start an evaluator process')
+    args, train_args = parser.parse_known_args()
+
+    launch_local_cluster(args.n_workers, args.n_ps, train_args, first_port=args.port,
+                         evaluator=not args.no_evaluator)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from src.loader import PredictionModel, ImageDecoder
+from src.evaluation import read_csv_samples
+from src.graph_optimization import load_frozen_saved_model, transform_frozen_graph, save_graph_def_as_saved_model, \
+    fold_batch_norms, constant_fold_lookup_tables, prune_graph, directory_size
+
+
+def predict_csv(export_dir: str, paths: list, batch_size: int) -> dict:
+    # Outputs of the model for each batch of images and time of each batch
+    outputs, batch_times = list(), list()
+    image_decoder = ImageDecoder()
+    with tf.Session(graph=tf.Graph()):
+        model = PredictionModel(export_dir)
+        model.predict_files(paths[:batch_size], image_decoder=image_decoder)  # warm up
+        for i in range(0, len(paths), batch_size):
+            start = time.time()
+            outputs.append(model.predict_files(paths[i:i + batch_size], image_decoder=image_decoder))
+            batch_times.append(time.time() - start)
+    image_decoder.close()
+    return {'outputs': outputs, 'batch_times': batch_times}
+
+
+def compare_outputs(reference: list, optimized: list) -> dict:
+    # Largest difference of the logits (or of the scores) and fraction of identical words
+    key = 'prob' if 'prob' in reference[0] else 'score'
+    max_difference = max(float(np.abs(ref[key] - opt[key]).max()) for ref, opt in zip(reference, optimized))
+    same_words = np.concatenate([ref['words'] == opt['words'] for ref, opt in zip(reference, optimized)])
+    return {'compared_output': key, 'max_abs_difference': max_difference, 'identical_words': float(same_words.mean())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--export_dir', type=str, required=True, help='Exported model directory')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Output directory of the optimized model')
+    parser.add_argument('-c', '--csv_files', type=str, required=True, nargs='*',
+                        help='CSV filenames of the images used for the equivalence check and the latency comparison')
+    parser.add_argument('--csv_delimiter', type=str, help='Delimiter of the csv files', default=';')
+    parser.add_argument('-n', '--max_samples', type=int, help='Maximum number of samples used', default=500)
+    parser.add_argument('-b', '--batch_size', type=int, help='Batch size', default=32)
+    parser.add_argument('--tolerance', type=float, help='Maximum difference of the logits accepted', default=1e-3)
+    args = vars(parser.parse_args())
+
+    graph_def, signature_def, init_op_names = load_frozen_saved_model(args.get('export_dir'))
+    n_nodes = len(graph_def.node)
+
+    # Constants are folded first so that the values of the tables and batch norms are constants
+    graph_def = transform_frozen_graph(graph_def, signature_def, init_op_names, ['fold_constants(ignore_errors=true)'])
+    graph_def, folded_batch_norms = fold_batch_norms(graph_def)
+    graph_def, folded_tables = constant_fold_lookup_tables(graph_def)
+    graph_def, init_op_names = prune_graph(graph_def, signature_def, init_op_names)
+    graph_def = transform_frozen_graph(graph_def, signature_def, init_op_names, ['fold_constants(ignore_errors=true)'])
+
+    save_graph_def_as_saved_model(graph_def, signature_def, init_op_names, args.get('output_dir'))
+    print('Exported optimized model to {}'.format(args.get('output_dir')))
+
+    report = {'n_nodes': {'original': n_nodes, 'optimized': len(graph_def.node)},
+              'folded_batch_norms': folded_batch_norms,
+              'folded_lookup_tables': folded_tables,
+              'initialization_ops': init_op_names,
+              'model_size_bytes': {'original': directory_size(args.get('export_dir')),
+                                   'optimized': directory_size(args.get('output_dir'))}}
+
+    # Equivalence and latency
+    image_paths, _ = read_csv_samples(args.get('csv_files'), args.get('csv_delimiter'),
+                                      max_samples=args.get('max_samples'))
+    results = {name: predict_csv(export_dir, image_paths, args.get('batch_size'))
+               for name, export_dir in [('original', args.get('export_dir')), ('optimized', args.get('output_dir'))]}
+    report['equivalence'] = compare_outputs(results['original']['outputs'], results['optimized']['outputs'])
+    report['equivalence']['passed'] = report['equivalence']['max_abs_difference'] <= args.get('tolerance')
+    report['ms_per_image'] = {name: 1000 * float(np.sum(result['batch_times'])) / len(image_paths)
+                              for name, result in results.items()}
+    report['ms_per_batch_p50'] = {name: 1000 * float(np.median(result['batch_times']))
+                                  for name, result in results.items()}
+
+    print('Nodes {n_nodes[original]} -> {n_nodes[optimized]}, batch norms folded : {n_bn}, '
+          'tables folded : {n_tables}'.format(n_bn=len(folded_batch_norms), n_tables=len(folded_tables), **report))
+    print('Latency : {original:.2f} ms/image -> {optimized:.2f} ms/image'.format(**report['ms_per_image']))
+    print('Max difference of the {compared_output} : {max_abs_difference:.2e}, identical words : '
+          '{identical_words:.2%} ({status})'.format(status='OK' if report['equivalence']['passed'] else 'FAILED',
+                                                   **report['equivalence']))
+
+    with open(os.path.join(args.get('output_dir'), 'optimization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
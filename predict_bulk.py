@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import csv
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from typing import Iterator, Iterable, Callable, List, Tuple
+from src.loader import PredictionModel, ImageDecoder
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def iter_directory_images(directory: str) -> Iterator[str]:
+    # Deterministic order (sorted at each level) so that a job can be resumed
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, filename)
+
+
+def iter_csv_images(csv_filename: str, delimiter: str) -> Iterator[str]:
+    with open(csv_filename, 'r', encoding='utf8') as f:
+        for row in csv.reader(f, delimiter=delimiter):
+            if row:
+                yield row[0]
+
+
+def skip(iterable: Iterable, n: int) -> Iterator:
+    iterator = iter(iterable)
+    for _ in range(n):
+        next(iterator, None)
+    return iterator
+
+
+def parallel_map(function: Callable, iterable: Iterable, executor: ThreadPoolExecutor,
+                 max_pending: int) -> Iterator[Tuple]:
+    # Ordered map with at most max_pending items being processed (executor.map would consume the whole iterable)
+    pending = deque()
+    for item in iterable:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= max_pending:
+            item, future = pending.popleft()
+            yield item, future
+    while pending:
+        yield pending.popleft()
+
+
+def batches(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    batch = list()
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+class BulkPredictor:
+    # Decodes the files in a thread pool and runs batches through the model, whatever its serving signature
+    def __init__(self, model: PredictionModel, n_threads: int = 8):
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=n_threads)
+        self.image_decoder = ImageDecoder()
+        self.encoded_inputs = 'encoded_images' in model.input_names
+
+    def load(self, filename: str):
+        with open(filename, 'rb') as f:
+            encoded_image = f.read()
+        return encoded_image if self.encoded_inputs else self.image_decoder.decode(encoded_image)
+
+    def predict(self, inputs: list) -> Tuple[List[str], np.ndarray]:
+        if self.encoded_inputs:
+            predictions = self.model.predict_encoded_batch(inputs)
+        elif 'images_sizes' in self.model.input_names:
+            predictions = self.model.predict_batch(inputs)
+        else:
+            outputs = [self.model.predict(image) for image in inputs]
+            predictions = {'words': np.concatenate([output['words'] for output in outputs]),
+                           'score': np.concatenate([output['score'] for output in outputs])}
+        words = [word.decode('utf8') for word in predictions['words']]
+        scores = np.reshape(predictions['score'], [len(inputs), -1])[:, 0]
+        return words, scores
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.image_decoder.close()
+
+
+def predict_skipping_failures(predictor: BulkPredictor, filenames: List[str],
+                              inputs: list) -> Tuple[List[str], List[str], np.ndarray]:
+    # A bad file fails its whole batch (e.g corrupt image decoded in the graph) : the files of a failed batch are
+    # predicted one by one and the ones that still fail are skipped, so that a resumed job does not fail on them again
+    try:
+        words, scores = predictor.predict(inputs)
+        return filenames, words, scores
+    except Exception as e:
+        tf.logging.warn('Batch of {} files failed ({}), predicting them one by one'.format(len(inputs), e))
+
+    kept_filenames, words, scores = list(), list(), list()
+    for filename, single_input in zip(filenames, inputs):
+        try:
+            word, score = predictor.predict([single_input])
+        except Exception as e:
+            tf.logging.warn('Could not predict {} : {}'.format(filename, e))
+            continue
+        kept_filenames.append(filename)
+        words.extend(word)
+        scores.extend(score)
+    return kept_filenames, words, np.array(scores)
+
+
+def load_checkpoint(checkpoint_filename: str) -> dict:
+    if os.path.isfile(checkpoint_filename):
+        with open(checkpoint_filename, 'r') as f:
+            return json.load(f)
+    return {'n_processed': 0, 'output_offset': 0}
+
+
+def save_checkpoint(checkpoint_filename: str, n_processed: int, output_offset: int) -> None:
+    # Written to a temporary file and renamed so that a crash never leaves a corrupted checkpoint
+    with open(checkpoint_filename + '.tmp', 'w') as f:
+        json.dump({'n_processed': n_processed, 'output_offset': output_offset}, f)
+    os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+
+
+def run_bulk_prediction(predictor: BulkPredictor, filenames: Iterable[str], output_filename: str,
+                        batch_size: int = 64, checkpoint_every: int = 50, max_pending: int = None,
+                        delimiter: str = ';') -> int:
+    # The checkpoint holds the number of input files processed and the size of the output file at that point,
+    # results written after the last checkpoint are discarded when the job is resumed
+    checkpoint_filename = output_filename + '.checkpoint'
+    checkpoint = load_checkpoint(checkpoint_filename)
+    n_processed = checkpoint['n_processed']
+    if n_processed:
+        print('Resuming after {} files'.format(n_processed))
+
+    max_pending = max_pending or 4 * batch_size
+    loaded_files = parallel_map(predictor.load, skip(filenames, n_processed), predictor.executor, max_pending)
+
+    with open(output_filename, 'a+b') as output_file:
+        output_file.truncate(checkpoint['output_offset'])
+        output_file.seek(checkpoint['output_offset'])
+
+        progress = tqdm(initial=n_processed, unit='images')
+        for i_batch, batch in enumerate(batches(loaded_files, batch_size)):
+            filenames_batch, inputs = list(), list()
+            for filename, future in batch:
+                try:
+                    inputs.append(future.result())
+                    filenames_batch.append(filename)
+                except Exception as e:
+                    tf.logging.warn('Could not read {} : {}'.format(filename, e))
+
+            if inputs:
+                filenames_batch, words, scores = predict_skipping_failures(predictor, filenames_batch, inputs)
+                output_file.write(''.join('{}{}{}{}{:.6f}\n'.format(filename, delimiter, word, delimiter, score)
+                                          for filename, word, score in zip(filenames_batch, words, scores)
+                                          ).encode('utf8'))
+            n_processed += len(batch)
+            progress.update(len(batch))
+
+            if (i_batch + 1) % checkpoint_every == 0:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                save_checkpoint(checkpoint_filename, n_processed, output_file.tell())
+
+        output_file.flush()
+        os.fsync(output_file.fileno())
+        save_checkpoint(checkpoint_filename, n_processed, output_file.tell())
+        progress.close()
+
+    return n_processed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--export_dir', type=str, required=True, help='Exported model directory')
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('-d', '--input_dir', type=str, help='Directory of images (searched recursively)')
+    input_group.add_argument('-f', '--input_csv', type=str, help='CSV file with the image filenames in first column')
+    parser.add_argument('--csv_delimiter', type=str, help='Delimiter of the input csv file', default=';')
+    parser.add_argument('-o', '--output_file', type=str, required=True,
+                        help="Output file 'filename;word;score' (resumed if a checkpoint exists)")
+    parser.add_argument('-b', '--batch_size', type=int, help='Number of images per session call', default=64)
+    parser.add_argument('-t', '--n_threads', type=int, help='Threads reading and decoding the images', default=8)
+    parser.add_argument('-c', '--checkpoint_every', type=int, help='Batches between two checkpoints', default=50)
+    parser.add_argument('-g', '--gpu', type=str, help='GPU 1, 0 or '' for CPU', default='')
+    args = vars(parser.parse_args())
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.get('gpu')
+
+    if args.get('input_dir'):
+        input_filenames = iter_directory_images(args.get('input_dir'))
+    else:
+        input_filenames = iter_csv_images(args.get('input_csv'), args.get('csv_delimiter'))
+
+    with tf.Session(graph=tf.Graph()):
+        bulk_predictor = BulkPredictor(PredictionModel(args.get('export_dir')), n_threads=args.get('n_threads'))
+        try:
+            n_files = run_bulk_prediction(bulk_predictor, input_filenames, args.get('output_file'),
+                                          batch_size=args.get('batch_size'),
+                                          checkpoint_every=args.get('checkpoint_every'))
+        finally:
+            bulk_predictor.close()
+    print('Processed {} files, results in {}'.format(n_files, args.get('output_file')))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import tensorflow as tf
+from src.model import crnn_fn
+from src.data_handler import data_loader, preprocess_batch_for_prediction
+from src.loader import PredictionModel
+from src.evaluation import evaluate_prediction_model
+from src.pruning import select_channels, prune_checkpoint, pruned_params, model_complexity
+from src.config import Params, import_params_from_json
+
+
+def evaluate_checkpoint(model_dir: str, params: Params, csv_filename, batch_size: int, max_samples: int) -> dict:
+    # Complexity, latency and recognition metrics of the last checkpoint of a model (exported in a temporary dir)
+    export_dir_base = tempfile.mkdtemp()
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params={'Params': params}, model_dir=model_dir)
+    export_dir = estimator.export_savedmodel(export_dir_base,
+                                             preprocess_batch_for_prediction(fixed_height=params.input_shape[0],
+                                                                             min_width=10))
+    with tf.Session(graph=tf.Graph()):
+        model = PredictionModel(export_dir.decode() if isinstance(export_dir, bytes) else export_dir)
+        metrics = evaluate_prediction_model(model, csv_filename, params, batch_size=batch_size,
+                                            max_samples=max_samples)
+    shutil.rmtree(export_dir_base)
+
+    metrics.update(model_complexity(params))
+    return metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_dir', type=str, required=True, help='Directory of the trained model')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Directory of the pruned model')
+    parser.add_argument('-r', '--pruning_ratio', type=float, default=0.5,
+                        help='Fraction of the channels removed from each pruned layer')
+    parser.add_argument('-l', '--layers', type=int, nargs='*', default=[4, 5, 6, 7],
+                        help='Layers of deep_cnn whose channels are pruned')
+    parser.add_argument('-s', '--saliency', type=str, choices=['bn_gamma', 'l1'], default='bn_gamma',
+                        help="Ranking of the channels : |gamma| of the batch norm (l1 norm for the layers without "
+                             "batch norm) or 'l1' norm of the filters")
+    parser.add_argument('-ft', '--csv_files_train', type=str, nargs='*', default=None,
+                        help='CSV filenames for fine-tuning (default : csv_files_train of the params)')
+    parser.add_argument('-fe', '--csv_files_eval', type=str, nargs='*', default=None,
+                        help='CSV filenames for the evaluation (default : csv_files_eval of the params)')
+    parser.add_argument('-n', '--nb-epochs', type=int, default=2, help='Number of epochs of fine-tuning')
+    parser.add_argument('--max_samples', type=int, help='Maximum number of samples evaluated', default=None)
+    parser.add_argument('-b', '--batch_size', type=int, help='Batch size for the evaluation', default=32)
+    parser.add_argument('-g', '--gpu', type=str, help="GPU 0,1 or '' ", default='')
+    args = vars(parser.parse_args())
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.get('gpu')
+    parameters = Params(**import_params_from_json(args.get('model_dir')))
+    csv_files_train = args.get('csv_files_train') or parameters.csv_files_train
+    csv_files_eval = args.get('csv_files_eval') or parameters.csv_files_eval
+    assert all(1 <= layer <= 7 for layer in args.get('layers')), 'deep_cnn has 7 layers'
+
+    report = {'original': evaluate_checkpoint(args.get('model_dir'), parameters, csv_files_eval,
+                                              batch_size=args.get('batch_size'), max_samples=args.get('max_samples'))}
+
+    # Prune
+    checkpoint = tf.train.latest_checkpoint(args.get('model_dir'))
+    kept_channels = select_channels(checkpoint, args.get('layers'), args.get('pruning_ratio'),
+                                    criterion=args.get('saliency'))
+    prune_checkpoint(checkpoint, kept_channels, args.get('output_dir'))
+    pruned_parameters = pruned_params(parameters, kept_channels, args.get('output_dir'))
+    pruned_parameters.csv_files_train, pruned_parameters.csv_files_eval = csv_files_train, csv_files_eval
+    pruned_parameters.export_experiment_params()
+    print('Pruned model written to {}, number of filters {}'.format(args.get('output_dir'),
+                                                                    pruned_parameters.cnn_n_filters))
+    report['pruned'] = evaluate_checkpoint(args.get('output_dir'), pruned_parameters, csv_files_eval,
+                                           batch_size=args.get('batch_size'), max_samples=args.get('max_samples'))
+
+    # Fine-tune
+    if args.get('nb_epochs') > 0:
+        estimator = tf.estimator.Estimator(model_fn=crnn_fn, params={'Params': pruned_parameters},
+                                           model_dir=args.get('output_dir'))
+        estimator.train(input_fn=data_loader(csv_filename=csv_files_train,
+                                             params=pruned_parameters,
+                                             batch_size=pruned_parameters.train_batch_size,
+                                             num_epochs=args.get('nb_epochs'),
+                                             data_augmentation=True))
+        report['fine_tuned'] = evaluate_checkpoint(args.get('output_dir'), pruned_parameters, csv_files_eval,
+                                                   batch_size=args.get('batch_size'),
+                                                   max_samples=args.get('max_samples'))
+
+    for name, metrics in report.items():
+        print('{:10s} | {:8.1f} MFLOPs | {:6.2f} M params | {:7.2f} ms/image | CER {:.4f} | accuracy {:.4f}'.format(
+            name, metrics['flops'] / 1e6, metrics['n_parameters'] / 1e6, metrics['ms_per_image'], metrics['CER'],
+            metrics['accuracy']))
+
+    report['kept_channels'] = {layer: kept.tolist() for layer, kept in kept_channels.items()}
+    with open(os.path.join(args.get('output_dir'), 'pruning_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
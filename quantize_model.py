@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import tensorflow as tf
+from src.loader import PredictionModel
+from src.evaluation import evaluate_prediction_model, read_csv_samples
+from src.graph_optimization import load_frozen_saved_model, transform_frozen_graph, \
+    save_graph_def_as_saved_model, directory_size, RedirectStderr
+from src.config import Params, import_params_from_json
+
+REQUANTIZATION_LOG_MESSAGE = '__requant_min_max:'
+
+
+def calibrate_requantization_ranges(graph_def, signature_def, init_op_names, params: Params, calibration_csv,
+                                    max_samples: int, batch_size: int, log_filename: str) -> None:
+    # Runs the calibration images through the graph with the ranges of the quantized activations logged
+    logged_graph_def = transform_frozen_graph(graph_def, signature_def, init_op_names, [
+        'insert_logging(op=RequantizationRange, show_name=true, message="{}")'.format(REQUANTIZATION_LOG_MESSAGE)])
+
+    logged_export_dir = os.path.join(tempfile.mkdtemp(), 'logged_model')
+    save_graph_def_as_saved_model(logged_graph_def, signature_def, init_op_names, logged_export_dir)
+
+    paths, _ = read_csv_samples(calibration_csv, params.csv_delimiter, max_samples=max_samples)
+    with RedirectStderr(log_filename):
+        with tf.Session(graph=tf.Graph()):
+            model = PredictionModel(logged_export_dir)
+            for i in range(0, len(paths), batch_size):
+                model.predict_files(paths[i:i + batch_size])
+    shutil.rmtree(os.path.dirname(logged_export_dir))
+
+
+def evaluate_export(export_dir: str, params: Params, csv_filename, batch_size: int, max_samples: int) -> dict:
+    with tf.Session(graph=tf.Graph()):
+        model = PredictionModel(export_dir)
+        metrics = evaluate_prediction_model(model, csv_filename, params, batch_size=batch_size,
+                                            max_samples=max_samples)
+    metrics['model_size_bytes'] = directory_size(export_dir)
+    return metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--export_dir', type=str, required=True, help='Exported (float) model directory')
+    parser.add_argument('-o', '--output_dir', type=str, required=True, help='Output directory of the int8 model')
+    parser.add_argument('-m', '--model_dir', type=str, required=True,
+                        help='Directory of the trained model (for its parameters json)')
+    parser.add_argument('-c', '--calibration_csv', type=str, required=True, nargs='*',
+                        help='CSV filenames used for calibration and evaluation')
+    parser.add_argument('-q', '--quantization', type=str, choices=['weights', 'full'], default='full',
+                        help="'weights' : int8 weights, 'full' : int8 weights and activations (where possible)")
+    parser.add_argument('-n', '--max_samples', type=int, help='Maximum number of samples used', default=None)
+    parser.add_argument('-b', '--batch_size', type=int, help='Batch size for the evaluation', default=32)
+    args = vars(parser.parse_args())
+
+    parameters = Params(**import_params_from_json(args.get('model_dir')))
+
+    graph_def, signature_def, init_op_names = load_frozen_saved_model(args.get('export_dir'))
+
+    transforms = ['fold_constants(ignore_errors=true)', 'quantize_weights(minimum_size=1024)']
+    if args.get('quantization') == 'full':
+        transforms += ['quantize_nodes']
+    quantized_graph_def = transform_frozen_graph(graph_def, signature_def, init_op_names, transforms)
+
+    if args.get('quantization') == 'full':
+        # Replace the dynamic requantization ranges by the ranges observed on the calibration images
+        log_filename = os.path.join(tempfile.mkdtemp(), 'requantization_ranges.log')
+        calibrate_requantization_ranges(quantized_graph_def, signature_def, init_op_names, parameters,
+                                        args.get('calibration_csv'), max_samples=args.get('max_samples'),
+                                        batch_size=args.get('batch_size'), log_filename=log_filename)
+        quantized_graph_def = transform_frozen_graph(quantized_graph_def, signature_def, init_op_names, [
+            'freeze_requantization_ranges(min_max_log_file="{}")'.format(log_filename)])
+
+    save_graph_def_as_saved_model(quantized_graph_def, signature_def, init_op_names, args.get('output_dir'))
+    print('Exported quantized model to {}'.format(args.get('output_dir')))
+
+    # Report
+    report = {name: evaluate_export(export_dir, parameters, args.get('calibration_csv'),
+                                    batch_size=args.get('batch_size'), max_samples=args.get('max_samples'))
+              for name, export_dir in [('float', args.get('export_dir')), ('int8', args.get('output_dir'))]}
+
+    for name, metrics in report.items():
+        print('{:5s} | size {:8.2f} MB | {:7.2f} ms/image | CER {:.4f} | accuracy {:.4f}'.format(
+            name, metrics['model_size_bytes'] / 2**20, metrics['ms_per_image'], metrics['CER'], metrics['accuracy']))
+
+    with open(os.path.join(args.get('output_dir'), 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import asyncio
+import argparse
+import tensorflow as tf
+from src.loader import PredictionModel
+from src.inference_server import MicroBatcher, InferenceServer
+
+
+async def report_stats(batcher: MicroBatcher, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(batcher.stats.report()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--export_dir', type=str, required=True,
+                        help='Exported model directory (export_model.py --receiver batch)')
+    parser.add_argument('--host', type=str, help='Host of the HTTP server', default='localhost')
+    parser.add_argument('--port', type=int, help='Port of the HTTP server', default=8080)
+    parser.add_argument('--unix_socket', type=str, help='Serve on a Unix socket instead of TCP', default=None)
+    parser.add_argument('-b', '--max_batch_size', type=int, help='Maximum number of images per batch', default=32)
+    parser.add_argument('-w', '--max_wait_ms', type=float, help='Maximum waiting time of a request before its '
+                                                                'batch is run (ms)', default=10.0)
+    parser.add_argument('--width_bucket_ratio', type=float, default=1.5,
+                        help='Images with widths within this ratio can be batched together')
+    parser.add_argument('--n_decoding_threads', type=int, help='Threads decoding the images', default=4)
+    parser.add_argument('--stats_interval', type=float, help='Interval between stats reports (s)', default=30.0)
+    parser.add_argument('-g', '--gpu', type=str, help='GPU 1, 0 or '' for CPU', default='')
+    args = vars(parser.parse_args())
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.get('gpu')
+
+    with tf.Session(graph=tf.Graph()) as sess:
+        model = PredictionModel(args.get('export_dir'))
+        batcher = MicroBatcher(model, max_batch_size=args.get('max_batch_size'), max_wait_ms=args.get('max_wait_ms'),
+                               width_bucket_ratio=args.get('width_bucket_ratio'),
+                               n_decoding_threads=args.get('n_decoding_threads'))
+        server = InferenceServer(batcher)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(server.start(host=args.get('host'), port=args.get('port'),
+                                             unix_socket=args.get('unix_socket')))
+        loop.create_task(report_stats(batcher, args.get('stats_interval')))
+        print('Serving {} on {}'.format(args.get('export_dir'), args.get('unix_socket') or
+                                        '{}:{}'.format(args.get('host'), args.get('port'))))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            print(json.dumps(batcher.stats.report()))
+        finally:
+            batcher.close()
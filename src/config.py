@@ -9,6 +9,12 @@ from glob import glob
 
 class CONST:
     DIMENSION_REDUCTION_W_POOLING = 2*2  # 2x2 pooling in dimension W on layer 1 and 2
+    # Collections of the expensive summaries, each one saved at its own rate (not with the scalar summaries)
+    IMAGE_SUMMARIES = 'image_summaries'
+    TEXT_SUMMARIES = 'text_summaries'
+    HISTOGRAM_SUMMARIES = 'histogram_summaries'
+    # Params of the current run (cluster of the workers), not exported with the params of the experiment
+    RUNTIME_PARAMS = ['num_workers', 'worker_index']
 
 
 # noinspection SpellCheckingInspection,SpellCheckingInspection
@@ -101,8 +107,114 @@ class Params:
         self.csv_files_eval = kwargs.get('csv_files_eval')
         self.output_model_dir = kwargs.get('output_model_dir')
         self._keep_prob_dropout = kwargs.get('keep_prob')
+        # Input pipeline used by data_loader : 'dataset' (tf.data), 'tfrecord' (preprocessed shards cache),
+        # 'memmap' (memory-mapped uint8 store of padded images) or 'queue' (legacy queue runners)
+        self.input_pipeline = kwargs.get('input_pipeline', 'dataset')
+        # Number of csv files read in parallel (tf.data pipeline)
+        self.csv_reader_cycle_length = kwargs.get('csv_reader_cycle_length', 4)
+        # Number of elements decoded and padded in parallel (tf.data pipeline)
+        self.num_parallel_calls = kwargs.get('num_parallel_calls', 8)
+        # Size of the buffer used to shuffle the samples (tf.data pipeline)
+        self.shuffle_buffer_size = kwargs.get('shuffle_buffer_size', 4000)
+        # Number of batches prepared in advance (tf.data pipeline)
+        self.prefetch_buffer_size = kwargs.get('prefetch_buffer_size', 2)
+        # Directory where the preprocessed TFRecord shards are cached ('tfrecord' pipeline)
+        self.tfrecord_cache_dir = kwargs.get('tfrecord_cache_dir', './tfrecord_cache')
+        # Number of TFRecord shards written per cached dataset
+        self.tfrecord_n_shards = kwargs.get('tfrecord_n_shards', 16)
+        # Either store the images padded to input_shape (no decoding nor padding at training time)
+        # or store the decoded grayscale images (allows data augmentation before padding)
+        self.tfrecord_padded_images = kwargs.get('tfrecord_padded_images', True)
+        # Group the samples by width and pad each batch to its widest image instead of the full input width
+        # ('dataset' pipeline and 'tfrecord' pipeline with tfrecord_padded_images=False)
+        self.bucket_by_width = kwargs.get('bucket_by_width', False)
+        # Upper (exclusive) widths of the buckets. If None, n_width_buckets buckets evenly spread on input width
+        self.bucket_boundaries = kwargs.get('bucket_boundaries', None)
+        self.n_width_buckets = kwargs.get('n_width_buckets', 8)
+        # Number of pixels per batch (batch_size * width of the bucket * height). If None, batch_size * input_shape
+        self.batch_pixel_budget = kwargs.get('batch_pixel_budget', None)
+        # Maximum number of images in a batch of narrow images. If None, 8 * batch_size
+        self.max_bucket_batch_size = kwargs.get('max_bucket_batch_size', None)
+        # Convolutional backbone : 'vgg' (7 layers of full convolutions) or 'separable' (same layers and poolings
+        # with depthwise separable convolutions, lighter for CPU inference)
+        self.cnn_backbone = kwargs.get('cnn_backbone', 'vgg')
+        # Number of filters of each layer of the backbone (64, 128, 256, 256, 512, 512, 512) multiplied by this factor
+        self.cnn_width_multiplier = kwargs.get('cnn_width_multiplier', 1.0)
+        # Number of filters of each of the 7 layers of the backbone, overrides the width multiplier (pruned models)
+        self.cnn_n_filters = kwargs.get('cnn_n_filters', None)
+        # Exported teacher model (outputs 'prob' and 'sequence_lengths') for knowledge distillation, None : no teacher.
+        # Its logits on the training images are computed once and cached in distillation_cache_dir
+        self.distillation_teacher = kwargs.get('distillation_teacher', None)
+        self.distillation_cache_dir = kwargs.get('distillation_cache_dir', './teacher_cache')
+        # Weight of the frame level KL divergence to the teacher in the loss (the ctc loss has weight 1 - alpha)
+        self.distillation_alpha = kwargs.get('distillation_alpha', 0.5)
+        # Temperature of the softmax of the teacher and student logits in the KL divergence
+        self.distillation_temperature = kwargs.get('distillation_temperature', 2.0)
+        # Implementation of the bidirectional lstm : 'basic' (BasicLSTMCell in a dynamic rnn loop)
+        # or 'block_fused' (LSTMBlockFusedCell, one op per layer and direction) or 'unrolled' (static rnn, needs
+        # a fixed input width and does not mask the padding, used for the tflite export). Checkpoints are compatible
+        self.lstm_implementation = kwargs.get('lstm_implementation', 'basic')
+        # Data augmentation of each decoded image ('sample', legacy) or of the whole batch after batching ('batch')
+        self.augmentation_stage = kwargs.get('augmentation_stage', 'batch')
+        # Random padding of each side (fraction of the image height, width padding is at most 1/4 of the width)
+        self.augmentation_max_padding = kwargs.get('augmentation_max_padding', 0.2)
+        # Maximum rotation (radians) and shear of the affine transform
+        self.augmentation_max_rotation = kwargs.get('augmentation_max_rotation', 0.05)
+        self.augmentation_max_shear = kwargs.get('augmentation_max_shear', 0.2)
+        # Maximum elastic displacement (pixels) and spacing of its random control points (pixels). 0 disables it
+        self.augmentation_elastic_alpha = kwargs.get('augmentation_elastic_alpha', 1.0)
+        self.augmentation_elastic_grid = kwargs.get('augmentation_elastic_grid', 8)
+        # Maximum brightness change (fraction of 255) and range of the contrast factor
+        self.augmentation_max_brightness_delta = kwargs.get('augmentation_max_brightness_delta', 0.1)
+        self.augmentation_contrast_range = kwargs.get('augmentation_contrast_range', (0.5, 1.5))
+        # Filter the samples and count them with a manifest index of the csv files (image sizes, label lengths)
+        self.use_manifest_index = kwargs.get('use_manifest_index', False)
+        self.manifest_index_dir = kwargs.get('manifest_index_dir', './manifest_index')
+        # Number of training workers and index of the current one, set at runtime by train.py in distributed mode
+        # (used to shard the training data, not exported with the params, see CONST.RUNTIME_PARAMS)
+        self.num_workers = 1
+        self.worker_index = 0
+        # Synchronous training (gradients averaged over the workers) or asynchronous updates of the parameter servers
+        self.sync_replicas = kwargs.get('sync_replicas', True)
+        # Scale the learning rate with the number of workers (effective batch size is num_workers * train_batch_size)
+        self.scale_learning_rate_with_workers = kwargs.get('scale_learning_rate_with_workers', True)
+        # Steps between two saves of the image, text and histogram summaries (0 : never saved)
+        self.image_summaries_steps = kwargs.get('image_summaries_steps', 1000)
+        self.text_summaries_steps = kwargs.get('text_summaries_steps', 1000)
+        self.histogram_summaries_steps = kwargs.get('histogram_summaries_steps', 0)
+        # Interval (seconds) between two writes of the aggregated training metrics (loss, lr, throughput)
+        self.telemetry_flush_secs = kwargs.get('telemetry_flush_secs', 60)
+        # Aggregated metrics written to 'telemetry.jsonl' in the model directory ('jsonl') or to the event file
+        self.telemetry_format = kwargs.get('telemetry_format', 'jsonl')
+        # CTC decoder used for the predictions : 'beam_search' or 'greedy'
+        self.ctc_decoder = kwargs.get('ctc_decoder', 'beam_search')
+        # Beam width and number of decoded paths of the beam search decoder
+        self.beam_width = kwargs.get('beam_width', 100)
+        self.top_paths = kwargs.get('top_paths', 2)
+        # Confidence score of the predictions : 'beam_margin' (difference of log probabilities of the 2 best paths),
+        # 'mean_max_prob' or 'min_max_prob' (mean or minimum over the frames of the maximum class probability)
+        self.score_type = kwargs.get('score_type', 'beam_margin')
+        # Directory where the memory-mapped stores of padded images are built ('memmap' pipeline)
+        self.memmap_store_dir = kwargs.get('memmap_store_dir', './memmap_store')
 
         assert self.optimizer in ['adam', 'rms', 'ada'], 'Unknown optimizer {}'.format(self.optimizer)
+        assert self.input_pipeline in ['dataset', 'tfrecord', 'memmap', 'queue'], \
+            'Unknown input pipeline {}'.format(self.input_pipeline)
+        assert self.cnn_backbone in ['vgg', 'separable'], 'Unknown cnn backbone {}'.format(self.cnn_backbone)
+        assert self.cnn_width_multiplier > 0, 'The width multiplier of the cnn must be positive'
+        assert self.cnn_n_filters is None or len(self.cnn_n_filters) == 7, 'cnn_n_filters needs 7 numbers of filters'
+        assert 0 <= self.distillation_alpha <= 1, 'The distillation weight must be between 0 and 1'
+        assert self.lstm_implementation in ['basic', 'block_fused', 'unrolled'], \
+            'Unknown lstm implementation {}'.format(self.lstm_implementation)
+        assert self.ctc_decoder in ['beam_search', 'greedy'], 'Unknown ctc decoder {}'.format(self.ctc_decoder)
+        assert self.score_type in ['beam_margin', 'mean_max_prob', 'min_max_prob'], \
+            'Unknown score type {}'.format(self.score_type)
+        assert self.augmentation_stage in ['sample', 'batch'], \
+            'Unknown augmentation stage {}'.format(self.augmentation_stage)
+        assert self.telemetry_format in ['jsonl', 'events'], \
+            'Unknown telemetry format {}'.format(self.telemetry_format)
+        assert self.score_type != 'beam_margin' or (self.ctc_decoder == 'beam_search' and self.top_paths >= 2), \
+            "Score 'beam_margin' needs the beam search decoder with top_paths >= 2"
 
         self._assign_alphabet(alphabet_decoding_list=Alphabet.DecodingList)
 
@@ -111,7 +223,7 @@ class Params:
             os.mkdir(self.output_model_dir)
         filename = os.path.join(self.output_model_dir, 'model_params_{}.json'.format(round(time.time())))
         with open(filename, 'w') as f:
-            json.dump(vars(self), f)
+            json.dump({k: v for k, v in vars(self).items() if k not in CONST.RUNTIME_PARAMS}, f)
 
     def show_experiment_params(self):
         return vars(self)
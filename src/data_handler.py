@@ -2,9 +2,12 @@
 __author__ = 'solivr'
 
 import tensorflow as tf
-import numpy as np
 from .config import Params, CONST
-from typing import Tuple
+from .tfrecord_cache import get_cache_directory, compute_cache_key, is_cache_valid, write_tfrecord_cache, \
+    get_shard_filenames, parse_tfrecord_example
+from .manifest_index import filter_csv_files
+from .memmap_store import MemmapStore, count_csv_samples, is_store_valid, write_memmap_store
+from typing import Tuple, List, Union
 
 
 def resize_image(image, height_and_width: list):
@@ -12,8 +15,27 @@ def resize_image(image, height_and_width: list):
 
 
 def data_loader(csv_filename: str, params: Params, batch_size: int = 128, data_augmentation: bool = False,
-                num_epochs: int = None, image_summaries: bool = False):
-    def input_fn():
+                num_epochs: int = None, image_summaries: bool = False, shard_per_worker: bool = False):
+    # With shard_per_worker, each of the params.num_workers workers reads a disjoint part of the samples
+    sharded = shard_per_worker and params.num_workers > 1
+
+    # Data augmentation of the decoded samples (legacy) or of the whole batch after batching
+    sample_augmentation = data_augmentation and params.augmentation_stage == 'sample'
+    batch_augmentation = data_augmentation and params.augmentation_stage == 'batch'
+    # The logits of the teacher are aligned with the frames of the original images : with distillation only the
+    # brightness and contrast are changed, the geometric transforms (padding, rotation, shear, elastic) are disabled
+    geometric_augmentation = not params.distillation_teacher
+    if sample_augmentation and not geometric_augmentation:
+        tf.logging.warn("The augmentation of the samples moves the frames of the images, it is disabled with "
+                        "distillation (use augmentation_stage='batch' for brightness and contrast changes)")
+        sample_augmentation = False
+
+    if params.use_manifest_index:
+        # Samples that would not be trained on (unreadable image, unknown characters, label longer than the ctc
+        # sequence) are removed using the manifest index
+        csv_filename, _ = filter_csv_files(csv_filename if isinstance(csv_filename, list) else [csv_filename], params)
+
+    def queue_input_fn():
         # Choose case one csv file or list of csv files
         filename_queue = get_filename_queue()
         # Skip lines that have already been processed
@@ -26,7 +48,7 @@ def data_loader(csv_filename: str, params: Params, batch_size: int = 128, data_a
                                     name='csv_reading_op')
 
         image, img_width = image_reading(path, resized_size=params.input_shape,
-                                         data_augmentation=data_augmentation, padding=True)
+                                         data_augmentation=sample_augmentation, padding=True)
 
         to_batch = {'images': image, 'images_widths': img_width, 'filenames': path, 'labels': label}
         prepared_batch = tf.train.shuffle_batch(to_batch,
@@ -35,14 +57,135 @@ def data_loader(csv_filename: str, params: Params, batch_size: int = 128, data_a
                                                 num_threads=15, capacity=4000,
                                                 allow_smaller_final_batch=False,
                                                 name='prepared_batch_queue')
+        if batch_augmentation:
+            prepared_batch = augment_prepared_batch(prepared_batch)
 
-        if image_summaries:
-            tf.summary.image('input/image', prepared_batch.get('images'), max_outputs=1)
-        tf.summary.text('input/labels', prepared_batch.get('labels')[:10])
-        tf.summary.text('input/widths', tf.as_string(prepared_batch.get('images_widths')))
+        add_input_summaries(prepared_batch, image_summaries)
 
         return prepared_batch, prepared_batch.get('labels')
 
+    def dataset_input_fn():
+        csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+
+        with tf.name_scope('dataset_pipeline'):
+            # Read several csv files in parallel and interleave their lines
+            dataset = tf.data.Dataset.from_tensor_slices(csv_filenames)
+            dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+                tf.data.TextLineDataset,
+                cycle_length=min(len(csv_filenames), params.csv_reader_cycle_length),
+                sloppy=not sharded))
+
+            if sharded:
+                # The order of the lines is deterministic so the shards are disjoint
+                dataset = dataset.shard(params.num_workers, params.worker_index)
+
+            dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(params.shuffle_buffer_size, num_epochs))
+
+            # Decode and pad the images in parallel
+            dataset = dataset.map(parse_csv_line, num_parallel_calls=params.num_parallel_calls)
+
+            dataset = batch_dataset(dataset, params, batch_size)
+            if batch_augmentation:
+                dataset = dataset.map(augment_prepared_batch, num_parallel_calls=params.num_parallel_calls)
+            dataset = dataset.prefetch(params.prefetch_buffer_size)
+
+            prepared_batch = dataset.make_one_shot_iterator().get_next()
+
+        add_input_summaries(prepared_batch, image_summaries)
+
+        return prepared_batch, prepared_batch.get('labels')
+
+    def tfrecord_input_fn():
+        csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+        # (Re)build the cache if it does not exist or is stale
+        cache_dir = build_tfrecord_cache(csv_filenames, params)
+        shard_filenames = get_shard_filenames(cache_dir)
+
+        if data_augmentation and params.tfrecord_padded_images and not batch_augmentation:
+            tf.logging.warn('Cached images are already padded, data augmentation is not applied')
+
+        with tf.name_scope('tfrecord_pipeline'):
+            # Stream the shards in parallel
+            dataset = tf.data.Dataset.from_tensor_slices(shard_filenames)
+            dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=min(len(shard_filenames), params.csv_reader_cycle_length),
+                sloppy=not sharded))
+
+            if sharded:
+                dataset = dataset.shard(params.num_workers, params.worker_index)
+
+            dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(params.shuffle_buffer_size, num_epochs))
+            dataset = dataset.map(parse_tfrecord, num_parallel_calls=params.num_parallel_calls)
+            dataset = batch_dataset(dataset, params, batch_size)
+            if batch_augmentation:
+                dataset = dataset.map(augment_prepared_batch, num_parallel_calls=params.num_parallel_calls)
+            dataset = dataset.prefetch(params.prefetch_buffer_size)
+
+            prepared_batch = dataset.make_one_shot_iterator().get_next()
+
+        add_input_summaries(prepared_batch, image_summaries)
+
+        return prepared_batch, prepared_batch.get('labels')
+
+    def memmap_input_fn():
+        csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+        # (Re)build the store if it does not exist or is stale
+        store = MemmapStore(build_memmap_store(csv_filenames, params))
+
+        if data_augmentation and not batch_augmentation:
+            tf.logging.warn('Stored images are already padded, data augmentation is not applied')
+
+        with tf.name_scope('memmap_pipeline'):
+            height, width = store.input_shape
+            dataset = tf.data.Dataset.from_generator(
+                lambda: store.batch_generator(batch_size, num_epochs=num_epochs,
+                                              shard_index=params.worker_index if sharded else 0,
+                                              num_shards=params.num_workers if sharded else 1),
+                output_types={'images': tf.uint8, 'images_widths': tf.int32,
+                              'filenames': tf.string, 'labels': tf.string},
+                output_shapes={'images': [batch_size, height, width, 1], 'images_widths': [batch_size],
+                               'filenames': [batch_size], 'labels': [batch_size]})
+            dataset = dataset.map(lambda batch: dict(batch, images=tf.cast(batch['images'], tf.float32)))
+            if batch_augmentation:
+                dataset = dataset.map(augment_prepared_batch, num_parallel_calls=params.num_parallel_calls)
+            dataset = dataset.prefetch(params.prefetch_buffer_size)
+
+            prepared_batch = dataset.make_one_shot_iterator().get_next()
+
+        add_input_summaries(prepared_batch, image_summaries)
+
+        return prepared_batch, prepared_batch.get('labels')
+
+    def parse_tfrecord(serialized_example):
+        image, img_width, label, path = parse_tfrecord_example(serialized_example,
+                                                               padded_images=params.tfrecord_padded_images,
+                                                               input_shape=params.input_shape)
+        if not params.tfrecord_padded_images:
+            image, img_width = preprocess_image(image, resized_size=params.input_shape,
+                                                data_augmentation=sample_augmentation,
+                                                padding=not params.bucket_by_width,
+                                                resize_width=params.bucket_by_width)
+
+        return {'images': image, 'images_widths': img_width, 'filenames': path, 'labels': label}
+
+    def parse_csv_line(line):
+        default_line = [['None'], ['None']]
+
+        path, label = tf.decode_csv(line, record_defaults=default_line, field_delim=params.csv_delimiter,
+                                    name='csv_reading_op')
+
+        image, img_width = image_reading(path, resized_size=params.input_shape,
+                                         data_augmentation=sample_augmentation,
+                                         padding=not params.bucket_by_width,
+                                         resize_width=params.bucket_by_width)
+
+        return {'images': image, 'images_widths': img_width, 'filenames': path, 'labels': label}
+
+    def augment_prepared_batch(batch):
+        return dict(batch, images=augment_batch(batch['images'], batch['images_widths'], params,
+                                                geometric=geometric_augmentation))
+
     def get_filename_queue():
         if not isinstance(csv_filename, list):
             filename_queue = tf.train.string_input_producer([csv_filename], num_epochs=num_epochs,
@@ -52,19 +195,129 @@ def data_loader(csv_filename: str, params: Params, batch_size: int = 128, data_a
 
         return filename_queue
 
-    return input_fn
+    if params.bucket_by_width and (params.input_pipeline in ['queue', 'memmap'] or
+                                   (params.input_pipeline == 'tfrecord' and params.tfrecord_padded_images)):
+        tf.logging.warn('Bucketing by width is not possible with padded images, batches have a fixed width')
+
+    if sharded and params.input_pipeline == 'queue':
+        tf.logging.warn('The queue pipeline cannot be sharded, each worker reads all the samples')
+
+    if params.input_pipeline == 'queue':
+        return queue_input_fn
+    elif params.input_pipeline == 'tfrecord':
+        return tfrecord_input_fn
+    elif params.input_pipeline == 'memmap':
+        return memmap_input_fn
+    else:
+        return dataset_input_fn
+
+
+def batch_dataset(dataset: tf.data.Dataset, params: Params, batch_size: int) -> tf.data.Dataset:
+    if not params.bucket_by_width or dataset.output_shapes['images'][1].value is not None:
+        # Keep a static batch size (same as allow_smaller_final_batch=False)
+        return dataset.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+
+    # Group the images of similar widths and pad them to the widest image of the batch.
+    # The number of images per batch is given by the pixel budget of the widest image of the bucket
+    height, target_w = params.input_shape
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    if params.bucket_boundaries:
+        boundaries = list(params.bucket_boundaries)
+    else:
+        step = target_w / params.n_width_buckets
+        boundaries = sorted(set(int(round(step * i / increment) * increment) + 1
+                                for i in range(1, params.n_width_buckets)))
+    pixel_budget = params.batch_pixel_budget if params.batch_pixel_budget else batch_size * height * target_w
+    max_batch_size = params.max_bucket_batch_size if params.max_bucket_batch_size else 8 * batch_size
+
+    bucket_max_widths = [b - 1 for b in boundaries] + [target_w]
+    bucket_batch_sizes = [int(max(1, min(max_batch_size, pixel_budget // (height * w)))) for w in bucket_max_widths]
+
+    return dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+        element_length_func=lambda element: element['images_widths'],
+        bucket_boundaries=boundaries,
+        bucket_batch_sizes=bucket_batch_sizes,
+        padded_shapes={'images': [height, None, 1], 'images_widths': [], 'filenames': [], 'labels': []}))
+
+
+def count_samples(csv_filename: Union[str, List[str]], params: Params) -> int:
+    # Number of samples read by data_loader
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+    if params.use_manifest_index:
+        return filter_csv_files(csv_filenames, params)[1]
+    return count_csv_samples(csv_filenames)
+
+
+def build_tfrecord_cache(csv_filename: Union[str, List[str]], params: Params, force: bool = False) -> str:
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+
+    cache_dir = get_cache_directory(csv_filenames, params.tfrecord_cache_dir)
+    cache_key = compute_cache_key(csv_filenames, {'input_shape': list(params.input_shape),
+                                                  'padded_images': params.tfrecord_padded_images,
+                                                  'csv_delimiter': params.csv_delimiter})
+
+    if force or not is_cache_valid(cache_dir, cache_key):
+        print('Building TFRecord cache {} for {}'.format(cache_dir, csv_filenames))
+        samples = decoded_samples_generator(csv_filenames, params, padding=params.tfrecord_padded_images)
+        write_tfrecord_cache(samples, cache_dir, cache_key, n_shards=params.tfrecord_n_shards,
+                             padded_images=params.tfrecord_padded_images, input_shape=params.input_shape)
+
+    return cache_dir
+
+
+def build_memmap_store(csv_filename: Union[str, List[str]], params: Params, force: bool = False) -> str:
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+
+    store_dir = get_cache_directory(csv_filenames, params.memmap_store_dir)
+    store_key = compute_cache_key(csv_filenames, {'input_shape': list(params.input_shape),
+                                                  'csv_delimiter': params.csv_delimiter})
+
+    if force or not is_store_valid(store_dir, store_key):
+        print('Building memmap store {} for {}'.format(store_dir, csv_filenames))
+        samples = decoded_samples_generator(csv_filenames, params, padding=True)
+        write_memmap_store(samples, count_csv_samples(csv_filenames), store_dir, store_key,
+                           input_shape=params.input_shape)
+
+    return store_dir
+
+
+def add_input_summaries(prepared_batch: dict, image_summaries: bool = False) -> None:
+    # Saved at their own rates (Params.image_summaries_steps and text_summaries_steps)
+    if image_summaries:
+        tf.summary.image('input/image', prepared_batch.get('images'), max_outputs=1,
+                         collections=[CONST.IMAGE_SUMMARIES])
+    tf.summary.text('input/labels', prepared_batch.get('labels')[:10], collections=[CONST.TEXT_SUMMARIES])
+    tf.summary.text('input/widths', tf.as_string(prepared_batch.get('images_widths')),
+                    collections=[CONST.TEXT_SUMMARIES])
 
 
 def image_reading(path: str, resized_size: Tuple[int, int] = None, data_augmentation: bool = False,
-                  padding: bool = False) -> Tuple[tf.Tensor, tf.Tensor]:
+                  padding: bool = False, resize_width: bool = False) -> Tuple[tf.Tensor, tf.Tensor]:
+    image = decode_image_file(path)
+
+    return preprocess_image(image, resized_size=resized_size, data_augmentation=data_augmentation, padding=padding,
+                            resize_width=resize_width)
+
+
+def decode_image_file(path: str) -> tf.Tensor:
     image_content = tf.read_file(path, name='image_reader')
     image = tf.cond(tf.equal(tf.string_split([path], '.').values[1], tf.constant('jpg', dtype=tf.string)),
                     true_fn=lambda: tf.image.decode_jpeg(image_content, channels=1, try_recover_truncated=True),
                     false_fn=lambda: tf.image.decode_png(image_content, channels=1), name='image_decoding')
+    return image
+
 
+def preprocess_image(image: tf.Tensor, resized_size: Tuple[int, int] = None, data_augmentation: bool = False,
+                     padding: bool = False, resize_width: bool = False) -> Tuple[tf.Tensor, tf.Tensor]:
     if data_augmentation:
         image = augment_data(image)
 
+    if resize_width:
+        # Keep the aspect ratio, the width is only bounded by the target width (padding is done at batching)
+        with tf.name_scope('resize_width'):
+            image, img_width = resizing_inputs_width(image, resized_size, increment=CONST.DIMENSION_REDUCTION_W_POOLING)
+        return image, img_width
+
     if padding:
         with tf.name_scope('padding'):
             image, img_width = padding_inputs_width(image, resized_size, increment=CONST.DIMENSION_REDUCTION_W_POOLING)
@@ -76,6 +329,45 @@ def image_reading(path: str, resized_size: Tuple[int, int] = None, data_augmenta
         return image, img_width
 
 
+def decoded_samples_generator(csv_filename: Union[str, List[str]], params: Params, padding: bool = True):
+    # Decodes the samples of the csv files (in order) in a separate graph and yields numpy values
+    # (uint8 image [H, W, 1], image width, label, filename). With padding the images are resized and padded
+    # to params.input_shape, otherwise they keep their original shape
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+
+    def decode_csv_line(line):
+        default_line = [['None'], ['None']]
+        path, label = tf.decode_csv(line, record_defaults=default_line, field_delim=params.csv_delimiter,
+                                    name='csv_reading_op')
+        if padding:
+            image, img_width = image_reading(path, resized_size=params.input_shape, padding=True)
+            image = tf.cast(tf.round(tf.clip_by_value(image, 0, 255)), tf.uint8)
+        else:
+            image = decode_image_file(path)
+            img_width = tf.shape(image)[1]
+
+        return image, img_width, label, path
+
+    # The graph is only the default one while it is built, the caller's default graph is unchanged between yields
+    graph = tf.Graph()
+    with graph.as_default():
+        dataset = tf.data.TextLineDataset(csv_filenames)
+        dataset = dataset.map(decode_csv_line, num_parallel_calls=params.num_parallel_calls)
+        dataset = dataset.prefetch(params.prefetch_buffer_size)
+        next_sample = dataset.make_one_shot_iterator().get_next()
+
+    sess = tf.Session(graph=graph)
+    try:
+        while True:
+            try:
+                image, img_width, label, path = sess.run(next_sample)
+            except tf.errors.OutOfRangeError:
+                break
+            yield image, img_width, label, path
+    finally:
+        sess.close()
+
+
 def random_rotation(img: tf.Tensor, max_rotation: float = 0.1, crop: bool = True) -> tf.Tensor:
     with tf.name_scope('RandomRotation'):
         rotation = tf.random_uniform([], -max_rotation, max_rotation)
@@ -110,13 +402,14 @@ def cast(h, new_h):
 def random_padding(image: tf.Tensor, max_pad_w: int = 5, max_pad_h: int = 10) -> tf.Tensor:
     w_pad = random_pad(max_pad_w)
     h_pad = random_pad(max_pad_h)
-    padding = [h_pad, w_pad, [0, 0]]
+    padding = tf.stack([h_pad, w_pad, [0, 0]])
 
     return tf.pad(image, padding, mode='REFLECT', name='random_padding')
 
 
 def random_pad(max_pad):
-    return list(np.random.randint(0, max_pad, size=[2]))
+    # Drawn at each run (not once when the graph is built)
+    return tf.random_uniform([2], 0, max_pad, dtype=tf.int32)
 
 
 def augment_data(image: tf.Tensor) -> tf.Tensor:
@@ -135,6 +428,111 @@ def augment_data(image: tf.Tensor) -> tf.Tensor:
         return image
 
 
+def _bilinear_sampling(images: tf.Tensor, x: tf.Tensor, y: tf.Tensor, widths: tf.Tensor,
+                       fill_values: tf.Tensor) -> tf.Tensor:
+    # Samples images [B, H, W, 1] at the coordinates x, y [B, H, W]. Coordinates outside of the image
+    # (or beyond the width of the image in the batch) take the fill value of the image
+    shape = tf.shape(images)
+    batch_size, height, width = shape[0], shape[1], shape[2]
+    max_x = tf.cast(widths, tf.float32)[:, None, None] - 1
+    max_y = tf.cast(height, tf.float32) - 1
+    inside = tf.logical_and(tf.logical_and(x >= 0, x <= max_x), tf.logical_and(y >= 0, y <= max_y))
+
+    x, y = tf.clip_by_value(x, 0., max_x), tf.clip_by_value(y, 0., max_y)
+    x0, y0 = tf.floor(x), tf.floor(y)
+    wx, wy = x - x0, y - y0
+    x0, y0 = tf.cast(x0, tf.int32), tf.cast(y0, tf.int32)
+    x1 = tf.minimum(x0 + 1, tf.cast(max_x, tf.int32))
+    y1 = tf.minimum(y0 + 1, height - 1)
+
+    flat_images = tf.reshape(images, [-1])
+    batch_offsets = (tf.range(batch_size) * height * width)[:, None, None]
+
+    def gather(xi, yi):
+        return tf.gather(flat_images, batch_offsets + yi * width + xi)
+
+    sampled = (gather(x0, y0) * (1 - wx) * (1 - wy) + gather(x1, y0) * wx * (1 - wy) +
+               gather(x0, y1) * (1 - wx) * wy + gather(x1, y1) * wx * wy)
+    sampled = tf.where(inside, sampled, tf.ones_like(sampled) * fill_values[:, None, None])
+
+    return sampled[:, :, :, None]
+
+
+def augment_batch(images: tf.Tensor, images_widths: tf.Tensor, params: Params, geometric: bool = True) -> tf.Tensor:
+    # Data augmentation of a batch of images [B, H, W, 1] (random values drawn per image) :
+    # random padding, rotation and shear (one affine transform) and elastic jitter if geometric, brightness and
+    # contrast. Only the first images_widths columns of each image are transformed
+    with tf.name_scope('BatchDataAugmentation'):
+        shape = tf.shape(images)
+        batch_size, height, width = shape[0], shape[1], shape[2]
+        h = tf.cast(height, tf.float32)
+        widths = tf.cast(images_widths, tf.float32)
+
+        def uniform(low, high):
+            return tf.random_uniform([batch_size], low, high)
+
+        # Mean of the image is used as background value
+        valid_mask = tf.cast(tf.sequence_mask(images_widths, width), tf.float32)[:, None, :, None]
+        means = tf.reduce_sum(images * valid_mask, axis=[1, 2, 3]) / tf.maximum(widths * h, 1.0)
+
+        if geometric:
+            # Output to input coordinates : p_in = C + A (S (p_out - P) - C) with the padding P,
+            # the scaling S of the padded image to its original size, A the rotation and shear around the center C
+            max_pad_w = tf.minimum(params.augmentation_max_padding * h, widths / 4)
+            max_pad_h = params.augmentation_max_padding * h / 2
+            pad_left, pad_right = uniform(0., 1.) * max_pad_w, uniform(0., 1.) * max_pad_w
+            pad_top, pad_bottom = uniform(0., max_pad_h), uniform(0., max_pad_h)
+            scale_x = widths / (widths - pad_left - pad_right)
+            scale_y = h / (h - pad_top - pad_bottom)
+
+            angle = uniform(-params.augmentation_max_rotation, params.augmentation_max_rotation)
+            shear = uniform(-params.augmentation_max_shear, params.augmentation_max_shear)
+            a00, a01 = tf.cos(angle), tf.cos(angle) * shear - tf.sin(angle)
+            a10, a11 = tf.sin(angle), tf.sin(angle) * shear + tf.cos(angle)
+
+            center_x, center_y = widths / 2, h / 2
+            m00, m01, m10, m11 = a00 * scale_x, a01 * scale_y, a10 * scale_x, a11 * scale_y
+            t_x = center_x - a00 * center_x - a01 * center_y - m00 * pad_left - m01 * pad_top
+            t_y = center_y - a10 * center_x - a11 * center_y - m10 * pad_left - m11 * pad_top
+
+            grid_x = tf.cast(tf.range(width), tf.float32)[None, None, :]
+            grid_y = tf.cast(tf.range(height), tf.float32)[None, :, None]
+
+            def per_image(value):
+                return value[:, None, None]
+
+            x = per_image(m00) * grid_x + per_image(m01) * grid_y + per_image(t_x)
+            y = per_image(m10) * grid_x + per_image(m11) * grid_y + per_image(t_y)
+
+            if params.augmentation_elastic_alpha > 0:
+                # Smooth random displacements : random values on a coarse grid, bilinearly upsampled
+                grid_size = params.augmentation_elastic_grid
+                coarse_shape = tf.stack([batch_size, height // grid_size + 2, width // grid_size + 2, 2])
+                displacements = tf.image.resize_bilinear(
+                    tf.random_uniform(coarse_shape, -params.augmentation_elastic_alpha,
+                                      params.augmentation_elastic_alpha), tf.stack([height, width]))
+                x += displacements[:, :, :, 0]
+                y += displacements[:, :, :, 1]
+
+            augmented = _bilinear_sampling(images, x, y, images_widths, means)
+        else:
+            augmented = images
+
+        # Brightness and contrast
+        contrast = uniform(*params.augmentation_contrast_range)
+        brightness = 255 * uniform(-params.augmentation_max_brightness_delta,
+                                   params.augmentation_max_brightness_delta)
+        augmented = (augmented - means[:, None, None, None]) * contrast[:, None, None, None] + \
+            (means + brightness)[:, None, None, None]
+        augmented = tf.clip_by_value(augmented, 0., 255.)
+
+        # The columns beyond the width of each image are kept as they are
+        augmented = augmented * valid_mask + images * (1 - valid_mask)
+        augmented.set_shape(images.get_shape())
+
+        return augmented
+
+
 def padding_inputs_width(image: tf.Tensor, target_shape: Tuple[int, int], increment: int) -> Tuple[
     tf.Tensor, tf.Tensor]:
     target_ratio = target_shape[1] / target_shape[0]
@@ -211,6 +609,22 @@ def padding_inputs_width(image: tf.Tensor, target_shape: Tuple[int, int], increm
     return pad_image, new_w  # new_w = image width used for computing sequence lengths
 
 
+def resizing_inputs_width(image: tf.Tensor, target_shape: Tuple[int, int], increment: int) -> Tuple[
+    tf.Tensor, tf.Tensor]:
+    shape = tf.shape(image)
+    ratio = tf.divide(shape[1], shape[0], name='ratio')
+
+    new_h = target_shape[0]
+    new_w = tf.cast(tf.round((ratio * new_h) / increment) * increment, tf.int32)
+    # At least 2 time steps after the cnn and no wider than the target width
+    new_w = tf.clip_by_value(new_w, 2 * increment, target_shape[1])
+
+    img_resized = resize_image(image, tf.stack([new_h, new_w]))
+    img_resized.set_shape([target_shape[0], None, image.get_shape()[2]])
+
+    return img_resized, new_w
+
+
 def preprocess_image_for_prediction(fixed_height: int = 32, min_width: int = 8):
     def serving_input_fn():
         # define placeholder for input image
@@ -239,3 +653,88 @@ def preprocess_image_for_prediction(fixed_height: int = 32, min_width: int = 8):
         return tf.estimator.export.ServingInputReceiver(features, receiver_inputs)
 
     return serving_input_fn
+
+
+def preprocess_batch_for_prediction(fixed_height: int = 32, min_width: int = 8, num_parallel_calls: int = 8):
+    def serving_input_fn():
+        # define placeholders for a batch of images padded to the biggest height and width
+        # and for the original (height, width) of each image
+        images = tf.placeholder(dtype=tf.float32, shape=[None, None, None, 1])
+        images_sizes = tf.placeholder(dtype=tf.int32, shape=[None, 2])
+
+        def crop_image(image, size):
+            return image[:size[0], :size[1], :]
+
+        dataset = tf.data.Dataset.from_tensor_slices((images, images_sizes)).map(crop_image)
+        resized_images, new_widths = resize_and_pad_batch_for_prediction(dataset, tf.shape(images_sizes)[0],
+                                                                         fixed_height=fixed_height,
+                                                                         min_width=min_width,
+                                                                         num_parallel_calls=num_parallel_calls)
+
+        # Features to serve
+        features = {'images': resized_images,  # n x h x max_w x c
+                    'images_widths': new_widths  # n
+                    }
+
+        # Inputs received
+        receiver_inputs = {'images': images, 'images_sizes': images_sizes}
+
+        return tf.estimator.export.ServingInputReceiver(features, receiver_inputs)
+
+    return serving_input_fn
+
+
+def resize_and_pad_batch_for_prediction(images_dataset: tf.data.Dataset, n_images: tf.Tensor, fixed_height: int,
+                                        min_width: int, num_parallel_calls: int) -> Tuple[tf.Tensor, tf.Tensor]:
+    # Resizes each image of the dataset to the fixed height (keeping its ratio) and pads all of them
+    # to the widest one. Returns the batch of images and the width of each resized image
+    def resize_fn(image):
+        shape = tf.shape(image)
+        ratio = tf.divide(shape[1], shape[0])
+        increment = CONST.DIMENSION_REDUCTION_W_POOLING
+        new_width = tf.cast(tf.round((ratio * fixed_height) / increment) * increment, tf.int32)
+        new_width = tf.maximum(new_width, min_width)
+
+        resized_image = resize_image(image, tf.stack([fixed_height, new_width]))
+        resized_image.set_shape([fixed_height, None, 1])
+
+        return resized_image, new_width
+
+    dataset = images_dataset.map(resize_fn, num_parallel_calls=num_parallel_calls)
+    # One batch with all the images, padded to the widest one
+    dataset = dataset.padded_batch(tf.cast(n_images, tf.int64), padded_shapes=([fixed_height, None, 1], []))
+    resized_images, new_widths = tf.contrib.data.get_single_element(dataset)
+
+    return resized_images, new_widths
+
+
+def preprocess_encoded_images_for_prediction(fixed_height: int = 32, min_width: int = 8,
+                                             num_parallel_calls: int = 8):
+    def serving_input_fn():
+        # define placeholder for a batch of encoded images (jpg or png)
+        encoded_images = tf.placeholder(dtype=tf.string, shape=[None])
+
+        def decode_fn(encoded_image):
+            # Decoding and grayscale conversion are done in the graph
+            image = tf.image.decode_image(encoded_image, channels=1)
+            image.set_shape([None, None, 1])
+            return tf.cast(image, tf.float32)
+
+        dataset = tf.data.Dataset.from_tensor_slices(encoded_images).map(decode_fn,
+                                                                         num_parallel_calls=num_parallel_calls)
+        resized_images, new_widths = resize_and_pad_batch_for_prediction(dataset, tf.shape(encoded_images)[0],
+                                                                         fixed_height=fixed_height,
+                                                                         min_width=min_width,
+                                                                         num_parallel_calls=num_parallel_calls)
+
+        # Features to serve
+        features = {'images': resized_images,  # n x h x max_w x c
+                    'images_widths': new_widths  # n
+                    }
+
+        # Inputs received
+        receiver_inputs = {'encoded_images': encoded_images}
+
+        return tf.estimator.export.ServingInputReceiver(features, receiver_inputs)
+
+    return serving_input_fn
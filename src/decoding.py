@@ -7,21 +7,14 @@ from typing import List
 
 def get_words_from_chars(characters_list: List[str], sequence_lengths: List[int], name='chars_conversion'):
     with tf.name_scope(name=name):
-        def join_characters_fn(coords):
-            return tf.reduce_join(characters_list[coords[0]:coords[1]])
+        sequence_lengths = tf.cast(sequence_lengths, tf.int32)
+        # Place the characters in a [batch, max_length] grid, tf.where gives the positions in row major order
+        # which is the order of the characters in characters_list. Empty sequences give empty rows.
+        # Costs O(batch x max_length) (the grid is padded to the longest word), not O(number of characters)
+        mask = tf.sequence_mask(sequence_lengths)
+        dense_characters = tf.sparse_to_dense(tf.where(mask), tf.shape(mask, out_type=tf.int64), characters_list,
+                                              default_value='')
 
-        def coords_several_sequences():
-            end_coords = tf.cumsum(sequence_lengths)
-            start_coords = tf.concat([[0], end_coords[:-1]], axis=0)
-            coords = tf.stack([start_coords, end_coords], axis=1)
-            coords = tf.cast(coords, dtype=tf.int32)
-            return tf.map_fn(join_characters_fn, coords, dtype=tf.string)
-
-        def coords_single_sequence():
-            return tf.reduce_join(characters_list, keep_dims=True)
-
-        words = tf.cond(tf.shape(sequence_lengths)[0] > 1,
-                        true_fn=lambda: coords_several_sequences(),
-                        false_fn=lambda: coords_single_sequence())
+        words = tf.reduce_join(dense_characters, axis=1)
 
         return words
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+import tensorflow as tf
+from typing import List, Tuple, Union
+from .config import Params
+from .loader import PredictionModel, ImageDecoder
+from .evaluation import read_csv_samples
+from .tfrecord_cache import get_cache_directory, compute_cache_key
+
+TEACHER_LOGITS_FILENAME = 'teacher_logits.f16'
+TEACHER_INFO_FILENAME = 'teacher_info.json'
+
+
+def teacher_cache_directory(csv_filename: Union[str, List[str]], params: Params) -> str:
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+    return get_cache_directory(csv_filenames, params.distillation_cache_dir)
+
+
+def _teacher_cache_key(csv_filenames: List[str], teacher_export_dir: str) -> str:
+    return compute_cache_key(csv_filenames, {'teacher': os.path.abspath(teacher_export_dir)})
+
+
+def is_teacher_cache_valid(teacher_export_dir: str, csv_filename: Union[str, List[str]], params: Params) -> bool:
+    # The cache exists (complete) and was computed by this teacher on these csv files
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+    info_filename = os.path.join(teacher_cache_directory(csv_filenames, params), TEACHER_INFO_FILENAME)
+    if not os.path.isfile(info_filename):
+        return False
+    with open(info_filename, 'r') as f:
+        return json.load(f).get('key') == _teacher_cache_key(csv_filenames, teacher_export_dir)
+
+
+def build_teacher_cache(teacher_export_dir: str, csv_filename: Union[str, List[str]], params: Params,
+                        force: bool = False, batch_size: int = 32) -> str:
+    # Runs the teacher once on the images of the csv files and stores its logits (float16, only the frames
+    # of each image) with an index filename -> (offset, number of frames). Rebuilt when it is stale
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+    cache_dir = teacher_cache_directory(csv_filenames, params)
+    if not force and is_teacher_cache_valid(teacher_export_dir, csv_filenames, params):
+        return cache_dir
+
+    print('Computing the logits of the teacher {} in {}'.format(teacher_export_dir, cache_dir))
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+
+    paths, _ = read_csv_samples(csv_filenames, params.csv_delimiter)
+    paths = sorted(set(paths))
+    index, offset = dict(), 0
+    image_decoder = ImageDecoder()
+    with open(os.path.join(cache_dir, TEACHER_LOGITS_FILENAME), 'wb') as f, tf.Session(graph=tf.Graph()):
+        model = PredictionModel(teacher_export_dir)
+        for i in range(0, len(paths), batch_size):
+            batch_paths = paths[i:i + batch_size]
+            for path, logits in zip(batch_paths, model.predict_logits(batch_paths, image_decoder=image_decoder)):
+                assert logits.shape[1] == params.n_classes, \
+                    'The teacher has {} classes, the student {}'.format(logits.shape[1], params.n_classes)
+                logits.astype(np.float16).tofile(f)
+                index[path] = [offset, logits.shape[0]]
+                offset += logits.shape[0]
+    image_decoder.close()
+
+    # Info written last, an interrupted build is not considered valid
+    with open(os.path.join(cache_dir, TEACHER_INFO_FILENAME), 'w') as f:
+        json.dump({'key': _teacher_cache_key(csv_filenames, teacher_export_dir),
+                   'teacher': os.path.abspath(teacher_export_dir), 'n_frames': offset,
+                   'n_classes': params.n_classes, 'index': index}, f)
+
+    return cache_dir
+
+
+def wait_for_teacher_cache(teacher_export_dir: str, csv_filename: Union[str, List[str]], params: Params,
+                           poll_secs: float = 30) -> str:
+    # In distributed training only the chief builds the cache, the other workers wait until it is complete
+    cache_dir = teacher_cache_directory(csv_filename, params)
+    while not is_teacher_cache_valid(teacher_export_dir, csv_filename, params):
+        print('Waiting for the logits of the teacher in {}'.format(cache_dir))
+        time.sleep(poll_secs)
+    return cache_dir
+
+
+class TeacherLogitsCache:
+    def __init__(self, cache_dir: str):
+        info_filename = os.path.join(cache_dir, TEACHER_INFO_FILENAME)
+        if not os.path.isfile(info_filename):
+            raise FileNotFoundError('No logits of the teacher in {}, compute them with train.py --teacher '
+                                    'or compile_dataset.py --format teacher'.format(cache_dir))
+        with open(info_filename, 'r') as f:
+            info = json.load(f)
+        self.n_classes = info['n_classes']
+        self.index = info['index']
+        self.logits = np.memmap(os.path.join(cache_dir, TEACHER_LOGITS_FILENAME), dtype=np.float16, mode='r',
+                                shape=(info['n_frames'], self.n_classes))
+
+    def lookup(self, filenames: np.ndarray, n_frames: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Time major logits [n_frames, batch, n_classes] (zero padded or cropped) and number of frames of the
+        # teacher for each filename (0 if the file is not in the cache). Used in the graph with tf.py_func
+        logits = np.zeros([n_frames, len(filenames), self.n_classes], dtype=np.float32)
+        lengths = np.zeros([len(filenames)], dtype=np.int32)
+        for i, filename in enumerate(filenames):
+            entry = self.index.get(filename.decode('utf8'))
+            if entry is None:
+                continue
+            offset, length = entry
+            n = min(length, n_frames)
+            logits[:n, i] = self.logits[offset:offset + n]
+            lengths[i] = length
+        return logits, lengths
+
+
+def distillation_loss(student_logits: tf.Tensor, teacher_logits: tf.Tensor, student_lengths: tf.Tensor,
+                      teacher_lengths: tf.Tensor, temperature: float) -> tf.Tensor:
+    # Frame level KL(teacher || student) of the softened distributions of the time major logits, averaged over
+    # the frames of the samples aligned with the teacher (same number of frames, i.e not squeezed nor padded
+    # differently). Scaled by temperature^2 so that its gradients do not depend on the temperature
+    with tf.name_scope('distillation_loss'):
+        teacher_log_prob = tf.nn.log_softmax(teacher_logits / temperature)
+        student_log_prob = tf.nn.log_softmax(student_logits / temperature)
+        kl = tf.reduce_sum(tf.exp(teacher_log_prob) * (teacher_log_prob - student_log_prob), axis=2)  # [time, batch]
+
+        frames = tf.transpose(tf.sequence_mask(student_lengths, maxlen=tf.shape(student_logits)[0]))
+        mask = tf.cast(tf.logical_and(frames, tf.equal(student_lengths, teacher_lengths)[None]), tf.float32)
+        return temperature ** 2 * tf.reduce_sum(kl * mask) / tf.maximum(tf.reduce_sum(mask), 1.0)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+from typing import List, Tuple
+
+
+def configure_cluster(worker_hosts: List[str], ps_hosts: List[str], task_type: str,
+                      task_index: int) -> Tuple[int, int]:
+    # Sets TF_CONFIG for the estimator. The first worker is the chief, the evaluator is not part of the cluster.
+    # Returns the number of workers and the index of the current worker (used to shard the training data)
+    cluster = {'chief': worker_hosts[:1]}
+    if len(worker_hosts) > 1:
+        cluster['worker'] = worker_hosts[1:]
+    if ps_hosts:
+        cluster['ps'] = ps_hosts
+
+    if task_type == 'worker' and task_index == 0:
+        task = {'type': 'chief', 'index': 0}
+    elif task_type == 'worker':
+        task = {'type': 'worker', 'index': task_index - 1}
+    else:
+        task = {'type': task_type, 'index': task_index}
+
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': task})
+
+    worker_index = task_index if task_type == 'worker' else 0
+    return len(worker_hosts), worker_index
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import csv
+import time
+import numpy as np
+from typing import List, Tuple, Union
+from .config import Params
+from .loader import PredictionModel, ImageDecoder
+
+
+def read_csv_samples(csv_filename: Union[str, List[str]], delimiter: str, max_samples: int = None,
+                     encoding: str = 'utf8') -> Tuple[List[str], List[str]]:
+    csv_filenames = csv_filename if isinstance(csv_filename, list) else [csv_filename]
+    paths, labels = list(), list()
+    for filename in csv_filenames:
+        with open(filename, 'r', encoding=encoding) as f:
+            for row in csv.reader(f, delimiter=delimiter):
+                paths.append(row[0])
+                labels.append(row[1])
+    if max_samples:
+        return paths[:max_samples], labels[:max_samples]
+    return paths, labels
+
+
+def edit_distance(hypothesis: str, truth: str) -> int:
+    previous = list(range(len(truth) + 1))
+    for i, h in enumerate(hypothesis, 1):
+        current = [i] + [0] * len(truth)
+        for j, t in enumerate(truth, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (h != t))
+        previous = current
+    return previous[-1]
+
+
+def label_to_decoding_alphabet(label: str, params: Params) -> str:
+    # Same conversion as the labels in crnn_fn (alphabet -> codes -> decoding alphabet)
+    char_to_code = dict(zip(params.alphabet, params.alphabet_codes))
+    code_to_char = dict(zip(params.alphabet_decoding_codes, params.alphabet_decoding))
+    return ''.join(code_to_char.get(char_to_code.get(c), '?') for c in label)
+
+
+def evaluate_predictions(predicted_words: List[str], labels: List[str], params: Params) -> dict:
+    # Same metrics as crnn_fn in EVAL mode : CER (edit distance normalized by the label length) and accuracy
+    target_words = [label_to_decoding_alphabet(label, params) for label in labels]
+    cer = [edit_distance(word, target) / max(len(target), 1) for word, target in zip(predicted_words, target_words)]
+    accuracy = [word == target for word, target in zip(predicted_words, target_words)]
+    return {'CER': float(np.mean(cer)), 'accuracy': float(np.mean(accuracy))}
+
+
+def evaluate_prediction_model(model: PredictionModel, csv_filename: Union[str, List[str]], params: Params,
+                              batch_size: int = 32, max_samples: int = None) -> dict:
+    # Recognition metrics and latency of an exported model on the samples of csv files
+    paths, labels = read_csv_samples(csv_filename, params.csv_delimiter, max_samples=max_samples)
+    image_decoder = ImageDecoder()
+
+    predicted_words, batch_times = list(), list()
+    for i in range(0, len(paths), batch_size):
+        start = time.time()
+        predictions = model.predict_files(paths[i:i + batch_size], image_decoder=image_decoder)
+        batch_times.append(time.time() - start)
+        predicted_words.extend(word.decode('utf8') for word in predictions['words'])
+    image_decoder.close()
+
+    metrics = evaluate_predictions(predicted_words, labels, params)
+    metrics.update({'n_samples': len(paths),
+                    'ms_per_batch': 1000 * float(np.mean(batch_times)),
+                    'ms_per_image': 1000 * float(np.sum(batch_times)) / len(paths),
+                    'images_per_sec': len(paths) / float(np.sum(batch_times))})
+    return metrics
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import sys
+import copy
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from tensorflow.core.protobuf.meta_graph_pb2 import SignatureDef
+from typing import List, Tuple
+
+
+def _node_name(tensor_name: str) -> str:
+    return tensor_name.split(':')[0]
+
+
+def load_frozen_saved_model(export_dir: str, signature_key: str = 'predictions') -> Tuple[
+        tf.GraphDef, SignatureDef, List[str]]:
+    # Loads an exported model and replaces its variables by constants.
+    # The initialization ops of the lookup tables are kept so that the graph can be exported again
+    with tf.Session(graph=tf.Graph()) as sess:
+        meta_graph = tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+        signature_def = meta_graph.signature_def[signature_key]
+
+        init_op_names = [op.name for key in [tf.saved_model.constants.LEGACY_INIT_OP_KEY,
+                                             tf.saved_model.constants.MAIN_OP_KEY]
+                         for op in tf.get_collection(key)]
+        output_node_names = [_node_name(t.name) for t in signature_def.outputs.values()] + init_op_names
+
+        frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph_def, output_node_names)
+
+    return frozen_graph_def, signature_def, init_op_names
+
+
+def transform_frozen_graph(graph_def: tf.GraphDef, signature_def: SignatureDef, init_op_names: List[str],
+                           transforms: List[str]) -> tf.GraphDef:
+    input_node_names = [_node_name(t.name) for t in signature_def.inputs.values()]
+    output_node_names = [_node_name(t.name) for t in signature_def.outputs.values()] + init_op_names
+    return TransformGraph(graph_def, input_node_names, output_node_names, transforms)
+
+
+def save_graph_def_as_saved_model(graph_def: tf.GraphDef, signature_def: SignatureDef, init_op_names: List[str],
+                                  output_dir: str, signature_key: str = 'predictions') -> None:
+    # The tensors keep their names so the signature of the original model is still valid
+    with tf.Session(graph=tf.Graph()) as sess:
+        tf.import_graph_def(graph_def, name='')
+        init_op = tf.group(*[sess.graph.get_operation_by_name(name) for name in init_op_names]) \
+            if init_op_names else None
+
+        builder = tf.saved_model.builder.SavedModelBuilder(output_dir)
+        builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING],
+                                             signature_def_map={signature_key: signature_def},
+                                             legacy_init_op=init_op)
+        builder.save()
+
+
+def directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, filenames in os.walk(directory) for filename in filenames)
+
+
+class RedirectStderr:
+    # Redirects the stderr file descriptor (where the graph logging ops write) to a file
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    def __enter__(self):
+        sys.stderr.flush()
+        self._file = open(self.filename, 'w')
+        self._saved_fd = os.dup(2)
+        os.dup2(self._file.fileno(), 2)
+        return self
+
+    def __exit__(self, *args):
+        sys.stderr.flush()
+        os.dup2(self._saved_fd, 2)
+        os.close(self._saved_fd)
+        self._file.close()
+
+
+def _input_node_name(input_name: str) -> str:
+    # 'scope/op:1' -> 'scope/op', '^scope/op' (control dependency) -> 'scope/op'
+    return _node_name(input_name.lstrip('^'))
+
+
+def _const_value(nodes: dict, name: str) -> np.ndarray:
+    # Value of a constant, following the Identity nodes (variables read in a frozen graph)
+    node = nodes[_input_node_name(name)]
+    while node.op == 'Identity':
+        node = nodes[_input_node_name(node.input[0])]
+    if node.op != 'Const':
+        return None
+    return tf.make_ndarray(node.attr['value'].tensor)
+
+
+def _const_node(name: str, value: np.ndarray) -> tf.NodeDef:
+    node = tf.NodeDef(name=name, op='Const')
+    node.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+    return node
+
+
+def _redirect_inputs(graph_def: tf.GraphDef, old_name: str, new_name: str) -> None:
+    # Consumers of the first output of old_name now read new_name
+    for node in graph_def.node:
+        for i, input_name in enumerate(node.input):
+            if input_name in (old_name, old_name + ':0'):
+                node.input[i] = new_name
+
+
+def fold_batch_norms(graph_def: tf.GraphDef) -> Tuple[tf.GraphDef, List[str]]:
+    # Folds the inference batch norms of the pattern Conv2D -> BiasAdd -> FusedBatchNorm (deep_cnn layers 3, 5, 7)
+    # into the weights and bias of the convolution : W' = W * s, b' = (b - mean) * s + beta, s = gamma / std
+    graph_def = copy.deepcopy(graph_def)
+    nodes = {node.name: node for node in graph_def.node}
+    new_nodes, folded = list(), list()
+
+    for node in list(graph_def.node):
+        if node.op not in ('FusedBatchNorm', 'FusedBatchNormV2'):
+            continue
+        bias_add = nodes[_input_node_name(node.input[0])]
+        if bias_add.op != 'BiasAdd':
+            continue
+        conv = nodes[_input_node_name(bias_add.input[0])]
+        if conv.op != 'Conv2D':
+            continue
+        values = [_const_value(nodes, name) for name in [conv.input[1], bias_add.input[1]] + list(node.input[1:5])]
+        if any(value is None for value in values):
+            continue
+        weights, bias, gamma, beta, mean, variance = values
+
+        scale = gamma / np.sqrt(variance + node.attr['epsilon'].f)
+        folded_weights = _const_node(conv.name + '/folded_weights', (weights * scale).astype(weights.dtype))
+        folded_bias = _const_node(bias_add.name + '/folded_bias', ((bias - mean) * scale + beta).astype(bias.dtype))
+        new_nodes.extend([folded_weights, folded_bias])
+
+        conv.input[1] = folded_weights.name
+        bias_add.input[1] = folded_bias.name
+        _redirect_inputs(graph_def, node.name, bias_add.name)
+        folded.append(node.name)
+
+    graph_def.node.extend(new_nodes)
+    return graph_def, folded
+
+
+def constant_fold_lookup_tables(graph_def: tf.GraphDef) -> Tuple[tf.GraphDef, List[str]]:
+    # Replaces the lookups of int -> string hash tables (code2str_conversion) by a gather in a constant array
+    # of the values indexed by code, so that the tables do not need to be initialized
+    graph_def = copy.deepcopy(graph_def)
+    nodes = {node.name: node for node in graph_def.node}
+    initializers = {_input_node_name(node.input[0]): node for node in graph_def.node
+                    if node.op in ('InitializeTable', 'InitializeTableV2')}
+    new_nodes, replaced = list(), list()
+
+    for node in list(graph_def.node):
+        if node.op not in ('LookupTableFind', 'LookupTableFindV2'):
+            continue
+        table_name = _input_node_name(node.input[0])
+        if table_name not in initializers:
+            continue
+        keys = _const_value(nodes, initializers[table_name].input[1])
+        values = _const_value(nodes, initializers[table_name].input[2])
+        default_value = _const_value(nodes, node.input[2])
+        if keys is None or values is None or default_value is None or not np.issubdtype(keys.dtype, np.integer) \
+                or keys.min() < 0:
+            continue
+
+        dense_values = np.array([default_value.item()] * (int(keys.max()) + 1), dtype=object)
+        dense_values[keys] = values
+        values_node = _const_node(node.name + '/values_by_key', dense_values.astype(values.dtype))
+        new_nodes.append(values_node)
+
+        # The lookup node keeps its name so that its consumers are unchanged
+        name, keys_input, keys_dtype, values_dtype = node.name, node.input[1], node.attr['Tin'].type, \
+            node.attr['Tout'].type
+        node.Clear()
+        node.name, node.op = name, 'Gather'
+        node.input.extend([values_node.name, keys_input])
+        node.attr['Tparams'].type = values_dtype
+        node.attr['Tindices'].type = keys_dtype
+        node.attr['validate_indices'].b = True
+        replaced.append(name)
+
+    graph_def.node.extend(new_nodes)
+    return graph_def, replaced
+
+
+def prune_graph(graph_def: tf.GraphDef, signature_def: SignatureDef, init_op_names: List[str]) -> Tuple[
+        tf.GraphDef, List[str]]:
+    # Keeps the nodes needed by the outputs. The initialization ops are dropped if no lookup table is left
+    output_node_names = [_node_name(t.name) for t in signature_def.outputs.values()]
+    pruned_graph_def = tf.graph_util.extract_sub_graph(graph_def, output_node_names)
+    if any(node.op.startswith('LookupTableFind') for node in pruned_graph_def.node):
+        return tf.graph_util.extract_sub_graph(graph_def, output_node_names + init_op_names), init_op_names
+    return pruned_graph_def, []
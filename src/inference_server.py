@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import math
+import time
+import json
+import asyncio
+import numpy as np
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from .loader import PredictionModel, ImageDecoder
+
+
+class _Request:
+    __slots__ = ['image', 'future', 'arrival_time']
+
+    def __init__(self, image: np.ndarray, future: asyncio.Future):
+        self.image = image
+        self.future = future
+        self.arrival_time = time.time()
+
+
+class LatencyStats:
+    def __init__(self, window: int = 10000):
+        # Latencies and batch sizes of the last requests / batches
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests = 0
+        self.start_time = time.time()
+
+    def add_batch(self, latencies: List[float]) -> None:
+        self.latencies.extend(latencies)
+        self.batch_sizes.append(len(latencies))
+        self.n_requests += len(latencies)
+
+    def report(self) -> dict:
+        latencies = np.array(self.latencies) if self.latencies else np.zeros([1])
+        return {'n_requests': self.n_requests,
+                'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+                'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                'images_per_sec': self.n_requests / (time.time() - self.start_time)}
+
+
+class MicroBatcher:
+    # Collects concurrent requests in batches of images of similar widths, bounded by max_batch_size and
+    # max_wait_ms (time waited by the oldest request of a batch), and runs each batch in one session call.
+    # Needs a model exported with the batch receiver (export_model.py --receiver batch)
+    def __init__(self, model: PredictionModel, max_batch_size: int = 32, max_wait_ms: float = 10.0,
+                 width_bucket_ratio: float = 1.5, n_decoding_threads: int = 4):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # Images whose widths are within a factor width_bucket_ratio are in the same bucket
+        self._log_ratio = math.log(width_bucket_ratio)
+        self.stats = LatencyStats()
+
+        self._image_decoder = ImageDecoder()
+        self._decoding_executor = ThreadPoolExecutor(max_workers=n_decoding_threads)
+        # One batch at a time in the model, the batches build up meanwhile
+        self._model_executor = ThreadPoolExecutor(max_workers=1)
+        self._buckets = defaultdict(list)
+        self._new_request = None
+        self._task = None
+
+    def start(self) -> None:
+        self._new_request = asyncio.Event()
+        self._task = asyncio.ensure_future(self._batching_loop())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self._decoding_executor.shutdown()
+        self._model_executor.shutdown()
+        self._image_decoder.close()
+
+    def _bucket(self, width: int) -> int:
+        return int(math.log(max(width, 1)) / self._log_ratio)
+
+    async def predict_encoded(self, encoded_image: bytes) -> dict:
+        loop = asyncio.get_event_loop()
+        image = await loop.run_in_executor(self._decoding_executor, self._image_decoder.decode, encoded_image)
+        return await self.predict(image)
+
+    async def predict(self, image: np.ndarray) -> dict:
+        future = asyncio.get_event_loop().create_future()
+        request = _Request(image if image.ndim == 3 else image[:, :, None], future)
+        self._buckets[self._bucket(request.image.shape[1])].append(request)
+        self._new_request.set()
+        return await future
+
+    def _pop_ready_batch(self) -> List[_Request]:
+        # A full batch, otherwise the oldest batch whose first request has waited max_wait (None if there is none)
+        for bucket, requests in self._buckets.items():
+            if len(requests) >= self.max_batch_size:
+                return self._pop_batch(bucket)
+        if self._buckets:
+            bucket = min(self._buckets, key=lambda b: self._buckets[b][0].arrival_time)
+            if time.time() - self._buckets[bucket][0].arrival_time >= self.max_wait:
+                return self._pop_batch(bucket)
+        return None
+
+    def _pop_batch(self, bucket: int) -> List[_Request]:
+        requests = self._buckets[bucket]
+        batch = requests[:self.max_batch_size]
+        del requests[:self.max_batch_size]
+        if not requests:
+            del self._buckets[bucket]
+        return batch
+
+    def _next_deadline(self) -> float:
+        if not self._buckets:
+            return None
+        return min(requests[0].arrival_time for requests in self._buckets.values()) + self.max_wait
+
+    async def _batching_loop(self) -> None:
+        while True:
+            deadline = self._next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            try:
+                await asyncio.wait_for(self._new_request.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._new_request.clear()
+
+            # A batch is only taken once the model is free, the requests arriving during a run join the buckets
+            # (bigger batches under load)
+            batch = self._pop_ready_batch()
+            while batch is not None:
+                try:
+                    await self._run_batch(batch)
+                except Exception as e:
+                    # The loop serves all the requests, an error of a batch must not stop it
+                    print('Batch of {} requests failed : {!r}'.format(len(batch), e))
+                batch = self._pop_ready_batch()
+
+    async def _run_batch(self, batch: List[_Request]) -> None:
+        # Requests already done (e.g cancelled with their handler) are not run nor answered
+        batch = [request for request in batch if not request.future.done()]
+        if not batch:
+            return
+
+        loop = asyncio.get_event_loop()
+        try:
+            predictions = await loop.run_in_executor(self._model_executor, self.model.predict_batch,
+                                                     [request.image for request in batch])
+            end_time = time.time()
+            results = [{'word': predictions['words'][i].decode('utf8'),
+                        'score': float(np.ravel(predictions['score'][i])[0])} for i in range(len(batch))]
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        for request, result in zip(batch, results):
+            if not request.future.done():
+                request.future.set_result(result)
+        self.stats.add_batch([end_time - request.arrival_time for request in batch])
+
+
+class InferenceServer:
+    # Minimal HTTP/1.1 server (TCP or Unix socket) :
+    #   POST /predict with the content of a jpg/png image -> {"word": ..., "score": ...}
+    #   GET /stats -> latency percentiles, throughput and mean batch size
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode('latin1').split(' ', 2)
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, path, headers, body
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: str, content: dict) -> None:
+        body = json.dumps(content).encode('utf8')
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+            status, len(body)).encode('latin1') + body)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Keep-alive connections : requests are read until the client closes the connection
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, _, body = request
+                if method == 'POST' and path == '/predict':
+                    try:
+                        self._write_response(writer, '200 OK', await self.batcher.predict_encoded(body))
+                    except Exception as e:
+                        self._write_response(writer, '500 Internal Server Error', {'error': str(e)})
+                elif method == 'GET' and path == '/stats':
+                    self._write_response(writer, '200 OK', self.batcher.stats.report())
+                else:
+                    self._write_response(writer, '404 Not Found', {'error': 'Unknown path {}'.format(path)})
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = 'localhost', port: int = 8080, unix_socket: str = None):
+        self.batcher.start()
+        if unix_socket:
+            return await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        return await asyncio.start_server(self.handle_connection, host=host, port=port)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import math
+import numpy as np
+from collections import defaultdict, Counter
+from multiprocessing import Pool
+from typing import List, Tuple, Iterable
+from .config import Params
+
+NEG_INF = -float('inf')
+
+
+def _log_add(a: float, b: float) -> float:
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
+
+
+def _log_softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+class PrefixTrie:
+    def __init__(self, words: Iterable[str]):
+        # Characters allowed after each prefix and set of complete words
+        self.children = defaultdict(set)
+        self.words = set()
+        for word in words:
+            for i in range(len(word)):
+                self.children[word[:i]].add(word[i])
+            self.words.add(word)
+
+    def is_prefix(self, text: str) -> bool:
+        return text in self.words or text in self.children
+
+    def is_word(self, text: str) -> bool:
+        return text in self.words
+
+
+class CharNgramLM:
+    BOS = '\x02'
+    EOS = '\x03'
+
+    def __init__(self, order: int = 3, smoothing: float = 0.1):
+        assert order >= 1, 'Order must be >= 1'
+        self.order = order
+        self.smoothing = smoothing
+        self.counts = defaultdict(Counter)
+        self.vocabulary = {self.EOS}
+        self._cache = dict()
+
+    @classmethod
+    def from_file(cls, filename: str, order: int = 3, smoothing: float = 0.1, encoding: str = 'utf8'):
+        lm = cls(order=order, smoothing=smoothing)
+        with open(filename, 'r', encoding=encoding) as f:
+            lm.train(line.strip() for line in f if line.strip())
+        return lm
+
+    def train(self, texts: Iterable[str]) -> None:
+        for text in texts:
+            padded = self.BOS * (self.order - 1) + text + self.EOS
+            for i in range(self.order - 1, len(padded)):
+                self.counts[padded[i - self.order + 1:i]][padded[i]] += 1
+                self.vocabulary.add(padded[i])
+        self._cache = dict()
+
+    def _context(self, text: str) -> str:
+        if self.order == 1:
+            return ''
+        return (self.BOS * (self.order - 1) + text)[-(self.order - 1):]
+
+    def log_prob(self, text: str, char: str) -> float:
+        # Log probability of char following text (add-k smoothing), cached by context
+        key = (self._context(text), char)
+        if key not in self._cache:
+            counter = self.counts.get(key[0], Counter())
+            total = sum(counter.values())
+            self._cache[key] = math.log((counter[char] + self.smoothing) /
+                                        (total + self.smoothing * len(self.vocabulary)))
+        return self._cache[key]
+
+    def end_log_prob(self, text: str) -> float:
+        return self.log_prob(text, self.EOS)
+
+
+def load_lexicon(filename: str, encoding: str = 'utf8') -> List[str]:
+    with open(filename, 'r', encoding=encoding) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class CTCLexiconDecoder:
+    def __init__(self, params: Params, lexicon: List[str] = None, lm: CharNgramLM = None, beam_width: int = 25,
+                 lm_weight: float = 0.5, insertion_bonus: float = 0.0, min_log_prob: float = -12.0):
+        # Codes of the network outputs are mapped to the decoding alphabet, blank is the last class
+        self.code_to_char = dict(zip(params.alphabet_decoding_codes, params.alphabet_decoding))
+        self.blank = params.n_classes - 1
+        self.trie = PrefixTrie(lexicon) if lexicon is not None else None
+        self.lm = lm
+        self.beam_width = beam_width
+        self.lm_weight = lm_weight
+        self.insertion_bonus = insertion_bonus
+        # Classes with a lower log probability at a time step are not considered for extension
+        self.min_log_prob = min_log_prob
+        self._extension_cache = dict()
+        self._pool = None
+        self._pool_n_processes = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'], state['_pool_n_processes'] = None, None
+        return state
+
+    def _extension_score(self, text: str) -> float:
+        # Score added when the last character of text is appended (None if text is not allowed by the lexicon).
+        # Cached by prefix since the same prefixes are extended at each time step
+        if text not in self._extension_cache:
+            if self.trie is not None and not self.trie.is_prefix(text):
+                score = None
+            else:
+                score = self.insertion_bonus
+                if self.lm is not None:
+                    score += self.lm_weight * self.lm.log_prob(text[:-1], text[-1])
+            self._extension_cache[text] = score
+        return self._extension_cache[text]
+
+    def _final_score(self, text: str) -> float:
+        if self.trie is not None and not self.trie.is_word(text):
+            return None
+        return self.lm_weight * self.lm.end_log_prob(text) if self.lm is not None else 0.0
+
+    def _text(self, prefix: Tuple[int, ...]) -> str:
+        return ''.join(self.code_to_char.get(code, '?') for code in prefix)
+
+    def decode(self, logits: np.ndarray, sequence_length: int = None) -> Tuple[str, float]:
+        # CTC prefix beam search on the logits [time, n_classes] of one sequence.
+        # Each beam holds the log probabilities of the prefix ending with a blank and with a character
+        log_probs = _log_softmax(logits[:sequence_length] if sequence_length is not None else logits)
+
+        beams = {(): (0.0, NEG_INF, 0.0)}  # prefix -> (log p blank, log p non blank, lexicon/lm score)
+        for t in range(log_probs.shape[0]):
+            frame = log_probs[t]
+            candidates = [c for c in np.flatnonzero(frame > self.min_log_prob) if c != self.blank]
+            next_beams = defaultdict(lambda: [NEG_INF, NEG_INF, 0.0])
+
+            for prefix, (p_b, p_nb, ext_score) in beams.items():
+                p_total = _log_add(p_b, p_nb)
+
+                # Blank : the prefix stays the same
+                beam = next_beams[prefix]
+                beam[0] = _log_add(beam[0], p_total + frame[self.blank])
+                beam[2] = ext_score
+
+                last = prefix[-1] if prefix else None
+                for c in candidates:
+                    if c == last:
+                        # Repeated character without blank is merged in the same prefix
+                        beam[1] = _log_add(beam[1], p_nb + frame[c])
+
+                    new_prefix = prefix + (int(c),)
+                    score = self._extension_score(self._text(new_prefix))
+                    if score is None:
+                        continue
+                    new_beam = next_beams[new_prefix]
+                    # A repeated character needs a blank in between to be a new character
+                    p_from = p_b if c == last else p_total
+                    new_beam[1] = _log_add(new_beam[1], p_from + frame[c])
+                    new_beam[2] = ext_score + score
+
+            ranked = sorted(next_beams.items(), key=lambda item: _log_add(item[1][0], item[1][1]) + item[1][2],
+                            reverse=True)
+            beams = {prefix: tuple(values) for prefix, values in ranked[:self.beam_width]}
+
+        best_text, best_score = None, NEG_INF
+        for prefix, (p_b, p_nb, ext_score) in beams.items():
+            text = self._text(prefix)
+            final_score = self._final_score(text)
+            if final_score is None:
+                continue
+            score = _log_add(p_b, p_nb) + ext_score + final_score
+            if score > best_score:
+                best_text, best_score = text, score
+
+        if best_text is None:
+            # No complete word of the lexicon in the beams, keep the best prefix
+            prefix, (p_b, p_nb, ext_score) = max(beams.items(), key=lambda item: _log_add(item[1][0], item[1][1]))
+            best_text, best_score = self._text(prefix), _log_add(p_b, p_nb) + ext_score
+
+        return best_text, float(best_score)
+
+    def decode_batch(self, prob: np.ndarray, sequence_lengths: List[int] = None,
+                     n_processes: int = None) -> Tuple[List[str], np.ndarray]:
+        # prob is the time major output of the model [time, batch, n_classes]
+        n_sequences = prob.shape[1]
+        if sequence_lengths is None:
+            sequence_lengths = [prob.shape[0]] * n_sequences
+        sequences = [(prob[:, i, :], int(sequence_lengths[i])) for i in range(n_sequences)]
+
+        if n_processes == 1:
+            results = [self.decode(logits, length) for logits, length in sequences]
+        else:
+            n_processes = n_processes or os.cpu_count()
+            if self._pool is not None and self._pool_n_processes != n_processes:
+                self.close()
+            if self._pool is None:
+                self._pool = Pool(processes=n_processes, initializer=_init_worker, initargs=(self,))
+                self._pool_n_processes = n_processes
+            chunksize = max(1, n_sequences // (4 * n_processes))
+            results = self._pool.map(_decode_worker, sequences, chunksize=chunksize)
+
+        words = [word for word, _ in results]
+        scores = np.array([score for _, score in results], dtype=np.float32)
+        return words, scores
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool, self._pool_n_processes = None, None
+
+
+_worker_decoder = None
+
+
+def _init_worker(decoder: CTCLexiconDecoder) -> None:
+    global _worker_decoder
+    _worker_decoder = decoder
+
+
+def _decode_worker(sequence: Tuple[np.ndarray, int]) -> Tuple[str, float]:
+    return _worker_decoder.decode(*sequence)
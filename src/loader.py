@@ -2,6 +2,8 @@
 __author__ = 'solivr'
 
 import tensorflow as tf
+import numpy as np
+from typing import List
 
 
 class PredictionModel:
@@ -11,10 +13,115 @@ class PredictionModel:
 
         self._input_dict, self._output_dict = _signature_def_to_tensors(self.model.signature_def['predictions'])
 
+    @property
+    def input_names(self) -> List[str]:
+        # Inputs of the serving signature : 'images' (and 'images_sizes' for the batch receiver) or 'encoded_images'
+        return list(self._input_dict.keys())
+
     def predict(self, image, ):
         output = self._output_dict
         return self.session.run(output, feed_dict={self._input_dict['images']: image})
 
+    def predict_batch(self, images: List[np.ndarray]):
+        # Needs a model exported with the batch receiver (preprocess_batch_for_prediction)
+        assert 'images_sizes' in self._input_dict, \
+            'The model was not exported with a batch serving signature (export_model.py --receiver batch)'
+
+        if len(images) == 0:
+            return self._empty_outputs()
+
+        images = [image[:, :, None] if image.ndim == 2 else image for image in images]
+        images_sizes = np.array([image.shape[:2] for image in images], dtype=np.int32)
+
+        # Pad all the images to the biggest height and width, the padding is removed in the graph
+        batch = np.zeros([len(images), images_sizes[:, 0].max(), images_sizes[:, 1].max(), 1], dtype=np.float32)
+        for i, image in enumerate(images):
+            batch[i, :image.shape[0], :image.shape[1]] = image
+
+        output = self._output_dict
+        return self.session.run(output, feed_dict={self._input_dict['images']: batch,
+                                                   self._input_dict['images_sizes']: images_sizes})
+
+    def predict_encoded_batch(self, encoded_images: List[bytes]):
+        # Needs a model exported with the encoded images receiver (preprocess_encoded_images_for_prediction)
+        assert 'encoded_images' in self._input_dict, \
+            'The model was not exported with an encoded images signature (export_model.py --receiver encoded)'
+
+        if len(encoded_images) == 0:
+            return self._empty_outputs()
+
+        output = self._output_dict
+        return self.session.run(output, feed_dict={self._input_dict['encoded_images']: encoded_images})
+
+    def _empty_outputs(self) -> dict:
+        # Outputs of an empty batch : arrays of the output types where the unknown dimensions are 0
+        outputs = dict()
+        for key, tensor in self._output_dict.items():
+            shape = [d if d is not None else 0 for d in tensor.shape.as_list()] \
+                if tensor.shape.ndims is not None else [0]
+            outputs[key] = np.zeros(shape, dtype=object if tensor.dtype == tf.string else tensor.dtype.as_numpy_dtype)
+        return outputs
+
+    def predict_files(self, filenames: List[str], image_decoder=None):
+        # Works with any of the serving signatures, returns at least the 'words' and 'score' of each file
+        encoded_images = list()
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                encoded_images.append(f.read())
+
+        if 'encoded_images' in self._input_dict:
+            return self.predict_encoded_batch(encoded_images)
+
+        if image_decoder is None:
+            image_decoder = ImageDecoder()
+        images = [image_decoder.decode(encoded_image) for encoded_image in encoded_images]
+
+        if 'images_sizes' in self._input_dict:
+            return self.predict_batch(images)
+
+        if len(images) == 0:
+            empty_outputs = self._empty_outputs()
+            return {'words': empty_outputs['words'], 'score': empty_outputs['score']}
+
+        outputs = [self.predict(image) for image in images]
+        return {'words': np.concatenate([output['words'] for output in outputs]),
+                'score': np.concatenate([output['score'] for output in outputs])}
+
+    def predict_logits(self, filenames: List[str], image_decoder=None) -> List[np.ndarray]:
+        # Logits [time, n_classes] of each file, restricted to the frames of the image
+        assert 'prob' in self._output_dict and 'sequence_lengths' in self._output_dict, \
+            "The model does not output its logits ('prob') and their 'sequence_lengths'"
+
+        if 'encoded_images' in self._input_dict or 'images_sizes' in self._input_dict:
+            outputs = [self.predict_files(filenames, image_decoder=image_decoder)]
+        else:
+            if image_decoder is None:
+                image_decoder = ImageDecoder()
+            outputs = [self.predict(image_decoder.decode_file(filename)) for filename in filenames]
+
+        return [output['prob'][:length, i] for output in outputs for i, length in enumerate(output['sequence_lengths'])]
+
+
+class ImageDecoder:
+    # Decodes jpg/png images to grayscale float arrays [H, W, 1] in a separate graph (thread safe)
+    def __init__(self):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._encoded_image = tf.placeholder(dtype=tf.string, shape=[])
+            image = tf.image.decode_image(self._encoded_image, channels=1)
+            self._image = tf.cast(image, tf.float32)
+        self.session = tf.Session(graph=self.graph)
+
+    def decode(self, encoded_image: bytes) -> np.ndarray:
+        return self.session.run(self._image, feed_dict={self._encoded_image: encoded_image})
+
+    def decode_file(self, filename: str) -> np.ndarray:
+        with open(filename, 'rb') as f:
+            return self.decode(f.read())
+
+    def close(self) -> None:
+        self.session.close()
+
 
 def _signature_def_to_tensors(signature_def):
     g = tf.get_default_graph()
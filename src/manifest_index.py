@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import csv
+import json
+import struct
+import tempfile
+import numpy as np
+from collections import Counter
+from multiprocessing import Pool
+from typing import List, Tuple, Iterator, Callable, IO
+from .config import Params, CONST
+from .tfrecord_cache import get_cache_directory, compute_cache_key
+
+INDEX_FILENAME = 'manifest_index.npy'
+INDEX_INFO_FILENAME = 'index_info.json'
+FILTERED_CSV_FILENAME = 'filtered.csv'
+
+# One record per sample (20 bytes). Height and width are 0 when the image header could not be read
+INDEX_DTYPE = np.dtype([('file_index', np.uint16),
+                        ('offset', np.uint64),
+                        ('height', np.uint16),
+                        ('width', np.uint16),
+                        ('resized_width', np.uint16),
+                        ('label_length', np.uint16),
+                        ('n_out_of_alphabet', np.uint16)])
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_image_size(filename: str) -> Tuple[int, int]:
+    # (height, width) read from the png or jpeg header without decoding the image, (0, 0) if it fails
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(26)
+            if header[:8] == b'\x89PNG\r\n\x1a\n':
+                width, height = struct.unpack('>II', header[16:24])
+                return height, width
+            if header[:2] == b'\xff\xd8':
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return 0, 0
+                    if marker[1] in _JPEG_SOF_MARKERS:
+                        _, _, height, width = struct.unpack('>HBHH', f.read(7))  # length, precision, h, w
+                        return height, width
+                    segment_length = struct.unpack('>H', f.read(2))[0]
+                    f.seek(segment_length - 2, 1)
+    except (IOError, struct.error):
+        pass
+    return 0, 0
+
+
+def resized_image_width(height: int, width: int, input_shape: Tuple[int, int], resize_width: bool = False) -> int:
+    # Width of the image given to the network (same computation as padding_inputs_width / resizing_inputs_width)
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    if height == 0:
+        return 0
+    new_w = int(round(width / height * input_shape[0] / increment) * increment)
+    if resize_width:
+        return min(max(new_w, 2 * increment), input_shape[1])
+    if new_w <= 0:
+        new_w = input_shape[0]
+    return min(new_w, input_shape[1])
+
+
+def _atomic_write(filename: str, write: Callable[[IO], None]) -> None:
+    # Written to a unique temporary file then renamed : the workers building the same file concurrently never
+    # read a partially written file
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def _iter_csv_lines(csv_filenames: List[str]) -> Iterator[Tuple[int, int, bytes]]:
+    # (file index, byte offset, line) of the non empty lines
+    for file_index, filename in enumerate(csv_filenames):
+        with open(filename, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    yield file_index, offset, line
+                offset += len(line)
+
+
+def _chunks(iterator: Iterator, chunk_size: int) -> Iterator[list]:
+    chunk = list()
+    for item in iterator:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def _index_lines(args) -> Tuple[np.ndarray, Counter]:
+    lines, delimiter, alphabet, input_shape, resize_width = args
+    records = np.zeros(len(lines), dtype=INDEX_DTYPE)
+    out_of_alphabet = Counter()
+    for i, (file_index, offset, line) in enumerate(lines):
+        row = next(csv.reader([line.decode('utf8').rstrip('\r\n')], delimiter=delimiter))
+        path, label = row[0], row[1] if len(row) > 1 else ''
+        height, width = read_image_size(path)
+        unknown_chars = [c for c in label if c not in alphabet]
+        out_of_alphabet.update(unknown_chars)
+        records[i] = (file_index, offset, min(height, 65535), min(width, 65535),
+                      resized_image_width(height, width, input_shape, resize_width),
+                      min(len(label), 65535), len(unknown_chars))
+    return records, out_of_alphabet
+
+
+class ManifestIndex:
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, INDEX_INFO_FILENAME), 'r') as f:
+            self.info = json.load(f)
+        self.records = np.load(os.path.join(index_dir, INDEX_FILENAME), mmap_mode='r')
+
+    @property
+    def n_samples(self) -> int:
+        return len(self.records)
+
+    @property
+    def csv_filenames(self) -> List[str]:
+        return self.info['csv_filenames']
+
+    def sequence_lengths(self) -> np.ndarray:
+        # Length of the sequence seen by the ctc loss (seq_len_inputs in crnn_fn)
+        return self.records['resized_width'].astype(np.int32) // CONST.DIMENSION_REDUCTION_W_POOLING - 1
+
+    def valid_mask(self) -> np.ndarray:
+        # Readable images with a non empty label of known characters not longer than the ctc sequence
+        return (self.records['height'] > 0) & (self.records['label_length'] > 0) & \
+               (self.records['n_out_of_alphabet'] == 0) & (self.records['label_length'] <= self.sequence_lengths())
+
+    def summary(self) -> dict:
+        valid = self.valid_mask()
+        readable = self.records['height'] > 0
+        return {'n_samples': self.n_samples,
+                'n_valid': int(valid.sum()),
+                'n_unreadable': int((~readable).sum()),
+                'n_out_of_alphabet': int((self.records['n_out_of_alphabet'] > 0).sum()),
+                'n_label_too_long': int((readable & (self.records['label_length'] > self.sequence_lengths())).sum()),
+                'out_of_alphabet_chars': self.info['out_of_alphabet_chars']}
+
+    def write_csv(self, output_filename: str, mask: np.ndarray) -> None:
+        # Copies the lines of the selected samples (original format) without parsing the csv files again
+        def write(output_file):
+            for record in self.records[mask]:
+                f = handles[record['file_index']]
+                f.seek(int(record['offset']))
+                line = f.readline()
+                output_file.write(line if line.endswith(b'\n') else line + b'\n')
+
+        handles = [open(filename, 'rb') for filename in self.csv_filenames]
+        try:
+            _atomic_write(output_filename, write)
+        finally:
+            for f in handles:
+                f.close()
+
+
+def build_manifest_index(csv_filenames: List[str], params: Params, force: bool = False,
+                         n_processes: int = None, chunk_size: int = 4096) -> ManifestIndex:
+    # Scans the csv files and the image headers in parallel once, the index is rebuilt when it is stale
+    index_dir = get_cache_directory(csv_filenames, params.manifest_index_dir)
+    preprocessing = {'input_shape': list(params.input_shape), 'alphabet': params.alphabet,
+                     'csv_delimiter': params.csv_delimiter, 'bucket_by_width': params.bucket_by_width}
+    index_key = compute_cache_key(csv_filenames, preprocessing)
+
+    info_filename = os.path.join(index_dir, INDEX_INFO_FILENAME)
+    if not force and os.path.isfile(info_filename):
+        with open(info_filename, 'r') as f:
+            if json.load(f).get('key') == index_key:
+                return ManifestIndex(index_dir)
+
+    print('Building manifest index {} for {}'.format(index_dir, csv_filenames))
+    os.makedirs(index_dir, exist_ok=True)
+
+    tasks = ((lines, params.csv_delimiter, params.alphabet, tuple(params.input_shape), params.bucket_by_width)
+             for lines in _chunks(_iter_csv_lines(csv_filenames), chunk_size))
+    records, out_of_alphabet = [np.zeros(0, dtype=INDEX_DTYPE)], Counter()
+    with Pool(processes=n_processes) as pool:
+        for chunk_records, chunk_out_of_alphabet in pool.imap(_index_lines, tasks):
+            records.append(chunk_records)
+            out_of_alphabet.update(chunk_out_of_alphabet)
+
+    records = np.concatenate(records)
+    _atomic_write(os.path.join(index_dir, INDEX_FILENAME), lambda f: np.save(f, records))
+    # Info written last, an interrupted build is not considered valid
+    info = {'key': index_key,
+            'csv_filenames': [os.path.abspath(filename) for filename in csv_filenames],
+            'out_of_alphabet_chars': dict(out_of_alphabet.most_common())}
+    _atomic_write(info_filename, lambda f: f.write(json.dumps(info).encode('utf8')))
+
+    return ManifestIndex(index_dir)
+
+
+def filter_csv_files(csv_filenames: List[str], params: Params) -> Tuple[List[str], int]:
+    # Csv file with the valid samples only (see ManifestIndex.valid_mask) and its number of samples
+    index = build_manifest_index(csv_filenames, params)
+    filtered_filename = os.path.join(index.index_dir, FILTERED_CSV_FILENAME)
+    valid = index.valid_mask()
+    if not os.path.isfile(filtered_filename) or \
+            os.path.getmtime(filtered_filename) < os.path.getmtime(os.path.join(index.index_dir, INDEX_FILENAME)):
+        index.write_csv(filtered_filename, valid)
+    return [filtered_filename], int(valid.sum())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import shutil
+import numpy as np
+from tqdm import tqdm
+from typing import List, Tuple, Iterable
+
+STORE_INFO_FILENAME = 'store_info.json'
+IMAGES_FILENAME = 'images.uint8'
+WIDTHS_FILENAME = 'widths.npy'
+LABELS_FILENAME = 'labels'
+FILENAMES_FILENAME = 'filenames'
+
+
+def count_csv_samples(csv_filenames: List[str]) -> int:
+    n_samples = 0
+    for filename in csv_filenames:
+        with open(filename, 'r', encoding='utf8') as f:
+            n_samples += sum(1 for line in f if line.strip())
+    return n_samples
+
+
+def _write_offset_blob(values: List[bytes], basename: str) -> None:
+    # Variable length strings are concatenated in one blob, string i is blob[offsets[i]:offsets[i+1]]
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in values])
+    np.save('{}_offsets.npy'.format(basename), offsets)
+    with open('{}.bin'.format(basename), 'wb') as f:
+        for v in values:
+            f.write(v)
+
+
+class OffsetBlob:
+    def __init__(self, basename: str):
+        self.offsets = np.load('{}_offsets.npy'.format(basename), mmap_mode='r')
+        if self.offsets[-1] > 0:
+            self.blob = np.memmap('{}.bin'.format(basename), dtype=np.uint8, mode='r')
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> bytes:
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+    def take(self, indices: np.ndarray) -> np.ndarray:
+        return np.array([self[i] for i in indices], dtype=object)
+
+
+def load_store_info(store_dir: str) -> dict:
+    info_filename = os.path.join(store_dir, STORE_INFO_FILENAME)
+    if not os.path.isfile(info_filename):
+        return None
+    with open(info_filename, 'r') as f:
+        return json.load(f)
+
+
+def is_store_valid(store_dir: str, store_key: str) -> bool:
+    store_info = load_store_info(store_dir)
+    return store_info is not None and store_info.get('key') == store_key
+
+
+def write_memmap_store(samples: Iterable[Tuple], n_samples: int, store_dir: str, store_key: str,
+                       input_shape: Tuple[int, int], seed: int = 0) -> int:
+    # samples yields (uint8 image [H, W, 1], image width, label, filename) as given by decoded_samples_generator
+    # with padded images. The samples are written in a random order so that the contiguous shards of the workers
+    # are random subsets of the samples
+    if os.path.isdir(store_dir):
+        # Stale store
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir)
+
+    images = np.memmap(os.path.join(store_dir, IMAGES_FILENAME), dtype=np.uint8, mode='w+',
+                       shape=(n_samples, input_shape[0], input_shape[1], 1))
+    widths = np.zeros(n_samples, dtype=np.int32)
+    labels = [b''] * n_samples
+    filenames = [b''] * n_samples
+
+    positions = np.random.RandomState(seed).permutation(n_samples)
+    n_written = 0
+    for image, img_width, label, filename in tqdm(samples, total=n_samples, desc='Building memmap store'):
+        position = positions[n_written]
+        images[position] = image
+        widths[position] = img_width
+        labels[position] = label
+        filenames[position] = filename
+        n_written += 1
+
+    assert n_written == n_samples, 'Expected {} samples, {} were decoded'.format(n_samples, n_written)
+
+    images.flush()
+    del images
+    np.save(os.path.join(store_dir, WIDTHS_FILENAME), widths)
+    _write_offset_blob(labels, os.path.join(store_dir, LABELS_FILENAME))
+    _write_offset_blob(filenames, os.path.join(store_dir, FILENAMES_FILENAME))
+
+    # Writing the info file last marks the store as complete
+    store_info = {'key': store_key,
+                  'n_samples': n_samples,
+                  'input_shape': list(input_shape)}
+    with open(os.path.join(store_dir, STORE_INFO_FILENAME), 'w') as f:
+        json.dump(store_info, f)
+
+    return n_samples
+
+
+class MemmapStore:
+    def __init__(self, store_dir: str):
+        store_info = load_store_info(store_dir)
+        assert store_info is not None, 'No memmap store found in {}'.format(store_dir)
+
+        self.n_samples = store_info['n_samples']
+        self.input_shape = tuple(store_info['input_shape'])
+        # Read-only mappings : the pages are shared between all the processes reading the store
+        self.images = np.memmap(os.path.join(store_dir, IMAGES_FILENAME), dtype=np.uint8, mode='r',
+                                shape=(self.n_samples, self.input_shape[0], self.input_shape[1], 1))
+        self.widths = np.load(os.path.join(store_dir, WIDTHS_FILENAME), mmap_mode='r')
+        self.labels = OffsetBlob(os.path.join(store_dir, LABELS_FILENAME))
+        self.filenames = OffsetBlob(os.path.join(store_dir, FILENAMES_FILENAME))
+
+    def get_batch(self, indices: np.ndarray) -> dict:
+        # Rows of the memmaps at the given sorted indices (read in the order of the file). The batch is copied
+        # from the page cache, and copied again by tf.data.Dataset.from_generator
+        return {'images': self.images[indices],
+                'images_widths': self.widths[indices],
+                'filenames': self.filenames.take(indices),
+                'labels': self.labels.take(indices)}
+
+    def batch_generator(self, batch_size: int, num_epochs: int = None, seed: int = None, shard_index: int = 0,
+                        num_shards: int = 1):
+        # Each shard is a contiguous range of samples (the samples are stored in a random order). The samples of
+        # the shard are reshuffled at each epoch, the last incomplete batch of an epoch is dropped
+        shard_start = shard_index * self.n_samples // num_shards
+        n_samples = (shard_index + 1) * self.n_samples // num_shards - shard_start
+        assert n_samples >= batch_size, 'Store has less samples than batch size {}'.format(batch_size)
+        random_state = np.random.RandomState(seed)
+        epoch = 0
+        while num_epochs is None or epoch < num_epochs:
+            permutation = shard_start + random_state.permutation(n_samples)
+            for i in range(n_samples // batch_size):
+                yield self.get_batch(np.sort(permutation[i * batch_size:(i + 1) * batch_size]))
+            epoch += 1
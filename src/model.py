@@ -1,12 +1,14 @@
 #!/usr/bin/env python
-from typing import Tuple
+from typing import Tuple, List
 
 __author__ = 'solivr'
 
 import tensorflow as tf
-from tensorflow.contrib.rnn import BasicLSTMCell
+from tensorflow.contrib.rnn import BasicLSTMCell, LSTMBlockFusedCell
 from .decoding import get_words_from_chars
 from .config import Params, CONST
+from .telemetry import TelemetryHook, sampled_summaries_hooks
+from .distillation import TeacherLogitsCache, teacher_cache_directory, distillation_loss
 
 
 def weight_variable(shape, mean=0.0, stddev=0.02, name='weights'):
@@ -25,7 +27,188 @@ def conv2d(input, filter, strides=None, padding='SAME', name=None):
     return tf.nn.conv2d(input, filter, strides=strides, padding=padding, name=name)
 
 
-def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool = True) -> tf.Tensor:
+CNN_N_FILTERS = [64, 128, 256, 256, 512, 512, 512]  # number of filters of the 7 layers of the backbones
+
+
+def cnn_filters(params: Params = None) -> List[int]:
+    # Number of filters of each layer given by the params (pruned models) or scaled by their width multiplier
+    if params is not None and params.cnn_n_filters is not None:
+        return list(params.cnn_n_filters)
+    multiplier = params.cnn_width_multiplier if params is not None else 1.0
+    return [max(1, int(round(n * multiplier))) for n in CNN_N_FILTERS]
+
+
+def vgg_cnn(input_tensor: tf.Tensor, input_channels: int, n_filters: List[int], is_training: bool,
+            summaries: bool = True) -> tf.Tensor:
+    # Following source code, not paper
+
+    # - conv1 - maxPool2x2
+    with tf.variable_scope('layer1'):
+        W = weight_variable([3, 3, input_channels, n_filters[0]])
+        b = bias_variable([n_filters[0]])
+        conv = conv2d(input_tensor, W, name='conv')
+        out = tf.nn.bias_add(conv, b)
+        conv1 = tf.nn.relu(out)
+        pool1 = tf.nn.max_pool(conv1, [1, 2, 2, 1], strides=[1, 2, 2, 1],
+                               padding='SAME', name='pool')
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer1/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer1/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # - conv2 - maxPool 2x2
+    with tf.variable_scope('layer2'):
+        W = weight_variable([3, 3, n_filters[0], n_filters[1]])
+        b = bias_variable([n_filters[1]])
+        conv = conv2d(pool1, W)
+        out = tf.nn.bias_add(conv, b)
+        conv2 = tf.nn.relu(out)
+        pool2 = tf.nn.max_pool(conv2, [1, 2, 2, 1], strides=[1, 2, 2, 1],
+                               padding='SAME', name='pool1')
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer2/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer2/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # - conv3 - w/batch-norm (as source code, not paper)
+    with tf.variable_scope('layer3'):
+        W = weight_variable([3, 3, n_filters[1], n_filters[2]])
+        b = bias_variable([n_filters[2]])
+        conv = conv2d(pool2, W)
+        out = tf.nn.bias_add(conv, b)
+        b_norm = tf.layers.batch_normalization(out, axis=-1,
+                                               training=is_training, name='batch-norm')
+        conv3 = tf.nn.relu(b_norm, name='ReLU')
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer3/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer3/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # - conv4 - maxPool 2x1
+    with tf.variable_scope('layer4'):
+        W = weight_variable([3, 3, n_filters[2], n_filters[3]])
+        b = bias_variable([n_filters[3]])
+        conv = conv2d(conv3, W)
+        out = tf.nn.bias_add(conv, b)
+        conv4 = tf.nn.relu(out)
+        pool4 = tf.nn.max_pool(conv4, [1, 2, 2, 1], strides=[1, 2, 1, 1],
+                               padding='SAME', name='pool4')
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer4/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer4/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # - conv5 - w/batch-norm
+    with tf.variable_scope('layer5'):
+        W = weight_variable([3, 3, n_filters[3], n_filters[4]])
+        b = bias_variable([n_filters[4]])
+        conv = conv2d(pool4, W)
+        out = tf.nn.bias_add(conv, b)
+        b_norm = tf.layers.batch_normalization(out, axis=-1,
+                                               training=is_training, name='batch-norm')
+        conv5 = tf.nn.relu(b_norm)
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer5/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer5/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # - conv6 - maxPool 2x1 (as source code, not paper)
+    with tf.variable_scope('layer6'):
+        W = weight_variable([3, 3, n_filters[4], n_filters[5]])
+        b = bias_variable([n_filters[5]])
+        conv = conv2d(conv5, W)
+        out = tf.nn.bias_add(conv, b)
+        conv6 = tf.nn.relu(out)
+        pool6 = tf.nn.max_pool(conv6, [1, 2, 2, 1], strides=[1, 2, 1, 1],
+                               padding='SAME', name='pool6')
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer6/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer6/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # - conv 7 - w/batch-norm (as source code, not paper)
+    with tf.variable_scope('layer7'):
+        W = weight_variable([2, 2, n_filters[5], n_filters[6]])
+        b = bias_variable([n_filters[6]])
+        conv = conv2d(pool6, W, padding='VALID')
+        out = tf.nn.bias_add(conv, b)
+        b_norm = tf.layers.batch_normalization(out, axis=-1,
+                                               training=is_training, name='batch-norm')
+        conv7 = tf.nn.relu(b_norm)
+
+        if summaries:
+            weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer7/weights:0'][0]
+            tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
+            bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer7/bias:0'][0]
+            tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    return conv7
+
+
+def separable_conv_layer(inputs: tf.Tensor, n_in: int, n_out: int, kernel_size: int, is_training: bool,
+                         padding: str = 'SAME', summaries: bool = True) -> tf.Tensor:
+    # Depthwise convolution (one filter per input channel) followed by a pointwise 1x1 convolution and a batch norm :
+    # k x k x n_in + n_in x n_out weights instead of k x k x n_in x n_out
+    depthwise_W = weight_variable([kernel_size, kernel_size, n_in, 1], name='depthwise_weights')
+    W = weight_variable([1, 1, n_in, n_out])
+    b = bias_variable([n_out])
+    depthwise = tf.nn.depthwise_conv2d(inputs, depthwise_W, strides=[1, 1, 1, 1], padding=padding,
+                                       name='depthwise_conv')
+    out = tf.nn.bias_add(conv2d(depthwise, W, name='conv'), b)
+    b_norm = tf.layers.batch_normalization(out, axis=-1, training=is_training, name='batch-norm')
+
+    if summaries:
+        tf.summary.histogram('depthwise_weights', depthwise_W, collections=[CONST.HISTOGRAM_SUMMARIES])
+        tf.summary.histogram('weights', W, collections=[CONST.HISTOGRAM_SUMMARIES])
+        tf.summary.histogram('bias', b, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    return tf.nn.relu(b_norm)
+
+
+def separable_cnn(input_tensor: tf.Tensor, input_channels: int, n_filters: List[int], is_training: bool,
+                  summaries: bool = True) -> tf.Tensor:
+    # Same layers and poolings as vgg_cnn (same output height and width) with depthwise separable convolutions
+    # after the first layer
+    with tf.variable_scope('layer1'):
+        W = weight_variable([3, 3, input_channels, n_filters[0]])
+        b = bias_variable([n_filters[0]])
+        conv1 = tf.nn.relu(tf.nn.bias_add(conv2d(input_tensor, W, name='conv'), b))
+        cnn_net = tf.nn.max_pool(conv1, [1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool')
+
+        if summaries:
+            tf.summary.histogram('weights', W, collections=[CONST.HISTOGRAM_SUMMARIES])
+            tf.summary.histogram('bias', b, collections=[CONST.HISTOGRAM_SUMMARIES])
+
+    # (kernel size, padding, strides of the max pooling after the layer) of layers 2 to 7
+    layers = [(3, 'SAME', [1, 2, 2, 1]),
+              (3, 'SAME', None),
+              (3, 'SAME', [1, 2, 1, 1]),
+              (3, 'SAME', None),
+              (3, 'SAME', [1, 2, 1, 1]),
+              (2, 'VALID', None)]
+    for i, (kernel_size, padding, pool_strides) in enumerate(layers, start=1):
+        with tf.variable_scope('layer{}'.format(i + 1)):
+            cnn_net = separable_conv_layer(cnn_net, n_filters[i - 1], n_filters[i], kernel_size, is_training,
+                                           padding=padding, summaries=summaries)
+            if pool_strides is not None:
+                cnn_net = tf.nn.max_pool(cnn_net, [1, 2, 2, 1], strides=pool_strides, padding='SAME', name='pool')
+
+    return cnn_net
+
+
+def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool = True, params: Params = None) -> tf.Tensor:
     input_tensor = input_imgs
     if input_tensor.shape[-1] == 1:
         input_channels = 1
@@ -34,150 +217,64 @@ def deep_cnn(input_imgs: tf.Tensor, is_training: bool, summaries: bool = True) -
     else:
         raise NotImplementedError
 
-    # Following source code, not paper
+    # All the backbones divide the height by 16 and the width by CONST.DIMENSION_REDUCTION_W_POOLING (minus 1 for
+    # the last 2x2 valid convolution), so that the sequence lengths seen by the lstm stay the same
+    backbone = params.cnn_backbone if params is not None else 'vgg'
+    n_filters = cnn_filters(params)
 
     with tf.variable_scope('deep_cnn'):
-        # - conv1 - maxPool2x2
-        with tf.variable_scope('layer1'):
-            W = weight_variable([3, 3, input_channels, 64])
-            b = bias_variable([64])
-            conv = conv2d(input_tensor, W, name='conv')
-            out = tf.nn.bias_add(conv, b)
-            conv1 = tf.nn.relu(out)
-            pool1 = tf.nn.max_pool(conv1, [1, 2, 2, 1], strides=[1, 2, 2, 1],
-                                   padding='SAME', name='pool')
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer1/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer1/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        # - conv2 - maxPool 2x2
-        with tf.variable_scope('layer2'):
-            W = weight_variable([3, 3, 64, 128])
-            b = bias_variable([128])
-            conv = conv2d(pool1, W)
-            out = tf.nn.bias_add(conv, b)
-            conv2 = tf.nn.relu(out)
-            pool2 = tf.nn.max_pool(conv2, [1, 2, 2, 1], strides=[1, 2, 2, 1],
-                                   padding='SAME', name='pool1')
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer2/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer2/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        # - conv3 - w/batch-norm (as source code, not paper)
-        with tf.variable_scope('layer3'):
-            W = weight_variable([3, 3, 128, 256])
-            b = bias_variable([256])
-            conv = conv2d(pool2, W)
-            out = tf.nn.bias_add(conv, b)
-            b_norm = tf.layers.batch_normalization(out, axis=-1,
-                                                   training=is_training, name='batch-norm')
-            conv3 = tf.nn.relu(b_norm, name='ReLU')
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer3/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer3/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        # - conv4 - maxPool 2x1
-        with tf.variable_scope('layer4'):
-            W = weight_variable([3, 3, 256, 256])
-            b = bias_variable([256])
-            conv = conv2d(conv3, W)
-            out = tf.nn.bias_add(conv, b)
-            conv4 = tf.nn.relu(out)
-            pool4 = tf.nn.max_pool(conv4, [1, 2, 2, 1], strides=[1, 2, 1, 1],
-                                   padding='SAME', name='pool4')
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer4/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer4/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        # - conv5 - w/batch-norm
-        with tf.variable_scope('layer5'):
-            W = weight_variable([3, 3, 256, 512])
-            b = bias_variable([512])
-            conv = conv2d(pool4, W)
-            out = tf.nn.bias_add(conv, b)
-            b_norm = tf.layers.batch_normalization(out, axis=-1,
-                                                   training=is_training, name='batch-norm')
-            conv5 = tf.nn.relu(b_norm)
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer5/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer5/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        # - conv6 - maxPool 2x1 (as source code, not paper)
-        with tf.variable_scope('layer6'):
-            W = weight_variable([3, 3, 512, 512])
-            b = bias_variable([512])
-            conv = conv2d(conv5, W)
-            out = tf.nn.bias_add(conv, b)
-            conv6 = tf.nn.relu(out)
-            pool6 = tf.nn.max_pool(conv6, [1, 2, 2, 1], strides=[1, 2, 1, 1],
-                                   padding='SAME', name='pool6')
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer6/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer6/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        # - conv 7 - w/batch-norm (as source code, not paper)
-        with tf.variable_scope('layer7'):
-            W = weight_variable([2, 2, 512, 512])
-            b = bias_variable([512])
-            conv = conv2d(pool6, W, padding='VALID')
-            out = tf.nn.bias_add(conv, b)
-            b_norm = tf.layers.batch_normalization(out, axis=-1,
-                                                   training=is_training, name='batch-norm')
-            conv7 = tf.nn.relu(b_norm)
-
-            if summaries:
-                weights = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer7/weights:0'][0]
-                tf.summary.histogram('weights', weights)
-                bias = [var for var in tf.global_variables() if var.name == 'deep_cnn/layer7/bias:0'][0]
-                tf.summary.histogram('bias', bias)
-
-        cnn_net = conv7
+        if backbone == 'separable':
+            cnn_net = separable_cnn(input_tensor, input_channels, n_filters, is_training, summaries=summaries)
+        else:
+            cnn_net = vgg_cnn(input_tensor, input_channels, n_filters, is_training, summaries=summaries)
 
         with tf.variable_scope('Reshaping_cnn'):
             shape = cnn_net.get_shape().as_list()  # [batch, height, width, features]
+            # Batch size and width can be dynamic (bucketing by width), height and features are static
+            dynamic_shape = tf.shape(cnn_net)
+            batch_size = shape[0] if shape[0] is not None else dynamic_shape[0]
+            width = shape[2] if shape[2] is not None else dynamic_shape[2]
             transposed = tf.transpose(cnn_net, perm=[0, 2, 1, 3],
                                       name='transposed')  # [batch, width, height, features]
-            conv_reshaped = tf.reshape(transposed, [shape[0], -1, shape[1] * shape[3]],
+            conv_reshaped = tf.reshape(transposed, [batch_size, width, shape[1] * shape[3]],
                                        name='reshaped')  # [batch, width, height x features]
 
     return conv_reshaped
 
 
-def deep_bidirectional_lstm(inputs: tf.Tensor, params: Params, summaries: bool = True) -> Tuple[tf.Tensor, tf.Tensor]:
+def deep_bidirectional_lstm(inputs: tf.Tensor, params: Params, summaries: bool = True,
+                            sequence_length: tf.Tensor = None) -> Tuple[tf.Tensor, tf.Tensor]:
     # Prepare data shape to match `bidirectional_rnn` function requirements
     # Current data input shape: (batch_size, n_steps, n_input) "(batch, time, height)"
 
     list_n_hidden = [256, 256]
 
     with tf.name_scope('deep_bidirectional_lstm'):
-        # Forward direction cells
-        fw_cell_list = [BasicLSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
-        # Backward direction cells
-        bw_cell_list = [BasicLSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
-
-        lstm_net, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(fw_cell_list,
-                                                                        bw_cell_list,
-                                                                        inputs,
-                                                                        dtype=tf.float32
-                                                                        )
+        if params.lstm_implementation == 'block_fused':
+            lstm_net = stack_bidirectional_fused_lstm(list_n_hidden, inputs, sequence_length=sequence_length)
+        elif params.lstm_implementation == 'unrolled':
+            # One cell per time step (no while loop), the width must be static and the sequence length is ignored
+            fw_cell_list = [BasicLSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
+            bw_cell_list = [BasicLSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
+
+            outputs, _, _ = tf.contrib.rnn.stack_bidirectional_rnn(fw_cell_list,
+                                                                   bw_cell_list,
+                                                                   tf.unstack(inputs, axis=1),
+                                                                   dtype=tf.float32
+                                                                   )
+            lstm_net = tf.stack(outputs, axis=1)
+        else:
+            # Forward direction cells
+            fw_cell_list = [BasicLSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
+            # Backward direction cells
+            bw_cell_list = [BasicLSTMCell(nh, forget_bias=1.0) for nh in list_n_hidden]
+
+            lstm_net, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(fw_cell_list,
+                                                                            bw_cell_list,
+                                                                            inputs,
+                                                                            sequence_length=sequence_length,
+                                                                            dtype=tf.float32
+                                                                            )
 
         # Dropout layer
         lstm_net = tf.nn.dropout(lstm_net, keep_prob=params.keep_prob_dropout)
@@ -194,12 +291,13 @@ def deep_bidirectional_lstm(inputs: tf.Tensor, params: Params, summaries: bool =
             if summaries:
                 weights = [var for var in tf.global_variables()
                            if var.name == 'deep_bidirectional_lstm/fully_connected/weights:0'][0]
-                tf.summary.histogram('weights', weights)
+                tf.summary.histogram('weights', weights, collections=[CONST.HISTOGRAM_SUMMARIES])
                 bias = [var for var in tf.global_variables()
                         if var.name == 'deep_bidirectional_lstm/fully_connected/bias:0'][0]
-                tf.summary.histogram('bias', bias)
+                tf.summary.histogram('bias', bias, collections=[CONST.HISTOGRAM_SUMMARIES])
 
-        lstm_out = tf.reshape(fc_out, [shape[0], -1, params.n_classes], name='reshape_out')  # [batch, width, n_classes]
+        lstm_out = tf.reshape(fc_out, [tf.shape(lstm_net)[0], -1, params.n_classes],
+                              name='reshape_out')  # [batch, width, n_classes]
 
         raw_pred = tf.argmax(tf.nn.softmax(lstm_out), axis=2, name='raw_prediction')
 
@@ -209,101 +307,187 @@ def deep_bidirectional_lstm(inputs: tf.Tensor, params: Params, summaries: bool =
         return lstm_out, raw_pred
 
 
-def crnn_fn(features, labels, mode, params):
+def stack_bidirectional_fused_lstm(list_n_hidden: list, inputs: tf.Tensor,
+                                   sequence_length: tf.Tensor = None) -> tf.Tensor:
+    # Same as stack_bidirectional_dynamic_rnn with BasicLSTMCell but each direction of each layer is one fused op
+    # over all the time steps. The variables have the same names and shapes (and the same gates order)
+    # as the ones of stack_bidirectional_dynamic_rnn so that checkpoints can be loaded by both implementations
+
+    def reverse(x):
+        if sequence_length is None:
+            return tf.reverse(x, axis=[0])
+        return tf.reverse_sequence(x, sequence_length, seq_axis=0, batch_axis=1)
+
+    layer_input = tf.transpose(inputs, [1, 0, 2])  # [width(time), batch, features]
+    with tf.variable_scope('stack_bidirectional_rnn'):
+        for i, nh in enumerate(list_n_hidden):
+            with tf.variable_scope('cell_{}'.format(i)), tf.variable_scope('bidirectional_rnn'):
+                with tf.variable_scope('fw'):
+                    fw_cell = LSTMBlockFusedCell(nh, forget_bias=1.0, name='basic_lstm_cell')
+                    output_fw, _ = fw_cell(layer_input, dtype=tf.float32, sequence_length=sequence_length)
+                with tf.variable_scope('bw'):
+                    bw_cell = LSTMBlockFusedCell(nh, forget_bias=1.0, name='basic_lstm_cell')
+                    output_bw, _ = bw_cell(reverse(layer_input), dtype=tf.float32, sequence_length=sequence_length)
+                    output_bw = reverse(output_bw)
+
+                layer_input = tf.concat([output_fw, output_bw], axis=2)
+
+    return tf.transpose(layer_input, [1, 0, 2])  # [batch, width, 2*n_hidden]
+
+
+def crnn_fn(features, labels, mode, params, config=None):
     parameters = params.get('Params')
     assert isinstance(parameters, Params)
+    # The unrolled lstm ignores the sequence lengths (the padding of the batch is seen by the lstm), export only
+    assert not (mode == tf.estimator.ModeKeys.TRAIN and parameters.lstm_implementation == 'unrolled'), \
+        "lstm_implementation='unrolled' is only meant for the export (tflite), train with 'basic' or 'block_fused'"
+    training_hooks = list()
 
     if mode == tf.estimator.ModeKeys.TRAIN:
         parameters.keep_prob_dropout = 0.7
     else:
         parameters.keep_prob_dropout = 1.0
 
-    conv = deep_cnn(features['images'], (mode == tf.estimator.ModeKeys.TRAIN), summaries=False)
-    log_prob, raw_pred = deep_bidirectional_lstm(conv, params=parameters, summaries=False)
-
     # Compute seq_len from image width
     n_pools = CONST.DIMENSION_REDUCTION_W_POOLING  # 2x2 pooling in dimension W on layer 1 and 2
     seq_len_inputs = tf.divide(features['images_widths'], n_pools, name='seq_len_input_op') - 1
 
+    # Histograms of the weights are only built when they are saved
+    histogram_summaries = mode == tf.estimator.ModeKeys.TRAIN and parameters.histogram_summaries_steps > 0
+    conv = deep_cnn(features['images'], (mode == tf.estimator.ModeKeys.TRAIN), summaries=histogram_summaries,
+                    params=parameters)
+    # The padding of the batch (images narrower than the batch width) is not seen by the lstm
+    log_prob, raw_pred = deep_bidirectional_lstm(conv, params=parameters, summaries=histogram_summaries,
+                                                 sequence_length=tf.cast(seq_len_inputs, tf.int32))
+
     predictions_dict = {'prob': log_prob,
                         'raw_predictions': raw_pred,
+                        'sequence_lengths': tf.cast(seq_len_inputs, tf.int32),
                         }
     try:
         predictions_dict['filenames'] = features['filenames']
     except KeyError:
         pass
 
-    # Alphabet and codes
-    keys = [c for c in parameters.alphabet]
-    values = parameters.alphabet_codes
-
-    # Convert string label to code label
-    with tf.name_scope('str2code_conversion'):
-        table_str2int = tf.contrib.lookup.HashTable(tf.contrib.lookup.KeyValueTensorInitializer(keys, values), -1)
-        split_label = tf.string_split(labels, delimiter='')  # TODO change string split to utf8 split in next tf version
-        codes = table_str2int.lookup(split_label.values)
-        sparse_code_target = tf.SparseTensor(split_label.indices, codes, split_label.dense_shape)
-
-    seq_lengths_labels = tf.bincount(tf.cast(sparse_code_target.indices[:, 0], tf.int32),
-                                     minlength=tf.shape(predictions_dict['prob'])[1])
-
-    # Loss
-    # ----
-    # >>> Cannot have longer labels than predictions -> error
-    with tf.control_dependencies(
-            [tf.less_equal(sparse_code_target.dense_shape[1], tf.reduce_max(tf.cast(seq_len_inputs, tf.int64)))]):
-        loss_ctc = tf.nn.ctc_loss(labels=sparse_code_target,
-                                  inputs=predictions_dict['prob'],
-                                  sequence_length=tf.cast(seq_len_inputs, tf.int32),
-                                  preprocess_collapse_repeated=False,
-                                  ctc_merge_repeated=True,
-                                  ignore_longer_outputs_than_inputs=True,
-                                  # returns zero gradient in case it happens -> ema loss = NaN
-                                  time_major=True)
-        loss_ctc = tf.reduce_mean(loss_ctc)
-        loss_ctc = tf.Print(loss_ctc, [loss_ctc], message='* Loss : ')
-
-    global_step = tf.train.get_or_create_global_step()
-    # # Create an ExponentialMovingAverage object
-    ema = tf.train.ExponentialMovingAverage(decay=0.99, num_updates=global_step, zero_debias=True)
-    # Create the shadow variables, and add op to maintain moving averages
-    maintain_averages_op = ema.apply([loss_ctc])
-
-    # Train op
-    # --------
-    learning_rate = tf.train.exponential_decay(parameters.learning_rate, global_step,
-                                               parameters.learning_decay_steps, parameters.learning_decay_rate,
-                                               staircase=True)
-
-    optimizer = get_optimizer(learning_rate, parameters)
-
-    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-    opt_op = optimizer.minimize(loss_ctc, global_step=global_step)
-    with tf.control_dependencies(update_ops + [opt_op]):
-        train_op = tf.group(maintain_averages_op)
-
-    # Summaries
-    # ---------
-    tf.summary.scalar('learning_rate', learning_rate)
-    tf.summary.scalar('losses/ctc_loss', loss_ctc)
-
     if mode == tf.estimator.ModeKeys.PREDICT:
-        loss_ctc, train_op = None, None
+        # No labels are given at prediction time
+        loss, train_op = None, None
+    else:
+        # Alphabet and codes
+        keys = [c for c in parameters.alphabet]
+        values = parameters.alphabet_codes
+
+        # Convert string label to code label
+        with tf.name_scope('str2code_conversion'):
+            table_str2int = tf.contrib.lookup.HashTable(tf.contrib.lookup.KeyValueTensorInitializer(keys, values),
+                                                        -1)
+            # TODO change string split to utf8 split in next tf version
+            split_label = tf.string_split(labels, delimiter='')
+            codes = table_str2int.lookup(split_label.values)
+            sparse_code_target = tf.SparseTensor(split_label.indices, codes, split_label.dense_shape)
+
+        seq_lengths_labels = tf.bincount(tf.cast(sparse_code_target.indices[:, 0], tf.int32),
+                                         minlength=tf.shape(predictions_dict['prob'])[1])
+
+        # Loss
+        # ----
+        # >>> Cannot have longer labels than predictions -> error
+        with tf.control_dependencies([tf.less_equal(sparse_code_target.dense_shape[1],
+                                                    tf.reduce_max(tf.cast(seq_len_inputs, tf.int64)))]):
+            loss_ctc = tf.nn.ctc_loss(labels=sparse_code_target,
+                                      inputs=predictions_dict['prob'],
+                                      sequence_length=tf.cast(seq_len_inputs, tf.int32),
+                                      preprocess_collapse_repeated=False,
+                                      ctc_merge_repeated=True,
+                                      ignore_longer_outputs_than_inputs=True,
+                                      # returns zero gradient in case it happens -> ema loss = NaN
+                                      time_major=True)
+            loss_ctc = tf.reduce_mean(loss_ctc)
+
+        loss = loss_ctc
+        distillation = mode == tf.estimator.ModeKeys.TRAIN and bool(parameters.distillation_teacher)
+        if distillation:
+            # Knowledge distillation : frame level KL divergence to the cached logits of the teacher
+            teacher_cache = TeacherLogitsCache(teacher_cache_directory(parameters.csv_files_train, parameters))
+            teacher_logits, teacher_lengths = tf.py_func(teacher_cache.lookup,
+                                                         [features['filenames'], tf.shape(predictions_dict['prob'])[0]],
+                                                         [tf.float32, tf.int32], stateful=False,
+                                                         name='teacher_logits_lookup')
+            teacher_logits.set_shape([None, None, parameters.n_classes])
+            teacher_lengths.set_shape([None])
+            loss_distillation = distillation_loss(predictions_dict['prob'], teacher_logits,
+                                                  tf.cast(seq_len_inputs, tf.int32), teacher_lengths,
+                                                  parameters.distillation_temperature)
+            loss = (1 - parameters.distillation_alpha) * loss_ctc + parameters.distillation_alpha * loss_distillation
+            tf.summary.scalar('losses/distillation_loss', loss_distillation)
+
+        global_step = tf.train.get_or_create_global_step()
+        # # Create an ExponentialMovingAverage object
+        ema = tf.train.ExponentialMovingAverage(decay=0.99, num_updates=global_step, zero_debias=True)
+        # Create the shadow variables, and add op to maintain moving averages
+        maintain_averages_op = ema.apply([loss_ctc])
+
+        # Train op
+        # --------
+        # Number of workers of the cluster of the RunConfig (TF_CONFIG), 1 when training in a single process.
+        # The effective batch size is multiplied by the number of workers (linear scaling rule)
+        num_workers = config.num_worker_replicas if config is not None else 1
+        lr_scale = num_workers if parameters.scale_learning_rate_with_workers else 1
+        learning_rate = tf.train.exponential_decay(parameters.learning_rate * lr_scale, global_step,
+                                                   parameters.learning_decay_steps, parameters.learning_decay_rate,
+                                                   staircase=True)
+
+        optimizer = get_optimizer(learning_rate, parameters)
+
+        if mode == tf.estimator.ModeKeys.TRAIN and num_workers > 1 and parameters.sync_replicas:
+            # Gradients of all the workers are averaged before each update
+            optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                                                       replicas_to_aggregate=num_workers,
+                                                       total_num_replicas=num_workers)
+            training_hooks.append(optimizer.make_session_run_hook(config.is_chief))
+
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        opt_op = optimizer.minimize(loss, global_step=global_step)
+        with tf.control_dependencies(update_ops + [opt_op]):
+            train_op = tf.group(maintain_averages_op)
+
+        # Summaries
+        # ---------
+        tf.summary.scalar('learning_rate', learning_rate)
+        tf.summary.scalar('losses/ctc_loss', loss_ctc)
+
+        if mode == tf.estimator.ModeKeys.TRAIN and (config is None or config.is_chief):
+            # Loss, lr and throughput are aggregated in-process
+            output_dir = config.model_dir if config is not None else parameters.output_model_dir
+            telemetry_tensors = {'loss': loss_ctc, 'ema_loss': ema.average(loss_ctc), 'learning_rate': learning_rate}
+            if distillation:
+                telemetry_tensors['distillation_loss'] = loss_distillation
+            training_hooks.append(TelemetryHook(telemetry_tensors,
+                                                batch_size=tf.shape(features['images'])[0],
+                                                output_dir=output_dir,
+                                                flush_secs=parameters.telemetry_flush_secs,
+                                                output_format=parameters.telemetry_format))
 
     with tf.name_scope('code2str_conversion'):
         keys = tf.cast(parameters.alphabet_decoding_codes, tf.int64)
         values = [c for c in parameters.alphabet_decoding]
         table_int2str = tf.contrib.lookup.HashTable(tf.contrib.lookup.KeyValueTensorInitializer(keys, values), '?')
 
-        sparse_code_pred, log_probability = tf.nn.ctc_beam_search_decoder(predictions_dict['prob'],
-                                                                          sequence_length=tf.cast(seq_len_inputs,
-                                                                                                  tf.int32),
-                                                                          merge_repeated=False,
-                                                                          beam_width=100,
-                                                                          top_paths=2)
+        if parameters.ctc_decoder == 'greedy':
+            sparse_code_pred, log_probability = tf.nn.ctc_greedy_decoder(predictions_dict['prob'],
+                                                                         sequence_length=tf.cast(seq_len_inputs,
+                                                                                                 tf.int32),
+                                                                         merge_repeated=True)
+        else:
+            sparse_code_pred, log_probability = tf.nn.ctc_beam_search_decoder(predictions_dict['prob'],
+                                                                              sequence_length=tf.cast(seq_len_inputs,
+                                                                                                      tf.int32),
+                                                                              merge_repeated=False,
+                                                                              beam_width=parameters.beam_width,
+                                                                              top_paths=parameters.top_paths)
         # Score
-        predictions_dict['score'] = tf.subtract(log_probability[:, 0], log_probability[:, 1])
-        # around 10.0 -> seems pretty sure, less than 5.0 bit unsure, some errors/challenging images
+        predictions_dict['score'] = prediction_score(predictions_dict['prob'], log_probability,
+                                                     tf.cast(seq_len_inputs, tf.int32), parameters.score_type)
         sparse_code_pred = sparse_code_pred[0]
 
         sequence_lengths_pred = tf.bincount(tf.cast(sparse_code_pred.indices[:, 0], tf.int32),
@@ -312,7 +496,16 @@ def crnn_fn(features, labels, mode, params):
         pred_chars = table_int2str.lookup(sparse_code_pred)
         predictions_dict['words'] = get_words_from_chars(pred_chars.values, sequence_lengths=sequence_lengths_pred)
 
-        tf.summary.text('predicted_words', predictions_dict['words'][:10])
+        tf.summary.text('predicted_words', predictions_dict['words'][:10], collections=[CONST.TEXT_SUMMARIES])
+
+    if mode == tf.estimator.ModeKeys.TRAIN and (config is None or config.is_chief):
+        # Expensive summaries are sampled, the savers are built once all the image, text (predicted words)
+        # and histogram summaries exist
+        output_dir = config.model_dir if config is not None else parameters.output_model_dir
+        summaries_hooks = sampled_summaries_hooks(parameters, output_dir)
+        assert not parameters.text_summaries_steps or CONST.TEXT_SUMMARIES in summaries_hooks, \
+            'No saver of the text summaries (predicted words)'
+        training_hooks.extend(summaries_hooks.values())
 
     if mode == tf.estimator.ModeKeys.EVAL:
         with tf.name_scope('evaluation'):
@@ -339,14 +532,34 @@ def crnn_fn(features, labels, mode, params):
     return tf.estimator.EstimatorSpec(
         mode=mode,
         predictions=predictions_dict,
-        loss=loss_ctc,
+        loss=loss,
         train_op=train_op,
         eval_metric_ops=eval_metric_ops,
         export_outputs=export_outputs,
+        training_hooks=training_hooks,
         scaffold=tf.train.Scaffold()
     )
 
 
+def prediction_score(logits: tf.Tensor, log_probability: tf.Tensor, sequence_length: tf.Tensor,
+                     score_type: str) -> tf.Tensor:
+    with tf.name_scope('score'):
+        if score_type == 'beam_margin':
+            # around 10.0 -> seems pretty sure, less than 5.0 bit unsure, some errors/challenging images
+            return tf.subtract(log_probability[:, 0], log_probability[:, 1])
+
+        # Maximum class probability of each frame
+        max_prob = tf.reduce_max(tf.nn.softmax(logits), axis=2)  # [time, batch]
+        # Only the frames of the sequence are used
+        mask = tf.transpose(tf.sequence_mask(sequence_length, maxlen=tf.shape(logits)[0]))  # [time, batch]
+
+        if score_type == 'mean_max_prob':
+            return tf.reduce_sum(tf.where(mask, max_prob, tf.zeros_like(max_prob)), axis=0) / \
+                   tf.maximum(tf.reduce_sum(tf.cast(mask, tf.float32), axis=0), 1.0)
+        else:
+            return tf.reduce_min(tf.where(mask, max_prob, tf.ones_like(max_prob)), axis=0)
+
+
 def get_optimizer(learning_rate, parameters):
     optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
     if parameters.optimizer == 'ada':
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import re
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from collections import defaultdict
+from tensorflow.python.client import timeline
+from typing import List, Tuple
+
+# Scopes of crnn_fn in which the cost of the ops is summed (the gradients are counted apart)
+_CNN_LAYER_SCOPE = re.compile(r'^deep_cnn/[^/]+')
+_SCOPES = ['deep_bidirectional_lstm', 'str2code_conversion', 'code2str_conversion', 'evaluation',
+           'dataset_pipeline', 'tfrecord_pipeline', 'memmap_pipeline']
+
+
+def op_scope_group(node_name: str) -> str:
+    # 'deep_cnn/layer3/conv/Conv2D' -> 'deep_cnn/layer3', 'gradients/deep_cnn/layer3/...' -> 'deep_cnn/layer3 (grad)'
+    node_name = node_name.split(':')[0]
+    suffix = ''
+    if node_name.startswith('gradients/'):
+        node_name, suffix = node_name[len('gradients/'):], ' (grad)'
+
+    match = _CNN_LAYER_SCOPE.match(node_name)
+    if match:
+        return match.group(0) + suffix
+    for scope in _SCOPES:
+        if node_name.startswith(scope + '/'):
+            return scope + suffix
+    if 'CTCLoss' in node_name:
+        return 'ctc_loss' + suffix
+    return 'other' + suffix
+
+
+def summarize_step_stats(step_stats, top_k: int = 20) -> Tuple[List[Tuple[str, float]], List[Tuple[str, float]]]:
+    # Time (ms) of each scope group and of the top_k most expensive ops of a traced step
+    op_times = defaultdict(float)
+    for device_stats in step_stats.dev_stats:
+        for node_stats in device_stats.node_stats:
+            op_times[node_stats.node_name.split(':')[0]] += node_stats.all_end_rel_micros / 1000
+
+    group_times = defaultdict(float)
+    for node_name, op_time in op_times.items():
+        group_times[op_scope_group(node_name)] += op_time
+
+    return sorted(group_times.items(), key=lambda item: item[1], reverse=True), \
+        sorted(op_times.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+def iterator_wait_ms(step_stats) -> float:
+    # Time (ms) spent waiting for the next batch of the tf.data iterators in a traced step ('dataset', 'tfrecord'
+    # and 'memmap' pipelines). Close to 0 when the prefetched batches are ready in time
+    return sum(node_stats.all_end_rel_micros / 1000 for device_stats in step_stats.dev_stats
+               for node_stats in device_stats.node_stats
+               if node_stats.node_name.split(':')[0].split('/')[-1].startswith('IteratorGetNext'))
+
+
+def _queue_fill_tensors() -> dict:
+    # Fill level (size / capacity) of the queues of the graph (queue runners pipeline only, the tf.data pipelines
+    # have no queues, their wait time is measured in the traced steps with iterator_wait_ms)
+    fill_tensors = dict()
+    for op in tf.get_default_graph().get_operations():
+        if op.type in ('QueueSizeV2', 'QueueSize'):
+            queue_op = op.inputs[0].op
+            try:
+                capacity = queue_op.get_attr('capacity')
+            except ValueError:
+                continue
+            if capacity > 0:
+                fill_tensors[queue_op.name] = tf.cast(op.outputs[0], tf.float32) / capacity
+    return fill_tensors
+
+
+class ProfilingHook(tf.train.SessionRunHook):
+    # Logs the wall time of the steps and the fill level of the input queues ('queue' pipeline) every
+    # log_every_n_steps, and every trace_every_n_steps traces a step : chrome timeline (chrome://tracing), cost per
+    # scope and time waited for the tf.data iterator
+    def __init__(self, output_dir: str, trace_every_n_steps: int = 1000, log_every_n_steps: int = 100,
+                 top_k: int = 20):
+        self.output_dir = output_dir
+        self.trace_every_n_steps = trace_every_n_steps
+        self.log_every_n_steps = log_every_n_steps
+        self.top_k = top_k
+
+    def begin(self):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        self._global_step = tf.train.get_global_step()
+        # The ops are created here since the graph is finalized once the session is created
+        self._queue_fill = _queue_fill_tensors()
+        if not self._queue_fill:
+            tf.logging.warning('No input queues in the graph, their fill level is only logged with '
+                               "input_pipeline='queue'. The wait for the tf.data iterator is logged in the traced "
+                               'steps (every {} steps)'.format(self.trace_every_n_steps))
+        self._step_times = list()
+        self._queue_fill_values = defaultdict(list)
+        self._next_step = None
+
+    def before_run(self, run_context):
+        self._trace = self._next_step is not None and self._next_step % self.trace_every_n_steps == 0
+        self._start_time = time.time()
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if self._trace else None
+        return tf.train.SessionRunArgs({'global_step': self._global_step, 'queue_fill': self._queue_fill},
+                                       options=options)
+
+    def after_run(self, run_context, run_values):
+        step_time = time.time() - self._start_time
+        global_step = run_values.results['global_step']
+        self._next_step = global_step + 1
+
+        if self._trace:
+            # The trace slows the step down, it is not counted in the step times
+            self._write_trace(global_step, run_values.run_metadata)
+        else:
+            self._step_times.append(step_time)
+            for name, fill in run_values.results['queue_fill'].items():
+                self._queue_fill_values[name].append(fill)
+
+        if len(self._step_times) >= self.log_every_n_steps:
+            tf.logging.info('Step {} : {:.1f} ms/step (p50 {:.1f} ms, p90 {:.1f} ms)'.format(
+                global_step, 1000 * np.mean(self._step_times), 1000 * np.percentile(self._step_times, 50),
+                1000 * np.percentile(self._step_times, 90)))
+            for name, values in self._queue_fill_values.items():
+                tf.logging.info('Queue {} : {:.0%} full (min {:.0%})'.format(name, np.mean(values), np.min(values)))
+            self._step_times = list()
+            self._queue_fill_values = defaultdict(list)
+
+    def _write_trace(self, global_step: int, run_metadata: tf.RunMetadata) -> None:
+        trace = timeline.Timeline(step_stats=run_metadata.step_stats)
+        with open(os.path.join(self.output_dir, 'timeline-{}.json'.format(global_step)), 'w') as f:
+            f.write(trace.generate_chrome_trace_format())
+
+        group_times, top_ops = summarize_step_stats(run_metadata.step_stats, self.top_k)
+        input_wait = iterator_wait_ms(run_metadata.step_stats)
+        with open(os.path.join(self.output_dir, 'op_costs-{}.json'.format(global_step)), 'w') as f:
+            json.dump({'scopes_ms': group_times, 'top_ops_ms': top_ops, 'iterator_wait_ms': input_wait}, f,
+                      indent=2)
+
+        tf.logging.info('Step {} traced, time per scope (ms) : {}'.format(
+            global_step, ', '.join('{} {:.1f}'.format(name, t) for name, t in group_times)))
+        tf.logging.info('Step {} traced, wait for the input iterator : {:.1f} ms'.format(global_step, input_wait))
+        tf.logging.info('Top {} ops (ms) : {}'.format(
+            self.top_k, ', '.join('{} {:.1f}'.format(name, t) for name, t in top_ops)))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import re
+import copy
+import numpy as np
+import tensorflow as tf
+from typing import Dict, List
+from .config import Params
+from .model import crnn_fn, cnn_filters
+
+N_CNN_LAYERS = 7
+# Input kernels of the first layer of the lstm ('basic' and 'block_fused' implementations have the same names)
+LSTM_INPUT_KERNEL_PATTERN = re.compile(r'(^|/)stack_bidirectional_rnn/cell_0/bidirectional_rnn/(fw|bw)/'
+                                       r'basic_lstm_cell/kernel$')
+_BATCH_NORM_VARIABLES = ['gamma', 'beta', 'moving_mean', 'moving_variance']
+
+
+def _layer_scope(layer: int) -> str:
+    return 'deep_cnn/layer{}'.format(layer)
+
+
+def channel_saliency(reader: tf.train.NewCheckpointReader, layer: int, criterion: str = 'bn_gamma') -> np.ndarray:
+    # Importance of each output channel of a layer : |gamma| of its batch norm ('bn_gamma', layers without batch
+    # norm fall back to the l1 norm) or l1 norm of its filters ('l1')
+    gamma_name = '{}/batch-norm/gamma'.format(_layer_scope(layer))
+    if criterion == 'bn_gamma' and reader.has_tensor(gamma_name):
+        return np.abs(reader.get_tensor(gamma_name))
+    weights = reader.get_tensor('{}/weights'.format(_layer_scope(layer)))  # [k, k, in, out]
+    return np.abs(weights).sum(axis=(0, 1, 2))
+
+
+def select_channels(checkpoint: str, layers: List[int], pruning_ratio: float,
+                    criterion: str = 'bn_gamma') -> Dict[int, np.ndarray]:
+    # Sorted indices of the channels kept in each pruned layer (the most salient ones)
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    kept_channels = dict()
+    for layer in layers:
+        saliency = channel_saliency(reader, layer, criterion)
+        n_kept = max(1, int(round(len(saliency) * (1 - pruning_ratio))))
+        kept_channels[layer] = np.sort(np.argsort(-saliency)[:n_kept])
+    return kept_channels
+
+
+def pruning_slices(variable_shapes: Dict[str, list], kept_channels: Dict[int, np.ndarray]) -> Dict[str, dict]:
+    # Variable name -> {axis: kept indices}. The outputs of a pruned layer are removed from its weights, bias and
+    # batch norm, and the corresponding inputs from the next layer (or from the input kernels of the lstm)
+    slices = dict()
+
+    def add_slice(name, axis, indices):
+        if name in variable_shapes:
+            slices.setdefault(name, dict())[axis] = indices
+
+    for layer, kept in kept_channels.items():
+        scope = _layer_scope(layer)
+        add_slice('{}/weights'.format(scope), 3, kept)
+        add_slice('{}/bias'.format(scope), 0, kept)
+        for name in _BATCH_NORM_VARIABLES:
+            add_slice('{}/batch-norm/{}'.format(scope, name), 0, kept)
+
+        if layer < N_CNN_LAYERS:
+            next_scope = _layer_scope(layer + 1)
+            add_slice('{}/weights'.format(next_scope), 2, kept)
+            add_slice('{}/depthwise_weights'.format(next_scope), 2, kept)
+        else:
+            # The lstm input is the [height x features] reshaping of the cnn output, followed by the hidden state
+            n_channels = variable_shapes['{}/weights'.format(scope)][3]
+            lstm_kernels = [name for name in variable_shapes if LSTM_INPUT_KERNEL_PATTERN.search(name)]
+            # The forward and backward kernels must be found, otherwise the checkpoint would only fail when restored
+            assert len(lstm_kernels) == 2, 'Expected the 2 input kernels (fw, bw) of the first lstm layer, found {}' \
+                .format(lstm_kernels)
+            for name in lstm_kernels:
+                shape = variable_shapes[name]
+                n_hidden = shape[1] // 4
+                input_height = (shape[0] - n_hidden) // n_channels
+                rows = [h * n_channels + c for h in range(input_height) for c in kept]
+                add_slice(name, 0, np.concatenate([rows, np.arange(shape[0] - n_hidden, shape[0])]))
+
+    return slices
+
+
+def prune_checkpoint(checkpoint: str, kept_channels: Dict[int, np.ndarray], output_dir: str) -> str:
+    # Writes a checkpoint with the pruned channels physically removed. The optimizer slots of a variable
+    # (e.g 'weights/Adam') are sliced like the variable, the other variables are copied
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    variable_shapes = reader.get_variable_to_shape_map()
+    slices = pruning_slices(variable_shapes, kept_channels)
+
+    def variable_slices(name):
+        for base_name, axes in slices.items():
+            if name == base_name or name.startswith(base_name + '/'):
+                return axes
+        return dict()
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        for name in sorted(variable_shapes):
+            value = reader.get_tensor(name)
+            for axis, indices in variable_slices(name).items():
+                value = np.take(value, indices, axis=axis)
+            tf.Variable(value, name=name)
+        sess.run(tf.global_variables_initializer())
+        global_step = reader.get_tensor(tf.GraphKeys.GLOBAL_STEP) if reader.has_tensor(tf.GraphKeys.GLOBAL_STEP) \
+            else None
+        return tf.train.Saver().save(sess, os.path.join(output_dir, 'model.ckpt'), global_step=global_step)
+
+
+def pruned_params(params: Params, kept_channels: Dict[int, np.ndarray], output_model_dir: str) -> Params:
+    params = copy.copy(params)
+    n_filters = cnn_filters(params)
+    for layer, kept in kept_channels.items():
+        n_filters[layer - 1] = len(kept)
+    params.cnn_n_filters = n_filters
+    params.output_model_dir = output_model_dir
+    return params
+
+
+def model_complexity(params: Params) -> dict:
+    # Floating point operations and number of parameters of the model on one image of the input shape
+    # (unrolled lstm so that all the operations are counted)
+    params = copy.copy(params)
+    params.lstm_implementation = 'unrolled'
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(dtype=tf.float32, shape=[1, params.input_shape[0], params.input_shape[1], 1])
+        features = {'images': images, 'images_widths': tf.constant([params.input_shape[1]], dtype=tf.int32)}
+        crnn_fn(features, None, tf.estimator.ModeKeys.PREDICT, {'Params': params})
+        flops = tf.profiler.profile(graph, options=tf.profiler.ProfileOptionBuilder.float_operation())
+        n_parameters = sum(int(np.prod(variable.get_shape().as_list())) for variable in tf.trainable_variables())
+
+    return {'flops': int(flops.total_float_ops), 'n_parameters': n_parameters, 'n_filters': cnn_filters(params)}
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import time
+import tensorflow as tf
+from typing import Dict
+from .config import Params, CONST
+
+
+class TelemetryHook(tf.train.SessionRunHook):
+    # Aggregates scalar tensors (mean over the steps) and the throughput in-process, and writes them
+    # every flush_secs to 'telemetry.jsonl' in output_dir ('jsonl') or to the event file ('events')
+    def __init__(self, tensors: dict, batch_size: tf.Tensor, output_dir: str, flush_secs: float = 60,
+                 output_format: str = 'jsonl'):
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.output_dir = output_dir
+        self.flush_secs = flush_secs
+        self.output_format = output_format
+
+    def begin(self):
+        self._global_step = tf.train.get_global_step()
+        self._reset()
+
+    def _reset(self):
+        self._sums = {name: 0.0 for name in self.tensors}
+        self._last_values = dict()
+        self._n_steps = 0
+        self._n_images = 0
+        self._start_time = time.time()
+
+    def before_run(self, run_context):
+        return tf.train.SessionRunArgs({'tensors': self.tensors, 'batch_size': self.batch_size,
+                                        'global_step': self._global_step})
+
+    def after_run(self, run_context, run_values):
+        results = run_values.results
+        for name, value in results['tensors'].items():
+            self._sums[name] += value
+        self._last_values = results['tensors']
+        self._n_steps += 1
+        self._n_images += results['batch_size']
+        self._global_step_value = results['global_step']
+
+        if time.time() - self._start_time >= self.flush_secs:
+            self._flush()
+
+    def end(self, session):
+        if self._n_steps:
+            self._flush()
+
+    def _flush(self):
+        elapsed = time.time() - self._start_time
+        metrics = {name: float(total / self._n_steps) for name, total in self._sums.items()}
+        # The moving average and the learning rate are better represented by their last value
+        for name in ['ema_loss', 'learning_rate']:
+            if name in self._last_values:
+                metrics[name] = float(self._last_values[name])
+        metrics.update({'steps_per_sec': self._n_steps / elapsed, 'images_per_sec': self._n_images / elapsed})
+
+        if self.output_format == 'jsonl':
+            metrics.update({'global_step': int(self._global_step_value), 'time': time.time()})
+            with open(os.path.join(self.output_dir, 'telemetry.jsonl'), 'a') as f:
+                f.write(json.dumps(metrics) + '\n')
+        else:
+            summary = tf.Summary(value=[tf.Summary.Value(tag='telemetry/{}'.format(name), simple_value=value)
+                                        for name, value in metrics.items()])
+            writer = tf.summary.FileWriterCache.get(self.output_dir)
+            writer.add_summary(summary, self._global_step_value)
+            writer.flush()
+        self._reset()
+
+
+def sampled_summaries_hooks(params: Params, output_dir: str) -> Dict[str, tf.train.SessionRunHook]:
+    # One summary saver per collection of expensive summaries, with its own saving rate. To be called once the
+    # summaries of the collections are built (empty collections and collections never saved have no saver)
+    hooks = dict()
+    for collection, save_steps in [(CONST.IMAGE_SUMMARIES, params.image_summaries_steps),
+                                   (CONST.TEXT_SUMMARIES, params.text_summaries_steps),
+                                   (CONST.HISTOGRAM_SUMMARIES, params.histogram_summaries_steps)]:
+        summary_op = tf.summary.merge_all(key=collection)
+        if save_steps and summary_op is not None:
+            hooks[collection] = tf.train.SummarySaverHook(save_steps=save_steps, output_dir=output_dir,
+                                                          summary_op=summary_op)
+    return hooks
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import copy
+import json
+import tensorflow as tf
+from .config import Params, CONST
+from .model import crnn_fn
+from .data_handler import preprocess_image_for_prediction
+from .tflite_recognizer import METADATA_SUFFIX
+
+
+def _tflite_converter(sess: tf.Session, input_tensors: list, output_tensors: list):
+    lite = tf.lite if hasattr(tf, 'lite') else tf.contrib.lite
+    converter_class = lite.TFLiteConverter if hasattr(lite, 'TFLiteConverter') else lite.TocoConverter
+    return converter_class.from_session(sess, input_tensors, output_tensors)
+
+
+def convert_checkpoint_to_tflite(model_dir: str, params: Params, output_filename: str, width: int = None,
+                                 min_width: int = 10, quantize: bool = False, checkpoint: str = None) -> str:
+    # The graph of crnn_fn (PREDICT) on one grayscale image of fixed size with an unrolled lstm (no while loop,
+    # lookup tables nor ctc decoder), up to the logits 'prob' [time, 1, n_classes]. The decoding is done outside
+    params = copy.copy(params)  # crnn_fn sets the dropout of the params
+    params.lstm_implementation = 'unrolled'
+    width = width if width is not None else params.input_shape[1]
+    assert width % CONST.DIMENSION_REDUCTION_W_POOLING == 0, \
+        'The width must be a multiple of {}'.format(CONST.DIMENSION_REDUCTION_W_POOLING)
+    checkpoint = checkpoint if checkpoint is not None else tf.train.latest_checkpoint(model_dir)
+
+    with tf.Graph().as_default():
+        images = tf.placeholder(dtype=tf.float32, shape=[1, params.input_shape[0], width, 1], name='images')
+        features = {'images': images, 'images_widths': tf.constant([width], dtype=tf.int32)}
+        estimator_spec = crnn_fn(features, None, tf.estimator.ModeKeys.PREDICT, {'Params': params})
+
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, checkpoint)
+            converter = _tflite_converter(sess, [images], [estimator_spec.predictions['prob']])
+            if quantize:
+                # Weights stored in int8, the computation stays in float
+                if hasattr(tf, 'lite') and hasattr(tf.lite, 'Optimize'):
+                    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                else:
+                    converter.post_training_quantize = True
+            flatbuffer = converter.convert()
+
+    with open(output_filename, 'wb') as f:
+        f.write(flatbuffer)
+    # Everything the tflite workers need to prepare the images and decode the logits
+    with open(output_filename + METADATA_SUFFIX, 'w') as f:
+        json.dump({'params': vars(params), 'min_width': min_width, 'checkpoint': checkpoint,
+                   'quantized': quantize}, f)
+
+    return output_filename
+
+
+def export_reference_saved_model(model_dir: str, params: Params, export_dir_base: str, min_width: int = 10) -> str:
+    # SavedModel of the same checkpoint (preprocess_image_for_prediction) with the greedy decoder and the score
+    # of the tflite workers, to check the parity of the tflite model
+    params = copy.copy(params)
+    params.ctc_decoder, params.score_type = 'greedy', 'mean_max_prob'
+    estimator = tf.estimator.Estimator(model_fn=crnn_fn, params={'Params': params}, model_dir=model_dir)
+    export_dir = estimator.export_savedmodel(export_dir_base,
+                                             preprocess_image_for_prediction(fixed_height=params.input_shape[0],
+                                                                             min_width=min_width))
+    return export_dir.decode() if isinstance(export_dir, bytes) else export_dir
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import json
+import numpy as np
+from typing import Tuple, Optional
+from .config import Params, CONST
+from .lexicon_decoding import CTCLexiconDecoder
+
+# The standalone tflite runtime is enough to run the converted models, tensorflow is only used without it
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+METADATA_SUFFIX = '.json'
+
+
+def load_interpreter(model_filename: str):
+    if Interpreter is not None:
+        return Interpreter(model_path=model_filename)
+    import tensorflow as tf
+    lite = tf.lite if hasattr(tf, 'lite') else tf.contrib.lite
+    return lite.Interpreter(model_path=model_filename)
+
+
+def resize_bilinear(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    # Same interpolation as tf.image.resize_images (bilinear, align_corners=False) of a [h, w, c] image
+    in_height, in_width = image.shape[:2]
+    y = np.arange(height) * (in_height / height)
+    x = np.arange(width) * (in_width / width)
+    y0, x0 = np.floor(y).astype(np.int32), np.floor(x).astype(np.int32)
+    y1, x1 = np.minimum(y0 + 1, in_height - 1), np.minimum(x0 + 1, in_width - 1)
+    dy, dx = (y - y0)[:, None, None], (x - x0)[None, :, None]
+
+    top = image[y0][:, x0] * (1 - dx) + image[y0][:, x1] * dx
+    bottom = image[y1][:, x0] * (1 - dx) + image[y1][:, x1] * dx
+    return (top * (1 - dy) + bottom * dy).astype(np.float32)
+
+
+def resized_width(image_shape: Tuple[int, int], height: int, width: Optional[int], min_width: int) -> int:
+    # Width of the image resized as in preprocess_image_for_prediction, at most the fixed width of the model
+    # (not bounded if width is None)
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    new_width = max(int(round(image_shape[1] / image_shape[0] * height / increment) * increment), min_width)
+    return new_width if width is None else min(new_width, width)
+
+
+def prepare_image(image: np.ndarray, height: int, width: int, min_width: int) -> Tuple[np.ndarray, int]:
+    # Resized as in preprocess_image_for_prediction then padded with zeros to the fixed width of the model
+    # (images wider than the model are squeezed to its width). Returns the image and its sequence length.
+    # The unrolled lstm is not masked : its backward direction runs over the padding, unlike the SavedModel
+    image = image[:, :, None] if image.ndim == 2 else image
+    increment = CONST.DIMENSION_REDUCTION_W_POOLING
+    new_width = resized_width(image.shape[:2], height, width, min_width)
+
+    padded_image = np.zeros([height, width, image.shape[2]], dtype=np.float32)
+    padded_image[:, :new_width] = resize_bilinear(image.astype(np.float32), height, new_width)
+    return padded_image, int(new_width / increment - 1)
+
+
+def greedy_decode(logits: np.ndarray, sequence_length: int, code_to_char: dict, blank: int) -> Tuple[str, float]:
+    # Same as tf.nn.ctc_greedy_decoder (merge_repeated) on the logits [time, n_classes] of one sequence.
+    # The score is the mean of the maximum class probability of each frame ('mean_max_prob')
+    logits = logits[:max(sequence_length, 1)]
+    best_path = np.argmax(logits, axis=1)
+    codes = [code for t, code in enumerate(best_path) if code != blank and (t == 0 or code != best_path[t - 1])]
+
+    prob = np.exp(logits - logits.max(axis=1, keepdims=True))
+    prob /= prob.sum(axis=1, keepdims=True)
+    return ''.join(code_to_char.get(code, '?') for code in codes), float(prob.max(axis=1).mean())
+
+
+class TFLiteRecognizer:
+    # Runs a model converted by convert_checkpoint_to_tflite on one image at a time, the ctc decoding
+    # (greedy, or a CTCLexiconDecoder) is done on the logits outside of the graph
+    def __init__(self, model_filename: str, decoder: CTCLexiconDecoder = None):
+        with open(model_filename + METADATA_SUFFIX, 'r') as f:
+            self.metadata = json.load(f)
+        self.params = Params(**self.metadata['params'])
+        self.min_width = self.metadata['min_width']
+
+        self.interpreter = load_interpreter(model_filename)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        _, self.height, self.width, _ = self._input['shape']
+
+        self.code_to_char = dict(zip(self.params.alphabet_decoding_codes, self.params.alphabet_decoding))
+        self.blank = self.params.n_classes - 1
+        self.decoder = decoder
+
+    def predict_prob(self, image: np.ndarray) -> Tuple[np.ndarray, int]:
+        # Logits [time, n_classes] of the image and the number of frames covering the image
+        input_image, sequence_length = prepare_image(image, self.height, self.width, self.min_width)
+        self.interpreter.set_tensor(self._input['index'], input_image[None])
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output['index'])[:, 0], sequence_length
+
+    def predict(self, image: np.ndarray) -> Tuple[str, float]:
+        prob, sequence_length = self.predict_prob(image)
+        if self.decoder is not None:
+            return self.decoder.decode(prob, sequence_length)
+        return greedy_decode(prob, sequence_length, self.code_to_char, self.blank)
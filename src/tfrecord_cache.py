@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+__author__ = 'solivr'
+
+import os
+import json
+import shutil
+import hashlib
+import tensorflow as tf
+from tqdm import tqdm
+from typing import List, Tuple, Iterable
+
+CACHE_INFO_FILENAME = 'cache_info.json'
+SHARD_PATTERN = 'shard-{:05d}-of-{:05d}.tfrecord'
+
+
+def get_cache_directory(csv_filenames: List[str], cache_root_dir: str) -> str:
+    # One cache directory per set of csv files, its content is validated with the cache key
+    paths = '\n'.join(sorted(os.path.abspath(f) for f in csv_filenames))
+    return os.path.join(cache_root_dir, hashlib.sha1(paths.encode('utf8')).hexdigest()[:16])
+
+
+def compute_cache_key(csv_filenames: List[str], preprocessing: dict) -> str:
+    # Key depends on the preprocessing parameters and on the content of the csv files
+    sha = hashlib.sha1()
+    sha.update(json.dumps(preprocessing, sort_keys=True).encode('utf8'))
+    for filename in csv_filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_cache_info(cache_dir: str) -> dict:
+    info_filename = os.path.join(cache_dir, CACHE_INFO_FILENAME)
+    if not os.path.isfile(info_filename):
+        return None
+    with open(info_filename, 'r') as f:
+        return json.load(f)
+
+
+def is_cache_valid(cache_dir: str, cache_key: str) -> bool:
+    cache_info = load_cache_info(cache_dir)
+    if cache_info is None or cache_info.get('key') != cache_key:
+        return False
+    return all(os.path.isfile(os.path.join(cache_dir, shard)) for shard in cache_info['shards'])
+
+
+def get_shard_filenames(cache_dir: str) -> List[str]:
+    cache_info = load_cache_info(cache_dir)
+    return [os.path.join(cache_dir, shard) for shard in cache_info['shards']]
+
+
+def _bytes_feature(value: bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value: int) -> tf.train.Feature:
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def write_tfrecord_cache(samples: Iterable[Tuple], cache_dir: str, cache_key: str, n_shards: int,
+                         padded_images: bool, input_shape: Tuple[int, int]) -> int:
+    # samples yields (uint8 image [H, W, 1], image width, label, filename) as given by decoded_samples_generator
+    if os.path.isdir(cache_dir):
+        # Stale cache
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+
+    shards = [SHARD_PATTERN.format(i, n_shards) for i in range(n_shards)]
+    writers = [tf.python_io.TFRecordWriter(os.path.join(cache_dir, '{}.tmp'.format(shard))) for shard in shards]
+
+    n_samples = 0
+    try:
+        for image, img_width, label, filename in tqdm(samples, desc='Compiling dataset'):
+            feature = {'image': _bytes_feature(image.tobytes()),
+                       'height': _int64_feature(image.shape[0]),
+                       'width': _int64_feature(image.shape[1]),
+                       'images_widths': _int64_feature(int(img_width)),
+                       'label': _bytes_feature(label),
+                       'filename': _bytes_feature(filename)}
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            # Round robin over the shards so that they all have the same size
+            writers[n_samples % n_shards].write(example.SerializeToString())
+            n_samples += 1
+    finally:
+        for writer in writers:
+            writer.close()
+
+    for shard in shards:
+        os.rename(os.path.join(cache_dir, '{}.tmp'.format(shard)), os.path.join(cache_dir, shard))
+
+    # Writing the info file last marks the cache as complete
+    cache_info = {'key': cache_key,
+                  'shards': shards,
+                  'n_samples': n_samples,
+                  'padded_images': padded_images,
+                  'input_shape': list(input_shape)}
+    with open(os.path.join(cache_dir, CACHE_INFO_FILENAME), 'w') as f:
+        json.dump(cache_info, f)
+
+    return n_samples
+
+
+def parse_tfrecord_example(serialized_example: tf.Tensor, padded_images: bool,
+                           input_shape: Tuple[int, int]) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+    features = tf.parse_single_example(serialized_example,
+                                       features={'image': tf.FixedLenFeature([], tf.string),
+                                                 'height': tf.FixedLenFeature([], tf.int64),
+                                                 'width': tf.FixedLenFeature([], tf.int64),
+                                                 'images_widths': tf.FixedLenFeature([], tf.int64),
+                                                 'label': tf.FixedLenFeature([], tf.string),
+                                                 'filename': tf.FixedLenFeature([], tf.string)},
+                                       name='tfrecord_parsing_op')
+
+    image = tf.decode_raw(features['image'], tf.uint8)
+    if padded_images:
+        image = tf.reshape(image, [input_shape[0], input_shape[1], 1])
+        image = tf.cast(image, tf.float32)
+    else:
+        image = tf.reshape(image, tf.stack([features['height'], features['width'], 1]))
+        image.set_shape([None, None, 1])
+    img_width = tf.cast(features['images_widths'], tf.int32)
+
+    return image, img_width, features['label'], features['filename']
+
@@ -3,13 +3,17 @@ __author__ = 'solivr'
 
 import argparse
 import os
-import csv
-import numpy as np
+import sys
+import subprocess
 from tqdm import trange
 import tensorflow as tf
 from src.model import crnn_fn
-from src.data_handler import data_loader
+from src.data_handler import data_loader, count_samples
 from src.data_handler import preprocess_image_for_prediction
+from src.distributed import configure_cluster
+from src.profiling import ProfilingHook
+from src.distillation import build_teacher_cache, wait_for_teacher_cache
+from evaluator import TRAINING_DONE_FILENAME
 
 from src.config import Params, Alphabet, import_params_from_json
 
@@ -24,6 +28,23 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--nb-epochs', type=int, default=30, help='Number of epochs')
     parser.add_argument('-g', '--gpu', type=str, help="GPU 0,1 or '' ", default='')
     parser.add_argument('-p', '--params-file', type=str, help='Parameters filename', default=None)
+    parser.add_argument('--worker_hosts', type=str, nargs='*', default=None,
+                        help='host:port of the workers for distributed training (the first one is the chief)')
+    parser.add_argument('--ps_hosts', type=str, nargs='*', default=None, help='host:port of the parameter servers')
+    parser.add_argument('--task_type', type=str, choices=['worker', 'ps', 'evaluator'], default='worker',
+                        help='Role of this process in distributed training')
+    parser.add_argument('--task_index', type=int, default=0, help='Index of this process among its task type')
+    parser.add_argument('--evaluator_threads', type=int, default=0,
+                        help='Train continuously and evaluate the checkpoints in a separate evaluator process '
+                             'with this number of CPU threads (0 : alternate training and evaluation)')
+    parser.add_argument('--teacher', type=str, default=None,
+                        help='Exported teacher model, the student is trained on the ctc loss and on the logits '
+                             'of the teacher (knowledge distillation)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Log step times and input queue fill levels, trace steps (chrome timeline, op costs)')
+    parser.add_argument('--profile_trace_every', type=int, default=1000, help='Steps between two traced steps')
+    parser.add_argument('--profile_log_every', type=int, default=100, help='Steps between two step time logs')
+    parser.add_argument('--profile_top_k', type=int, default=20, help='Number of most expensive ops reported')
     args = vars(parser.parse_args())
 
     if args.get('params_file'):
@@ -50,11 +71,30 @@ if __name__ == '__main__':
                             gpu=args.get('gpu')
                             )
 
+    if args.get('teacher'):
+        parameters.distillation_teacher = args.get('teacher')
+
+    distributed = bool(args.get('worker_hosts'))
+    if distributed:
+        parameters.num_workers, parameters.worker_index = configure_cluster(args.get('worker_hosts'),
+                                                                            args.get('ps_hosts'),
+                                                                            args.get('task_type'),
+                                                                            args.get('task_index'))
+        is_chief = args.get('task_type') == 'worker' and args.get('task_index') == 0
+    else:
+        is_chief = True
+
     model_params = {
         'Params': parameters,
     }
 
-    parameters.export_experiment_params()
+    if is_chief:
+        parameters.export_experiment_params()
+        if parameters.distillation_teacher:
+            # The logits of the teacher are computed once for all the epochs
+            build_teacher_cache(parameters.distillation_teacher, parameters.csv_files_train, parameters)
+    elif parameters.distillation_teacher and args.get('task_type') == 'worker':
+        wait_for_teacher_cache(parameters.distillation_teacher, parameters.csv_files_train, parameters)
 
     os.environ['CUDA_VISIBLE_DEVICES'] = parameters.gpu
     config_sess = tf.ConfigProto()
@@ -76,12 +116,74 @@ if __name__ == '__main__':
                                        config=est_config
                                        )
 
-    # Count number of image filenames in csv
-    n_samples = 0
-    for file in parameters.csv_files_eval:
-        with open(file, 'r', encoding='utf8') as csv_file:
-            reader = csv.reader(csv_file, delimiter=parameters.csv_delimiter)
-            n_samples += len(list(reader))
+    training_hooks = list()
+    if args.get('profile'):
+        tf.logging.set_verbosity(tf.logging.INFO)
+        training_hooks.append(ProfilingHook(os.path.join(parameters.output_model_dir, 'profiling'),
+                                            trace_every_n_steps=args.get('profile_trace_every'),
+                                            log_every_n_steps=args.get('profile_log_every'),
+                                            top_k=args.get('profile_top_k')))
+
+    if distributed:
+        # Each worker trains on its own shard of the data, the evaluator follows the checkpoints of the chief.
+        # Training stops after the batches of the smallest shard so that synchronous workers with unequal shards
+        # do not wait forever for the gradients of a worker that has finished its epochs
+        steps_per_worker = (count_samples(parameters.csv_files_train, parameters) // parameters.num_workers) \
+            * parameters.n_epochs // parameters.train_batch_size
+        max_steps = steps_per_worker if parameters.sync_replicas else steps_per_worker * parameters.num_workers
+        train_spec = tf.estimator.TrainSpec(input_fn=data_loader(csv_filename=parameters.csv_files_train,
+                                                                 params=parameters,
+                                                                 batch_size=parameters.train_batch_size,
+                                                                 num_epochs=parameters.n_epochs,
+                                                                 data_augmentation=True,
+                                                                 image_summaries=True,
+                                                                 shard_per_worker=True),
+                                            max_steps=max_steps,
+                                            hooks=training_hooks)
+        eval_spec = tf.estimator.EvalSpec(input_fn=data_loader(csv_filename=parameters.csv_files_eval,
+                                                               params=parameters,
+                                                               batch_size=parameters.eval_batch_size,
+                                                               num_epochs=1),
+                                          steps=None,  # the single epoch of the eval data (variable batch sizes)
+                                          throttle_secs=600)
+        tf.estimator.train_and_evaluate(estimator, train_spec, eval_spec)
+
+        if is_chief:
+            estimator.export_savedmodel(os.path.join(parameters.output_model_dir, 'export'),
+                                        preprocess_image_for_prediction(fixed_height=parameters.input_shape[0],
+                                                                        min_width=10))
+            print('Exported model to {}'.format(os.path.join(parameters.output_model_dir, 'export')))
+        exit()
+
+    if args.get('evaluator_threads'):
+        # The evaluator follows the checkpoints and stops once the last one is evaluated
+        done_filename = os.path.join(parameters.output_model_dir, TRAINING_DONE_FILENAME)
+        if os.path.isfile(done_filename):
+            os.remove(done_filename)
+        evaluator_process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                           'evaluator.py'),
+                                              '-m', parameters.output_model_dir,
+                                              '-t', str(args.get('evaluator_threads')),
+                                              '--timeout', '60'])
+        try:
+            estimator.train(input_fn=data_loader(csv_filename=parameters.csv_files_train,
+                                                 params=parameters,
+                                                 batch_size=parameters.train_batch_size,
+                                                 num_epochs=parameters.n_epochs,
+                                                 data_augmentation=True,
+                                                 image_summaries=True),
+                            hooks=training_hooks)
+        except KeyboardInterrupt:
+            print('Interrupted')
+        finally:
+            open(done_filename, 'w').close()
+
+        estimator.export_savedmodel(os.path.join(parameters.output_model_dir, 'export'),
+                                    preprocess_image_for_prediction(fixed_height=parameters.input_shape[0],
+                                                                    min_width=10))
+        print('Exported model to {}'.format(os.path.join(parameters.output_model_dir, 'export')))
+        evaluator_process.wait()
+        exit()
 
     try:
         for e in trange(0, parameters.n_epochs, parameters.evaluate_every_epoch):
@@ -90,20 +192,23 @@ if __name__ == '__main__':
                                                  batch_size=parameters.train_batch_size,
                                                  num_epochs=parameters.evaluate_every_epoch,
                                                  data_augmentation=True,
-                                                 image_summaries=True))
+                                                 image_summaries=True),
+                            hooks=training_hooks)
             estimator.evaluate(input_fn=data_loader(csv_filename=parameters.csv_files_eval,
                                                     params=parameters,
                                                     batch_size=parameters.eval_batch_size,
                                                     num_epochs=1),
-                               steps=np.floor(n_samples/parameters.eval_batch_size)
+                               steps=None  # until the end of the single epoch (batch sizes vary with bucketing)
                                )
 
     except KeyboardInterrupt:
         print('Interrupted')
         estimator.export_savedmodel(os.path.join(parameters.output_model_dir, 'export'),
-                                    preprocess_image_for_prediction(min_width=10))
+                                    preprocess_image_for_prediction(fixed_height=parameters.input_shape[0],
+                                                                    min_width=10))
         print('Exported model to {}'.format(os.path.join(parameters.output_model_dir, 'export')))
 
     estimator.export_savedmodel(os.path.join(parameters.output_model_dir, 'export'),
-                                preprocess_image_for_prediction(min_width=10))
+                                preprocess_image_for_prediction(fixed_height=parameters.input_shape[0],
+                                                                min_width=10))
     print('Exported model to {}'.format(os.path.join(parameters.output_model_dir, 'export')))